@@ -370,7 +370,7 @@ class getthings(delegate.page):
             'type': i.type,
             'limit': int(i.limit)
         }
-        things = [web.ctx.site.get(t, lazy=True) for t in web.ctx.site.things(q)]
+        things = web.ctx.site.things_with_docs(q)
         data = "\n".join("%s|%s" % (t[i.property], t.key) for t in things)
         raise web.HTTPError('200 OK', {}, data)
     
@@ -95,7 +95,7 @@ def _list_pages(path, limit, offset):
     q['offset'] = offset
     # queries are very slow with != conditions
     # q['type'] != '/type/delete'
-    return [web.ctx.site.get(key, lazy=True) for key in web.ctx.site.things(q)]
+    return web.ctx.site.things_with_docs(q)
                    
 def get_things(typename, prefix, limit):
     """Lists all things whose names start with typename"""	
@@ -105,5 +105,5 @@ def get_things(typename, prefix, limit):
         'sort': 'key',
         'limit': limit
     }
-    return [web.ctx.site.get(key, lazy=True) for key in web.ctx.site.things(q)]    
+    return web.ctx.site.things_with_docs(q)    
     
@@ -0,0 +1,222 @@
+"""Cache of keys that are known to be not present in the thing table.
+
+Requests for non-existing keys are as expensive as requests for real documents
+as the None result of get_metadata is never cached. NotFoundCache answers
+"definitely absent" in memory using two structures:
+
+* a Bloom filter over all the keys in the thing table, which is rebuilt
+  periodically in a background thread. A key which is not in the Bloom filter
+  doesn't exist.
+* an LRU of keys confirmed missing by the database, which takes care of the
+  false positives of the Bloom filter for the keys requested repeatedly.
+
+The store must call add with the keys it creates. Keys created by other
+processes are known only when they are announced by the invalidation bus or
+pg_notify, which pass them to add. So the Bloom filter is used only when one
+of them is configured, and the cache is cleared when their messages are lost.
+Otherwise only the keys confirmed missing are remembered, for miss_ttl seconds.
+"""
+import hashlib
+import logging
+import math
+import struct
+import threading
+import time
+
+import web
+from infogami.infobase import lru
+
+logger = logging.getLogger("infobase.notfound")
+
+class BloomFilter:
+    """Bloom filter backed by a bytearray.
+
+        >>> b = BloomFilter(100)
+        >>> b.add("/books/OL1M")
+        >>> "/books/OL1M" in b, "/books/OL2M" in b
+        (True, False)
+        >>> len(b)
+        1
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.nbits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.nhashes = max(1, int(round(math.log(2) * self.nbits / capacity)))
+        self.bits = bytearray((self.nbits + 7) // 8)
+        self.count = 0
+
+        # reads don't need a lock, but concurrent adds can lose bits without it.
+        self.lock = threading.Lock()
+
+    def _positions(self, key):
+        # double hashing: the k hash functions are derived from two 64 bit hashes.
+        h1, h2 = struct.unpack("<QQ", hashlib.md5(web.safestr(key)).digest())
+        return [(h1 + i * h2) % self.nbits for i in range(self.nhashes)]
+
+    def add(self, key):
+        positions = self._positions(key)
+        with self.lock:
+            for p in positions:
+                self.bits[p >> 3] |= 1 << (p & 7)
+            self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for p in self._positions(key):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+class NotFoundCache:
+    """Remembers the keys that don't exist in the thing table.
+
+    shared must be True only when the keys created by other processes are 
+    passed to add. In that case, the Bloom filter is built from the keys in the 
+    db on first use and after every rebuild_interval seconds, and the confirmed 
+    misses are kept till they are created or evicted. Till the first build is 
+    complete, only the LRU of confirmed misses is used. 
+    
+    When shared is False, the Bloom filter is not used and the confirmed misses 
+    expire after miss_ttl seconds.
+    """
+    def __init__(self, db, capacity=10000, error_rate=0.01, rebuild_interval=3600, batch_size=10000, shared=False, miss_ttl=60):
+        self.db = db
+        self.error_rate = error_rate
+        self.rebuild_interval = rebuild_interval
+        self.batch_size = batch_size
+        self.shared = shared
+        self.miss_ttl = miss_ttl
+
+        self.misses = lru.ShardedLRU(capacity)
+        self.bloom = None
+        self.last_rebuild = None
+
+        # incremented whenever keys are added.
+        # Used to ignore misses that were confirmed before a concurrent create.
+        self.generation = 0
+        # incremented on clear, to discard the Bloom filters being built at that time.
+        self.epoch = 0
+
+        self._lock = threading.Lock()
+        self._rebuilding = False
+        self._added_during_rebuild = []
+
+        self.counters = dict(lookups=0, bloom_rejects=0, miss_hits=0, misses_recorded=0, rebuilds=0, clears=0)
+
+    def is_missing(self, key):
+        """Returns True if the key definitely doesn't exist."""
+        self.counters['lookups'] += 1
+        if self.shared:
+            self._check_rebuild()
+
+        bloom = self.bloom
+        if bloom is not None and key not in bloom:
+            self.counters['bloom_rejects'] += 1
+            return True
+
+        timestamp = self.misses.get(key)
+        if timestamp is None:
+            return False
+        elif not self.shared and time.time() - timestamp > self.miss_ttl:
+            self.misses.delete(key)
+            return False
+        else:
+            self.counters['miss_hits'] += 1
+            return True
+
+    def add_missing(self, key, generation):
+        """Records that the key was not found in the db.
+
+        generation must be the value of self.generation taken before querying
+        the db. The miss is ignored if any keys were added after that as the
+        key could have been created in the meanwhile.
+        """
+        if generation == self.generation:
+            self.misses[key] = time.time()
+            self.counters['misses_recorded'] += 1
+
+    def add(self, keys):
+        """Records creation of the given keys."""
+        with self._lock:
+            self.generation += 1
+            if self._rebuilding:
+                self._added_during_rebuild.extend(keys)
+
+        bloom = self.bloom
+        for key in keys:
+            self.misses.delete(key)
+            if bloom is not None:
+                bloom.add(key)
+
+    def clear(self):
+        """Forgets all the missing keys. Called when the keys created by other processes are not known.
+        The Bloom filter is built again on the next lookup.
+        """
+        with self._lock:
+            self.generation += 1
+            self.epoch += 1
+            self.bloom = None
+            self.last_rebuild = None
+            self.misses.clear()
+        self.counters['clears'] += 1
+
+    def _check_rebuild(self):
+        if self._rebuilding:
+            return
+        if self.last_rebuild is None or time.time() - self.last_rebuild > self.rebuild_interval:
+            with self._lock:
+                if self._rebuilding:
+                    return
+                self._rebuilding = True
+                self._added_during_rebuild = []
+            t = threading.Thread(target=self.rebuild)
+            t.setDaemon(True)
+            t.start()
+
+    def rebuild(self):
+        """Builds a new Bloom filter from the keys in the thing table."""
+        try:
+            t_start = time.time()
+            epoch = self.epoch
+            max_id = self.db.query("SELECT max(id) as max_id FROM thing")[0].max_id or 0
+
+            # leave room for growth till the next rebuild.
+            bloom = BloomFilter(2 * max_id, self.error_rate)
+
+            last_id = 0
+            while True:
+                rows = self.db.query("SELECT id, key FROM thing WHERE id > $last_id ORDER BY id LIMIT $self.batch_size", vars=locals()).list()
+                if not rows:
+                    break
+                for row in rows:
+                    bloom.add(row.key)
+                last_id = rows[-1].id
+
+            with self._lock:
+                if epoch != self.epoch:
+                    # cleared while building, the keys created in the meanwhile by other processes may be missing
+                    self._added_during_rebuild = []
+                    return
+                for key in self._added_during_rebuild:
+                    bloom.add(key)
+                self.bloom = bloom
+                self._added_during_rebuild = []
+
+            self.counters['rebuilds'] += 1
+            logger.info("built bloom filter with %d keys in %.2f seconds", len(bloom), time.time() - t_start)
+        except Exception:
+            logger.error("failed to build bloom filter", exc_info=True)
+        finally:
+            if epoch == self.epoch:
+                self.last_rebuild = time.time()
+            self._rebuilding = False
+
+    def stats(self):
+        d = dict(self.counters)
+        d['queries_saved'] = d['bloom_rejects'] + d['miss_hits']
+        d['misses'] = len(self.misses)
+        d['bloom_keys'] = self.bloom is not None and len(self.bloom) or 0
+        return d
@@ -0,0 +1,274 @@
+"""Planning of the things queries with conditions on several properties.
+
+All the properties of a type are indexed in the same generic tables, like
+datum_str, with key_id and value columns. The statistics postgres keeps
+for those tables describe all the properties together, so it can't tell a
+condition matching a handful of rows from one matching millions and the
+queries with several conditions are sometimes planned badly.
+
+The planner estimates the number of rows matching the conditions on each
+property from the number of rows of the property in its table. The
+conditions are ordered by the estimates and the property with the fewest
+rows drives the query. The other properties are checked with subqueries:
+IN when they match at most in_threshold rows and EXISTS otherwise. The
+conditions on the property used for sorting are always joined. When a
+property has conditions which can't match together, like two different
+values for the same key, the query is not run at all.
+
+    >>> stats = PropertyStats(None)
+    >>> stats.tables["datum_str"] = TableStats(rows=1000000, key_rows={1: 900000, 2: 100000}, rows_per_value=10)
+    >>> stats.rows("datum_str", 1)
+    900000
+    >>> stats.add("datum_str", 1, 5)
+    >>> stats.rows("datum_str", 1)
+    900005
+
+The number of rows of each property is loaded from the statistics of the
+key_id column in pg_stats, which postgres updates on ANALYZE, and is kept up
+to date in between by IndexUtil, which reports the rows it inserts and
+deletes. These are estimates: the rows written by the other processes and
+the writes which are rolled back are not accounted till the next refresh.
+
+This is enabled by the query_planner config option.
+
+    query_planner:
+        in_threshold: 1000
+        refresh_interval: 3600
+"""
+import logging
+import threading
+import time
+
+import web
+
+logger = logging.getLogger("infobase.planner")
+
+COMMON_PROPERTIES = ['key', 'type', 'created', 'last_modified']
+
+# default selectivities of postgres for the conditions it doesn't have statistics for
+INEQUALITY_SELECTIVITY = 1.0 / 3
+MATCH_SELECTIVITY = 0.005
+
+class TableStats:
+    """Number of rows of a table and of each of the properties in it."""
+    def __init__(self, rows=0, key_rows=None, other_key_rows=0, rows_per_value=1):
+        self.rows = rows
+        # key_id -> rows for the properties with most rows
+        self.key_rows = key_rows or {}
+        # rows of any other property
+        self.other_key_rows = other_key_rows
+        # average number of rows with the same value
+        self.rows_per_value = rows_per_value
+        self.loaded_at = time.time()
+
+def _parse_array(text):
+    """Parses the text representation of a postgres array of ints.
+
+        >>> _parse_array("{1,2,3}")
+        [1, 2, 3]
+    """
+    text = text and text.strip("{}")
+    return text and [int(x) for x in text.split(",")] or []
+
+def _distinct(n_distinct, rows):
+    # negative n_distinct is the number of distinct values as a fraction of the rows
+    if n_distinct < 0:
+        return -n_distinct * rows
+    return n_distinct
+
+class PropertyStats:
+    """Estimated number of rows of each property in each of the index tables."""
+    def __init__(self, db, refresh_interval=3600):
+        self.db = db
+        self.refresh_interval = refresh_interval
+        self.tables = {}
+        # (table, key_id) -> rows inserted minus rows deleted since the stats of the table were loaded
+        self.deltas = {}
+        self._lock = threading.Lock()
+
+    def rows(self, table, key_id):
+        t = self.get_table_stats(table)
+        n = t.key_rows.get(key_id, t.other_key_rows) + self.deltas.get((table, key_id), 0)
+        return max(0, int(n))
+
+    def rows_per_value(self, table):
+        return self.get_table_stats(table).rows_per_value
+
+    def add(self, table, key_id, n):
+        """Records that n rows of the given property are inserted in the table, or deleted when n is negative."""
+        with self._lock:
+            self.deltas[table, key_id] = self.deltas.get((table, key_id), 0) + n
+
+    def get_table_stats(self, table):
+        t = self.tables.get(table)
+        if t is None or (self.refresh_interval and time.time() - t.loaded_at > self.refresh_interval):
+            try:
+                t = self._load(table)
+            except Exception:
+                logger.warn("failed to load the statistics of %s", table, exc_info=True)
+                t = t or TableStats()
+                t.loaded_at = time.time()
+            with self._lock:
+                self.tables[table] = t
+                for k in [k for k in self.deltas if k[0] == table]:
+                    del self.deltas[k]
+        return t
+
+    def _load(self, table):
+        """Loads the statistics of the table from the postgres catalog."""
+        d = self.db.query("SELECT reltuples FROM pg_class" +
+            " WHERE relname=$table AND relkind='r' AND pg_table_is_visible(oid)", vars=locals())
+        rows = d and max(0, d[0].reltuples) or 0
+
+        columns = {}
+        for r in self.db.query("SELECT attname, n_distinct, most_common_vals::text AS mcv, most_common_freqs AS freqs" +
+                " FROM pg_stats WHERE tablename=$table AND attname IN ('key_id', 'value')" +
+                " AND schemaname = ANY(current_schemas(false))", vars=locals()):
+            columns[r.attname] = r
+
+        t = TableStats(rows=rows)
+        c = columns.get('key_id')
+        if c:
+            keys = _parse_array(c.mcv)
+            freqs = c.freqs or []
+            t.key_rows = dict((k, f * rows) for k, f in zip(keys, freqs))
+            other_keys = _distinct(c.n_distinct, rows) - len(keys)
+            t.other_key_rows = rows * max(0, 1 - sum(freqs)) / max(1, other_keys)
+
+        c = columns.get('value')
+        if c:
+            t.rows_per_value = rows / max(1, _distinct(c.n_distinct, rows))
+        return t
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                tables=dict((name, dict(rows=t.rows, properties=len(t.key_rows), loaded_at=t.loaded_at))
+                    for name, t in self.tables.items()),
+                deltas=len(self.deltas))
+
+class Plan:
+    """The order of the property conditions of a query and how each of them is checked.
+
+    groups is a list of web.storage objects with key, table, key_id, estimate
+    and strategy, one for each property with conditions. The strategy is one of
+    "join", "in" and "exists". empty has the reason why the query can't match
+    anything, or None.
+    """
+    def __init__(self, groups, empty=None):
+        self.groups = groups
+        self.empty = empty
+
+    def signature(self):
+        return tuple((g.key, g.strategy) for g in self.groups)
+
+    def strategy(self, key):
+        for g in self.groups:
+            if g.key == key:
+                return g.strategy
+
+    def estimate(self):
+        """Estimates the number of things matching the query.
+        A thing must match the conditions on every property, so it is the smallest of their estimates.
+        """
+        return min(g.estimate for g in self.groups)
+
+    def dict(self):
+        return {
+            "empty": self.empty,
+            "estimate": self.estimate(),
+            "conditions": [dict(g) for g in self.groups]
+        }
+
+class Planner:
+    def __init__(self, schema, stats, in_threshold=1000):
+        self.schema = schema
+        self.stats = stats
+        self.in_threshold = in_threshold
+
+    def plan(self, store, query):
+        """Returns the Plan for the query, or None if the query doesn't need planning,
+        i.e. when it has conditions on less than two properties or on embedded objects.
+        """
+        if any(isinstance(c, query.__class__) for c in query.conditions):
+            return None
+
+        groups = []
+        conditions = {}
+        for c in query.conditions:
+            if c.key not in COMMON_PROPERTIES:
+                if c.key not in conditions:
+                    conditions[c.key] = []
+                    groups.append(web.storage(key=c.key, datatype=c.datatype))
+                conditions[c.key].append(c)
+
+        if len(groups) < 2:
+            return None
+
+        type = query.get_type()
+        empty = None
+        for g in groups:
+            g.table = self.schema.find_table(type, g.datatype, g.key)
+            g.key_id = store.get_property_id(type, g.key)
+            del g['datatype']
+            if not g.key_id:
+                g.estimate = 0
+                empty = empty or "property %s not found" % g.key
+            elif self._contradicts(conditions[g.key]):
+                g.estimate = 0
+                empty = empty or "conditions on %s can't match together" % g.key
+            else:
+                g.estimate = min(self.estimate(g.table, g.key_id, c) for c in conditions[g.key])
+
+        groups.sort(key=lambda g: g.estimate)
+
+        sort_key = query.sort and query.sort.key.lstrip("-")
+        for i, g in enumerate(groups):
+            if i == 0 or g.key == sort_key:
+                g.strategy = "join"
+            elif g.estimate <= self.in_threshold:
+                g.strategy = "in"
+            else:
+                g.strategy = "exists"
+        return Plan(groups, empty)
+
+    def estimate(self, table, key_id, c):
+        """Estimates the number of rows of the table matching the condition."""
+        rows = self.stats.rows(table, key_id)
+        n = isinstance(c.value, list) and len(c.value) or 1
+        if c.op == '=':
+            estimate = n * self.stats.rows_per_value(table)
+        elif c.op == '~':
+            estimate = rows * MATCH_SELECTIVITY
+        elif c.op == '!=':
+            estimate = rows
+        else:
+            estimate = rows * INEQUALITY_SELECTIVITY
+        return int(min(rows, estimate))
+
+    def _contradicts(self, conditions):
+        """True if the conditions on a property can't match a row together.
+
+            >>> p = Planner(None, None)
+            >>> c = lambda op, value: web.storage(op=op, value=value)
+            >>> p._contradicts([c("=", "a"), c("=", "b")])
+            True
+            >>> p._contradicts([c("=", "a"), c("=", ["a", "b"])])
+            False
+            >>> p._contradicts([c("=", [])])
+            True
+        """
+        values = None
+        for c in conditions:
+            if c.op != '=':
+                continue
+            if isinstance(c.value, list):
+                if not c.value:
+                    return True
+                v = set(c.value)
+            else:
+                v = set([c.value])
+            values = values is None and v or values & v
+            if not values:
+                return True
+        return False
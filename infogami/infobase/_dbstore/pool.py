@@ -0,0 +1,279 @@
+"""Pool of database connections shared by the threads of a process.
+
+By default, web.database opens a connection for each thread and keeps it open
+for the lifetime of the thread. The number of connections grows with the
+number of threads, idle connections are never closed and a connection broken
+by a database restart keeps failing the queries of its thread.
+
+ConnectionPool keeps between min_size and max_size connections. A connection
+is taken from the pool for each query, or for the whole of a transaction, and
+returned to the pool after it. When all max_size connections are in use, the
+threads wait for at most timeout seconds for a connection to be returned.
+Connections which have not been used for max_idle seconds are closed, till
+only min_size connections are left.
+
+A connection taken from the pool is checked before it is used. Connections
+closed by the driver are always replaced and the connections that have been
+idle for check_interval seconds or more are tested with a `SELECT 1`. The
+session settings, like statement_timeout, are set on each new connection.
+
+This is enabled by the db_pool section of the config.
+
+    db_pool:
+        min_size: 2
+        max_size: 10
+        session:
+            statement_timeout: 60000
+
+    >>> p = ConnectionPool(object, max_size=2)
+    >>> conn = p.get()
+    >>> p.put(conn)
+    >>> p.get() is conn
+    True
+    >>> sorted(p.stats()['connections'].items())
+    [('idle', 0), ('in_use', 1), ('size', 1)]
+"""
+import logging
+import threading
+import time
+
+import web
+
+logger = logging.getLogger("infobase.pool")
+
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool:
+    """Thread-safe pool of connections created by calling connect."""
+    def __init__(self, connect, min_size=1, max_size=10, timeout=30.0, max_idle=600, check_interval=10, session=None):
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.check_interval = check_interval
+        self.session = session or {}
+
+        # (connection, time it was returned) tuples, the most recently returned last.
+        self.idle = []
+        # number of open connections, including the ones in use.
+        self.size = 0
+        self.cond = threading.Condition()
+
+        self.counters = dict(
+            checkouts=0, waits=0, timeouts=0,
+            created=0, closed=0, broken=0, health_check_failures=0)
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def fill(self):
+        """Opens connections till there are min_size of them."""
+        while True:
+            with self.cond:
+                if self.size >= self.min_size:
+                    break
+                self.size += 1
+            try:
+                conn = self.connect()
+            except:
+                self._release_slot()
+                raise
+            self.put(conn)
+
+    def connect(self):
+        """Opens a new connection and applies the session settings to it."""
+        conn = self._connect()
+        try:
+            if self.session:
+                cur = conn.cursor()
+                for name, value in sorted(self.session.items()):
+                    cur.execute("SELECT set_config(%s, %s, false)", (name, str(value)))
+                conn.commit()
+        except:
+            self._close(conn)
+            raise
+        with self.cond:
+            self.counters['created'] += 1
+        return conn
+
+    def get(self):
+        """Takes a connection from the pool, opening a new one if there are no idle connections.
+        Raises PoolTimeout when no connection is available within timeout seconds.
+        """
+        t_start = time.time()
+        with self.cond:
+            self.counters['checkouts'] += 1
+            waited = False
+            while True:
+                if self.idle:
+                    conn, returned_at = self.idle.pop()
+                    break
+                elif self.size < self.max_size:
+                    # reserve a slot for the new connection.
+                    self.size += 1
+                    conn = returned_at = None
+                    break
+
+                remaining = t_start + self.timeout - time.time()
+                if remaining <= 0:
+                    self.counters['timeouts'] += 1
+                    self._record_wait(time.time() - t_start)
+                    raise PoolTimeout("no database connection available in %s seconds" % self.timeout)
+                waited = True
+                self.cond.wait(remaining)
+
+            if waited:
+                self.counters['waits'] += 1
+                self._record_wait(time.time() - t_start)
+
+        if conn is not None and not self._is_healthy(conn, returned_at):
+            with self.cond:
+                self.counters['broken'] += 1
+            self._close(conn)
+            conn = None
+
+        if conn is None:
+            try:
+                conn = self.connect()
+            except:
+                self._release_slot()
+                raise
+
+        web.ctx.poolwait = web.ctx.get('poolwait', 0.0) + time.time() - t_start
+        return conn
+
+    def put(self, conn, broken=False):
+        """Returns the connection to the pool. Broken connections are closed."""
+        if broken or getattr(conn, 'closed', False):
+            with self.cond:
+                self.counters['broken'] += 1
+            self._close(conn)
+            self._release_slot()
+            return
+
+        with self.cond:
+            self.idle.append((conn, time.time()))
+            expired = self._reap()
+            self.cond.notify()
+
+        for c in expired:
+            self._close(c)
+
+    def _reap(self):
+        """Removes the connections idle for more than max_idle seconds, leaving at least min_size connections.
+        Must be called holding the lock.
+        """
+        expired = []
+        cutoff = time.time() - self.max_idle
+        while self.idle and self.size > self.min_size and self.idle[0][1] < cutoff:
+            conn, returned_at = self.idle.pop(0)
+            expired.append(conn)
+            self.size -= 1
+        return expired
+
+    def _is_healthy(self, conn, returned_at):
+        if getattr(conn, 'closed', False):
+            return False
+        if self.check_interval is None or time.time() - returned_at < self.check_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchall()
+            conn.rollback()
+            return True
+        except Exception:
+            logger.warn("discarding broken database connection", exc_info=True)
+            with self.cond:
+                self.counters['health_check_failures'] += 1
+            return False
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self.cond:
+            self.counters['closed'] += 1
+
+    def _release_slot(self):
+        with self.cond:
+            self.size -= 1
+            self.cond.notify()
+
+    def _record_wait(self, t):
+        self.wait_time += t
+        self.max_wait_time = max(self.max_wait_time, t)
+
+    def close(self):
+        """Closes all the idle connections."""
+        with self.cond:
+            idle, self.idle = self.idle, []
+            self.size -= len(idle)
+        for conn, returned_at in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self.cond:
+            d = dict(self.counters)
+            d['connections'] = dict(size=self.size, idle=len(self.idle), in_use=self.size - len(self.idle))
+            d['min_size'] = self.min_size
+            d['max_size'] = self.max_size
+            d['wait_time'] = round(self.wait_time, 6)
+            d['max_wait_time'] = round(self.max_wait_time, 6)
+            d['avg_wait_time'] = round(self.wait_time / max(1, self.counters['waits'] + self.counters['timeouts']), 6)
+        return d
+
+def attach(db, **kw):
+    """Makes the web.database db take its connections from a new ConnectionPool
+    created with the given arguments, and returns the pool.
+
+    web.database releases the connection of a thread after every query that is
+    not in a transaction and at the end of every transaction when pooling is
+    enabled. The connection is returned to the pool at that point.
+    """
+    pool = ConnectionPool(lambda: db._connect(db.keywords), **kw)
+
+    def release(ctx, broken=False):
+        conn = ctx.pop('db', None)
+        if conn is not None:
+            pool.put(conn, broken=broken)
+
+    _load_context = db._load_context
+    def load_context(ctx):
+        _load_context(ctx)
+
+        def commit(unload=True):
+            try:
+                ctx.db.commit()
+            except:
+                release(ctx, broken=True)
+                raise
+            if unload:
+                release(ctx)
+
+        def rollback():
+            # a failed rollback must not hide the error which caused the rollback.
+            try:
+                ctx.db.rollback()
+            except Exception:
+                logger.warn("rollback failed, discarding the connection", exc_info=True)
+                release(ctx, broken=True)
+            else:
+                release(ctx)
+
+        ctx.commit = commit
+        ctx.rollback = rollback
+
+    db.has_pooling = True
+    db._connect_with_pooling = lambda keywords: pool.get()
+    db._load_context = load_context
+    db._unload_context = release
+    db.pool = pool
+
+    try:
+        pool.fill()
+    except Exception:
+        logger.error("failed to open the initial database connections", exc_info=True)
+    return pool
@@ -0,0 +1,200 @@
+"""Server-side prepared statements for the queries run on every request.
+
+Postgres parses and plans every query it receives. For the few statements
+that are run for almost every request, like reading a document by key, the
+planning takes as long as running the query. The registry prepares each of
+those statements once per connection with PREPARE and runs it with EXECUTE.
+
+Statements are registered with a name, SQL using $1, $2, ... for the
+parameters and the types of the parameters.
+
+    >>> r = StatementRegistry(None)
+    >>> r.register("thing_by_key", "SELECT * FROM thing WHERE key=$1", ["text"])
+    >>> print r.statements["thing_by_key"].prepare_sql()
+    PREPARE ib_thing_by_key (text) AS SELECT * FROM thing WHERE key=$1
+    >>> print r.statements["thing_by_key"].sql_query(["/type/type"])
+    SELECT * FROM thing WHERE key='/type/type'
+
+The prepared statements are used only when the prepared_statements config
+option is set and the database uses the connection pool from db_pool or no
+pooling at all. Otherwise, and on the connections where preparing a
+statement failed, the statements are run as plain queries. Ad-hoc queries
+are not affected and keep using db.query directly.
+
+The number of calls and the time taken by each statement are recorded.
+"""
+import logging
+import re
+import threading
+import time
+import weakref
+
+import web
+
+logger = logging.getLogger("infobase.prepared")
+
+PREPARED, BROKEN = "prepared", "broken"
+
+# SQLSTATEs of the errors which mean that the prepared statement can't be used anymore:
+# invalid_sql_statement_name (it doesn't exist) and feature_not_supported (cached plan must not change result type)
+UNUSABLE_ERRORS = ["26000", "0A000"]
+
+class Statement:
+    def __init__(self, name, sql, types):
+        self.name = name
+        self.sql = sql
+        self.types = types
+        self.prepared_name = "ib_" + name
+
+    def _split(self, values):
+        """Returns the SQL as a list of strings and SQLParams of the values."""
+        items = []
+        for i, part in enumerate(re.split(r"\$(\d+)", self.sql)):
+            if i % 2:
+                items.append(web.SQLParam(values[int(part) - 1]))
+            elif part:
+                items.append(part)
+        return items
+
+    def sql_query(self, values):
+        """Returns the statement as a plain query with the values as parameters."""
+        return web.SQLQuery(self._split(values))
+
+    def prepare_sql(self):
+        return "PREPARE %s (%s) AS %s" % (self.prepared_name, ", ".join(self.types), self.sql)
+
+    def execute_query(self, values):
+        items = ["EXECUTE %s (" % self.prepared_name]
+        for i, v in enumerate(values):
+            if i:
+                items.append(", ")
+            items.append(web.SQLParam(v))
+        items.append(")")
+        return web.SQLQuery(items)
+
+class StatementRegistry:
+    """Statements of a web.database, prepared on each of its connections when enabled."""
+    def __init__(self, db, enabled=False):
+        self.db = db
+        self.enabled = enabled
+        self.statements = {}
+        # connection -> {name: PREPARED or BROKEN}
+        self._connections = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.counters = {}
+
+    def register(self, name, sql, types):
+        self.statements[name] = Statement(name, sql, types)
+        self.counters.setdefault(name, dict(calls=0, prepares=0, plain=0, errors=0, time=0.0, max_time=0.0))
+
+    def register_all(self, statements):
+        """Registers the statements in the given dict of name -> (sql, types)."""
+        for name, (sql, types) in statements.items():
+            if name not in self.statements:
+                self.register(name, sql, types)
+        
+    def query(self, name, *values):
+        """Runs the statement with the given values and returns the result like db.query."""
+        stmt = self.statements[name]
+        t_start = time.time()
+        try:
+            return self._query(stmt, values)
+        except:
+            self._count(name, 'errors')
+            raise
+        finally:
+            t = time.time() - t_start
+            with self._lock:
+                c = self.counters[name]
+                c['calls'] += 1
+                c['time'] += t
+                c['max_time'] = max(c['max_time'], t)
+
+    def _query(self, stmt, values):
+        states = None
+        if self.enabled:
+            states = self._get_states()
+        if states is None or states.get(stmt.name) == BROKEN:
+            self._count(stmt.name, 'plain')
+            return self.db.query(stmt.sql_query(values))
+
+        if stmt.name not in states:
+            self._prepare(stmt, states)
+            if states[stmt.name] == BROKEN:
+                return self.db.query(stmt.sql_query(values))
+
+        try:
+            return self.db.query(stmt.execute_query(values))
+        except Exception, e:
+            if getattr(e, 'pgcode', None) not in UNUSABLE_ERRORS:
+                raise
+            logger.warn("prepared statement %s is not usable anymore: %s", stmt.prepared_name, e)
+            states[stmt.name] = BROKEN
+            # the error aborts the transaction, so the query can only be retried outside of one
+            if self.db.ctx.transactions:
+                raise
+        self._count(stmt.name, 'plain')
+        return self.db.query(stmt.sql_query(values))
+
+    def _get_states(self):
+        """Returns the states of the statements on the connection of the current thread.
+        Returns None if the connection can't be tracked.
+        """
+        conn = self.db.ctx.db
+        with self._lock:
+            try:
+                return self._connections.setdefault(conn, {})
+            except TypeError:
+                # not weak-referenceable
+                return None
+
+    def _prepare(self, stmt, states):
+        # PREPARE is run on the connection directly as db.query could release the connection to the pool.
+        # When not in a transaction, the implicit transaction started here is committed by the EXECUTE.
+        # In a transaction, it is run in a savepoint as a failed statement aborts the whole transaction.
+        conn = self.db.ctx.db
+        in_transaction = bool(self.db.ctx.transactions)
+        cursor = conn.cursor()
+        self._count(stmt.name, 'prepares')
+        try:
+            if in_transaction:
+                cursor.execute("SAVEPOINT ib_prepare")
+            cursor.execute(stmt.prepare_sql())
+        except Exception:
+            logger.warn("failed to prepare %s", stmt.prepared_name, exc_info=True)
+            states[stmt.name] = BROKEN
+            if in_transaction:
+                cursor.execute("ROLLBACK TO SAVEPOINT ib_prepare")
+            else:
+                conn.rollback()
+        else:
+            if in_transaction:
+                cursor.execute("RELEASE SAVEPOINT ib_prepare")
+            states[stmt.name] = PREPARED
+
+    def _count(self, name, counter):
+        with self._lock:
+            self.counters[name][counter] += 1
+
+    def stats(self):
+        with self._lock:
+            d = {}
+            for name, c in self.counters.items():
+                d[name] = dict(c, avg_time=round(c['time'] / max(1, c['calls']), 6), time=round(c['time'], 6), max_time=round(c['max_time'], 6))
+            return dict(enabled=self.enabled, statements=d)
+
+def attach(db):
+    """Enables prepared statements for the given web.database."""
+    if db.has_pooling and getattr(db, 'pool', None) is None:
+        # connections of other pools are wrapped in a new object for each checkout, which can't be tracked.
+        logger.warn("prepared statements are disabled as they don't work with DBUtils pooling. Use db_pool instead.")
+        return get_registry(db)
+    db.statements = StatementRegistry(db, enabled=True)
+    return db.statements
+
+def get_registry(db):
+    """Returns the statement registry of the given web.database, creating a disabled one if it has none."""
+    registry = getattr(db, 'statements', None)
+    if registry is None:
+        registry = db.statements = StatementRegistry(db)
+    return registry
@@ -0,0 +1,401 @@
+"""Compiled SQL of the things queries, cached by the shape of the query.
+
+Building the SQL of a things query involves finding the tables of the
+properties in the schema, joining them and formatting the conditions. The
+hottest queries differ only in their values, like the key of the author in
+{"type": "/type/edition", "authors": {"key": ...}}. So the SQL is compiled
+once for each shape of the query, i.e. the type, the keys, ops and datatypes
+of the conditions and the sort order, into a template with a slot for each
+value. Running a query only fills the slots of the template of its shape.
+
+    >>> from schema import Schema
+    >>> from infogami.infobase import readquery
+    >>> q = readquery.Query()
+    >>> q.add_condition("type", "=", "ref", "/type/page")
+    >>> q.add_condition("title", "=", "str", "foo")
+    >>> q.limit, q.offset = 20, 0
+    >>> compiled = compile_query(Schema(), q)
+    >>> print compiled.sql()
+    SELECT d0.thing_id FROM datum_str as d0 WHERE d0.key_id=$1 AND d0.value = $2 LIMIT $3 OFFSET $4
+
+The values of ref conditions are the keys of the things, which are replaced
+by their ids when the template is filled. When a thing or a property in the
+query doesn't exist, StopIteration is raised to indicate the empty result.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import web
+
+from infogami.infobase import common, lru
+
+COMMON_PROPERTIES = ['key', 'type', 'created', 'last_modified']
+
+def query_shape(query):
+    """Returns a hashable description of everything in the query except the values.
+
+    Lists of values are expanded into one condition for each value, so the
+    number of values is part of the shape.
+    """
+    conditions = []
+    for c in query.conditions:
+        if isinstance(c, query.__class__):
+            conditions.append(("query", c.key, query_shape(c)))
+        elif isinstance(c.value, list):
+            conditions.append((c.key, c.op, c.datatype, len(c.value)))
+        else:
+            conditions.append((c.key, c.op, c.datatype, None))
+    sort = query.sort and (query.sort.key, query.sort.datatype)
+    return (query.get_type(), tuple(conditions), sort, query.use_cursor, bool(query.cursor))
+
+class CompiledQuery:
+    """SQL template of a things query.
+
+    The template is a list of strings and slot numbers. The value of each
+    slot is computed from the query by the function at the same position in
+    the slots list.
+    """
+    def __init__(self, template, slots, column):
+        self.template = template
+        self.slots = slots
+        # column of the result with the thing key or thing id
+        self.column = column
+
+    def bind(self, store, query):
+        """Returns the SQLQuery for the given query of the shape of this template."""
+        values = [f(store, query) for f in self.slots]
+        items = []
+        for x in self.template:
+            if isinstance(x, int):
+                items.append(web.SQLParam(values[x]))
+            else:
+                items.append(x)
+        return web.SQLQuery(items)
+
+    def sql(self):
+        """Returns the template with $1, $2... in place of the slots."""
+        return "".join(isinstance(x, int) and "$%d" % (x + 1) or x for x in self.template)
+
+def _get_condition(query, path):
+    for i in path:
+        query = query.conditions[i]
+    return query
+
+def _condition_value(path, index):
+    def f(store, query):
+        c = _get_condition(query, path)
+        value = c.value
+        if index is not None:
+            value = value[index]
+        if c.datatype == 'ref':
+            metadata = store.get_metadata(value)
+            if metadata is None:
+                # required object is not found so the query result wil be empty.
+                raise StopIteration
+            value = metadata.id
+        if c.op == '~':
+            value = value.replace('*', '%')
+        return value
+    return f
+
+def _property_id(key):
+    def f(store, query):
+        key_id = store.get_property_id(query.get_type(), key)
+        if not key_id:
+            raise StopIteration
+        return key_id
+    return f
+
+def _attr(*names):
+    def f(store, query):
+        value = query
+        for name in names:
+            value = getattr(value, name)
+        return value
+    return f
+
+def compile_query(schema, query, plan=None, count=None):
+    """Compiles the query into a CompiledQuery.
+
+    When a planner.Plan is given, the properties are joined in the order of
+    the plan and the properties it checks with IN or EXISTS are put in subqueries.
+
+    When count is "exact", the query counts the matching things, ignoring the
+    limit, offset and cursor. When count is "estimate", the query is an EXPLAIN
+    of the query selecting all the matching things.
+    """
+    type = query.get_type()
+
+    # type is required if there are conditions/sort on keys other than [key, type, created, last_modified]
+    _sort = query.sort and query.sort.key
+    if _sort and _sort.startswith('-'):
+        _sort = _sort[1:]
+    type_required = bool([c for c in query.conditions if c.key not in COMMON_PROPERTIES]) or (_sort and _sort not in COMMON_PROPERTIES)
+
+    if type_required and type is None:
+        raise common.BadData(message="Type Required")
+
+    class DBTable:
+        def __init__(self, name, label=None):
+            self.name = name
+            self.label = label or name
+
+        def sql(self):
+            if self.label != self.name:
+                return "%s as %s" % (self.name, self.label)
+            else:
+                return self.name
+
+        def __repr__(self):
+            return self.label
+
+    # in the order of the conditions, the first table is joined with all the others
+    tables = OrderedDict()
+    slots = []
+    # (strategy, table, label, where clauses) of the properties checked with subqueries
+    subqueries = {}
+
+    def get_table(datatype, key):
+        if key not in tables:
+            assert type is not None, "Missing type"
+            table = schema.find_table(type, datatype, key)
+            label = 'd%d' % len(tables)
+            tables[key] = DBTable(table, label)
+        return tables[key]
+
+    def slot(f):
+        slots.append(f)
+        return len(slots) - 1
+
+    # each where clause is a list of strings and slots
+    wheres = []
+
+    def compare(column, op, c, path):
+        if c.value == []:
+            return ["1=2"]
+        elif isinstance(c.value, list):
+            items = ["("]
+            for i in range(len(c.value)):
+                if i:
+                    items.append(" OR ")
+                items += ["%s %s " % (column, op), slot(_condition_value(path, i))]
+            items.append(")")
+            return items
+        else:
+            return ["%s %s " % (column, op), slot(_condition_value(path, None))]
+
+    def process(c, path, ordering_func=None):
+        # ordering_func is used when the query contains emebbabdle objects
+        #
+        # example: {'links': {'title: 'foo', 'url': 'http://example.com/foo'}}
+        if c.op == '~':
+            op = 'LIKE'
+        else:
+            op = c.op
+
+        if c.key in COMMON_PROPERTIES:
+            #@@ special optimization to avoid join with thing.type when there are non-common properties in the query.
+            #@@ Since type information is already present in property table,
+            #@@ getting property id is equivalent to join with type.
+            if c.key == 'type' and type_required:
+                return
+
+            wheres.append(compare('thing.' + c.key, op, c, path))
+
+            # Add thing table explicitly because get_table is not called
+            tables['_thing'] = DBTable("thing")
+        elif plan and plan.strategy(c.key) in ["in", "exists"]:
+            if c.key not in subqueries:
+                label = 's%d' % len(subqueries)
+                table = schema.find_table(type, c.datatype, c.key)
+                subqueries[c.key] = (plan.strategy(c.key), table, label, [['%s.key_id=' % label, slot(_property_id(c.key))]])
+            strategy, table, label, xwheres = subqueries[c.key]
+            xwheres.append(compare('%s.value' % label, op, c, path))
+        else:
+            table = get_table(c.datatype, c.key)
+            wheres.append(['%s.key_id=' % table, slot(_property_id(c.key))])
+            wheres.append(compare('%s.value' % table, op, c, path))
+            if ordering_func:
+                wheres.append([ordering_func(table)])
+
+    def make_ordering_func():
+        d = web.storage(table=None)
+        def f(table):
+            d.table = d.table or table
+            if d.table == table:
+                # avoid a comparsion when both tables are same. it fails when ordering is None
+                return "1 = 1"
+            else:
+                return '%s.ordering = %s.ordering' % (table, d.table)
+        return f
+
+    def process_query(q, path=(), ordering_func=None):
+        conditions = list(enumerate(q.conditions))
+        if plan and not path:
+            # process the conditions in the order of the plan, so that the first property of the plan is d0.
+            rank = dict((g.key, i) for i, g in enumerate(plan.groups))
+            conditions.sort(key=lambda x: rank.get(x[1].key, len(rank)))
+        for i, c in conditions:
+            if isinstance(c, q.__class__):
+                process_query(c, path + (i,), ordering_func or make_ordering_func())
+            else:
+                process(c, path + (i,), ordering_func)
+
+    sort = web.storage(column=None, desc=False)
+
+    def process_sort(query):
+        """Process sort field in the query and finds the db column to order by."""
+        if query.sort:
+            sort_key = query.sort.key
+            if sort_key.startswith('-'):
+                sort.desc = True
+                sort_key = sort_key[1:]
+
+            if sort_key in COMMON_PROPERTIES:
+                sort.column = 'thing.' + sort_key
+                # Add thing table explicitly because get_table is not called
+                tables['_thing'] = DBTable("thing")
+            else:
+                table = get_table(query.sort.datatype, sort_key)
+                wheres.append(['%s.key_id=' % table, slot(_property_id(sort_key))])
+                sort.column = table.label + '.value'
+
+    process_query(query)
+    # special care for case where query {}.
+    if not tables:
+        tables['_thing'] = DBTable('thing')
+    process_sort(query)
+
+    def add_joins():
+        labels = [t.label for t in tables.values()]
+        def get_column(table):
+            if table == 'thing': return 'thing.id'
+            else: return table + '.thing_id'
+
+        if len(labels) > 1:
+            x = labels[0]
+            wheres.extend([get_column(x) + ' = ' + get_column(y)] for y in labels[1:])
+
+    add_joins()
+    table_names = [t.sql() for t in tables.values()]
+    if 'thing' in table_names:
+        id_column, column = 'thing.id', 'key'
+    else:
+        id_column, column = 'd0.thing_id', 'thing_id'
+
+    for strategy, table, label, xwheres in sorted(subqueries.values(), key=lambda x: x[2]):
+        if strategy == "in":
+            items = ["%s IN (SELECT %s.thing_id FROM %s as %s WHERE " % (id_column, label, table, label)]
+        else:
+            items = ["EXISTS (SELECT 1 FROM %s as %s WHERE " % (table, label)]
+            xwheres = [["%s.thing_id = %s" % (label, id_column)]] + xwheres
+        for i, w in enumerate(xwheres):
+            if i:
+                items.append(" AND ")
+            items += w
+        items.append(")")
+        wheres.append(items)
+
+    what = id_column == 'thing.id' and 'thing.key' or id_column
+    direction = sort.desc and " desc" or ""
+    if count:
+        # a thing can match more than once when a property has many values
+        if count == "exact":
+            what, column = "count(DISTINCT %s) AS count" % id_column, "count"
+        else:
+            what = id_column
+        order = None
+    elif query.use_cursor:
+        # keyset pagination: order by the sort column and the thing id and
+        # seek past the last row of the previous page instead of using offset.
+        if sort.column:
+            order = "%s%s, %s%s" % (sort.column, direction, id_column, direction)
+            what += ", %s as cursor_value, %s as cursor_id" % (sort.column, id_column)
+        else:
+            order = id_column
+            what += ", %s as cursor_id" % id_column
+
+        if query.cursor:
+            op = sort.desc and "<" or ">"
+            if sort.column:
+                wheres.append(["(%s, %s) %s (" % (sort.column, id_column, op),
+                    slot(_attr("cursor", "value")), ", ", slot(_attr("cursor", "id")), ")"])
+            else:
+                wheres.append(["%s %s " % (id_column, op), slot(_attr("cursor", "id"))])
+    elif sort.column:
+        order = sort.column + direction
+    else:
+        order = None
+
+    template = ["SELECT %s FROM %s WHERE " % (what, ", ".join(table_names))]
+    for i, w in enumerate(wheres or [["1 = 1"]]):
+        if i:
+            template.append(" AND ")
+        template += w
+    if count == "estimate":
+        template.insert(0, "EXPLAIN ")
+        column = "QUERY PLAN"
+    elif not count:
+        if order:
+            template.append(" ORDER BY " + order)
+        template += [" LIMIT ", slot(_attr("limit"))]
+        if not query.use_cursor:
+            template += [" OFFSET ", slot(_attr("offset"))]
+    return CompiledQuery(template, slots, column)
+
+class QueryCache:
+    """LRU cache of the compiled queries by shape.
+
+    The number of hits and misses and the time spent in compiling the queries
+    are recorded.
+    """
+    def __init__(self, schema, capacity=1000):
+        self.schema = schema
+        self.capacity = capacity
+        self.cache = capacity and lru.LRU(capacity) or None
+        self._lock = threading.Lock()
+        self.counters = dict(hits=0, misses=0, compile_time=0.0, max_compile_time=0.0)
+
+    def get(self, query, plan=None, count=None):
+        """Returns the CompiledQuery for the given query, planner.Plan and count mode."""
+        if self.cache is None:
+            return self._compile(query, plan, count)
+
+        shape = query_shape(query), plan and plan.signature(), count
+        compiled = self.cache.get(shape)
+        if compiled is not None:
+            self._count('hits')
+            return compiled
+
+        compiled = self.cache[shape] = self._compile(query, plan, count)
+        return compiled
+
+    def _compile(self, query, plan, count):
+        t_start = time.time()
+        compiled = compile_query(self.schema, query, plan, count)
+        t = time.time() - t_start
+        with self._lock:
+            c = self.counters
+            c['misses'] += 1
+            c['compile_time'] += t
+            c['max_compile_time'] = max(c['max_compile_time'], t)
+        return compiled
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def clear(self):
+        if self.cache is not None:
+            self.cache.clear()
+
+    def stats(self):
+        with self._lock:
+            d = dict(self.counters)
+        d['compile_time'] = round(d['compile_time'], 6)
+        d['max_compile_time'] = round(d['max_compile_time'], 6)
+        d['avg_compile_time'] = round(d['compile_time'] / max(1, d['misses']), 6)
+        d['size'] = self.cache is not None and len(self.cache.d) or 0
+        d['capacity'] = self.capacity
+        return d
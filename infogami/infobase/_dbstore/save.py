@@ -5,6 +5,7 @@ import simplejson
 from collections import defaultdict
 
 from indexer import Indexer
+from prepared import get_registry
 from schema import INDEXED_DATATYPES, Schema
 
 from infogami.infobase import config, common
@@ -13,9 +14,18 @@ __all__ = ["SaveImpl"]
 
 class SaveImpl:
     """Save implementaion."""
-    def __init__(self, db, schema=None, indexer=None, property_manager=None):
+    statements = {
+        "records_for_update": ("SELECT thing.*, data.data FROM thing, data" + 
+            " WHERE thing.key = ANY($1)" + 
+            " AND data.thing_id=thing.id AND data.revision = thing.latest_revision" + 
+            " FOR UPDATE NOWAIT", ["text[]"]),
+    }
+    
+    def __init__(self, db, schema=None, indexer=None, property_manager=None, stats=None):
         self.db = db
-        self.indexUtil = IndexUtil(db, schema, indexer, property_manager and property_manager.copy())
+        self.prepared = get_registry(db)
+        self.prepared.register_all(self.statements)
+        self.indexUtil = IndexUtil(db, schema, indexer, property_manager and property_manager.copy(), stats)
         self.thing_ids = {}
         
     def process_json(self, key, json):
@@ -59,6 +69,9 @@ class SaveImpl:
             data = [dict(thing_id=r.id, revision=r.revision, data=simplejson.dumps(r.data)) for r in records]
             self.db.multiple_insert('data', data, seqname=False)
             
+            if config.get('use_latest_data'):
+                self._update_latest_data(records, data)
+            
             self._update_index(records)
         except:
             dbtx.rollback()
@@ -69,6 +82,15 @@ class SaveImpl:
         changeset['old_docs'] = [r.prev.data for r in records]
         return changeset
         
+    def _update_latest_data(self, records, data):
+        """Copies the data of the new revisions to the latest_data table."""
+        new = []
+        for r, d in zip(records, data):
+            if r.revision == 1 or not self.db.update('latest_data', where='thing_id=$r.id', vars=locals(), revision=r.revision, data=d['data']):
+                new.append(dict(thing_id=r.id, key=r.key, revision=r.revision, data=d['data']))
+        if new:
+            self.db.multiple_insert('latest_data', new, seqname=False)
+        
     def _add_transaction(self, changeset):
         tx = {
             "action": changeset['kind'],
@@ -167,11 +189,7 @@ class SaveImpl:
         Each record is a storage object with (id, key, type, revision, last_modified, data) keys.
         """
         try:
-            rows = self.db.query("SELECT thing.*, data.data FROM thing, data" + 
-                " WHERE thing.key in $keys" + 
-                " AND data.thing_id=thing.id AND data.revision = thing.latest_revision" + 
-                " FOR UPDATE NOWAIT",
-                vars=locals())
+            rows = self.prepared.query("records_for_update", [web.safeunicode(k) for k in keys])
         except:
             raise common.Conflict(keys=keys, reason="Edit conflict detected.")
         
@@ -266,11 +284,13 @@ class IndexUtil:
     Dictionary of (table, thing_id, property_id) -> [values] for a set of documents.
     This is generated by compling the document index.
     """
-    def __init__(self, db, schema=None, indexer=None, property_manager=None):
+    def __init__(self, db, schema=None, indexer=None, property_manager=None, stats=None):
         self.db = db
         self.schema = schema or Schema()
         self._indexer = indexer or Indexer()
         self.property_manager = property_manager or PropertyManager(db)
+        # planner.PropertyStats to be informed about the number of rows inserted and deleted, if any
+        self.stats = stats
         self.thing_ids = {}
         
     def compute_index(self, doc):
@@ -426,6 +446,10 @@ class IndexUtil:
                 for v in values]
             self.db.multiple_insert(table, data, seqname=False)
             
+            if self.stats:
+                for (thing_id, property_id), values in group.iteritems():
+                    self.stats.add(table, property_id, len(values))
+            
     def delete_index(self, index):
         """Deletes the given index from database."""
         for table, group in self.group_index(index).iteritems():
@@ -446,6 +470,12 @@ class IndexUtil:
             for thing_id, pids in d.iteritems():
                 self.db.delete(table, where="thing_id=$thing_id AND key_id IN $pids", vars=locals())
             
+            # the number of rows deleted is known only for the deletes of the old values of a property.
+            if self.stats:
+                for (thing_id, property_id), values in group.iteritems():
+                    if property_id:
+                        self.stats.add(table, property_id, -len(values))
+            
     def get_thing_ids(self, keys):
         ### TODO: same function is there is SaveImpl too. Get rid of this duplication.
         keys = list(set(keys))
@@ -472,8 +502,15 @@ class IndexUtil:
 class PropertyManager:
     """Class to manage property ids.
     """
+    statements = {
+        "property_by_name": ("SELECT * FROM property WHERE type=$1 AND name=$2", ["int", "text"]),
+        "thing_id_by_key": ("SELECT id FROM thing WHERE key=$1", ["text"]),
+    }
+    
     def __init__(self, db):
         self.db = db
+        self.prepared = get_registry(db)
+        self.prepared.register_all(self.statements)
         self._cache = None
         self.thing_ids = {}
         
@@ -501,7 +538,7 @@ class PropertyManager:
             return self.get_cache()[type, name]
         except KeyError:
             type_id = self.get_thing_id(type)
-            d = self.db.query("SELECT * FROM property WHERE type=$type_id AND name=$name", vars=locals())
+            d = self.prepared.query("property_by_name", type_id, name)
 
             if d:
                 pid = d[0].id
@@ -517,7 +554,7 @@ class PropertyManager:
         try:
             id = self.thing_ids[key]
         except KeyError:
-            id = self.db.query("SELECT id FROM thing WHERE key=$key", vars=locals())[0].id
+            id = self.prepared.query("thing_id_by_key", key)[0].id
             self.thing_ids[key] = id
         return id
         
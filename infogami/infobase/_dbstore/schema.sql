@@ -4,11 +4,12 @@ BEGIN;
 
 -- changelog:
 -- 10: added active and bot columns to account and created meta table to track the schema version.
+-- 11: added latest_data table with the data of the latest revision of each thing.
 
 create table meta (
     version int
 );
-insert into meta (version) values (10);
+insert into meta (version) values (11);
 
 $if multisite:
     create table site (
@@ -107,6 +108,15 @@ create table data (
 );
 create unique index data_thing_id_revision_idx ON data(thing_id, revision);
 
+-- copy of the latest revision in data, maintained only when config.use_latest_data is set.
+create table latest_data (
+    thing_id int primary key references thing,
+    key text,
+    revision int,
+    data text
+);
+create unique index latest_data_key_idx ON latest_data(key);
+
 $ sqltypes = dict(int="int", float="float", boolean="boolean", str="varchar(2048)", datetime="timestamp", ref="int references thing")
 
 $for table, datatype in tables:
@@ -0,0 +1,81 @@
+"""Coalescing of concurrent loads of the same key.
+
+When a popular document drops out of the cache, every request thread that
+asks for it misses the cache at the same time and queries the database for
+it. SingleFlight lets only the first of those threads run the query. The
+others wait for its result, for at most timeout seconds, after which they
+run the query themselves.
+
+    >>> sf = SingleFlight()
+    >>> sf.do("/type/type", lambda: "json")
+    'json'
+    >>> sorted(sf.stats().items())
+    [('coalesced', 0), ('inflight', 0), ('loads', 1), ('timeouts', 0)]
+"""
+import logging
+import sys
+import threading
+
+logger = logging.getLogger("infobase.singleflight")
+
+class _Call:
+    """A load in progress."""
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+class SingleFlight:
+    """Runs at most one load for each key at a time.
+
+    The threads waiting for a load get the same result as the thread running
+    it, including the exception if it fails.
+    """
+    def __init__(self, timeout=5.0):
+        self.timeout = timeout
+        self.calls = {}
+        self._lock = threading.Lock()
+        self.counters = dict(loads=0, coalesced=0, timeouts=0)
+
+    def do(self, key, f, *args):
+        """Returns f(*args), sharing the result with the concurrent calls for the same key."""
+        with self._lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = _Call()
+                self.counters['loads'] += 1
+                leader = True
+            else:
+                self.counters['coalesced'] += 1
+                leader = False
+
+        if leader:
+            return self._run(key, call, f, args)
+
+        if not call.event.wait(self.timeout):
+            with self._lock:
+                self.counters['timeouts'] += 1
+            logger.warn("timed out waiting for the load of %r", key)
+            return f(*args)
+
+        if call.exc_info is not None:
+            raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+        return call.result
+
+    def _run(self, key, call, f, args):
+        try:
+            call.result = f(*args)
+            return call.result
+        except:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self.calls[key]
+            call.event.set()
+
+    def stats(self):
+        with self._lock:
+            d = dict(self.counters)
+            d['inflight'] = len(self.calls)
+        return d
@@ -16,7 +16,16 @@ is cleared on write failures.
 
 special_cache is an optional cache provided to cache most frequently accessed
 objects (like types and properties) and the application is responsible to keep
-it in sync.
+it in sync. Entries are never evicted from it. When special_cache_types is set
+in the config, each site pins all the documents of those types at startup and
+keeps them in sync using triggers.
+
+When the modifications made by other processes are missed, flush clears the
+special cache, the global cache and the other caches registered using
+add_flush_listener. The sites pin their documents again when that happens.
+Without the invalidation bus or pg_notify, the modifications made by other 
+processes are never announced, so the sites pin their documents again every 
+special_cache_ttl seconds.
 
 local_cache is a thread-local cache maintained to avoid repeated requests to
 global cache. This is stored at web.ctx.local_cache.
@@ -26,11 +35,31 @@ Typical examples of global_cache are LRU cache and memcached cache.
 
 Any elements added to the infobase cache during a request are cached locally until the end
 of that request and then they are added to the global cache.
+
+Old revisions of documents are cached separately in revision_cache, keyed by 
+(key, revision). A revision never changes once it is written, so this cache 
+needs no invalidation and it has its own capacity independent of global_cache. 
+As the keys are tuples, it must be an in-process cache like lru or sized_lru.
+
+parsed_cache is an optional cache of the documents parsed by common.parse_query, 
+keyed by (key, revision), to save decoding the JSON of hot documents on every 
+read. It keeps the JSON along with the parsed data, so that an entry of the 
+latest revision which is out of date is detected by comparing the JSON. The 
+parsed data is shared by all the readers and must not be modified. It must be 
+an in-process cache like lru or sharded_lru.
+
+The hits, misses, sets, evictions and bytes served of each layer are counted 
+per request in web.ctx.cache_stats and added to the totals of the process, 
+process_stats, at the end of the request.
 """
 
 import web
 import lru
+import shmcache
 import logging
+import threading
+import time
+import zlib
 
 logger = logging.getLogger("infobase.cache")
 
@@ -41,8 +70,17 @@ class NoneDict:
     def __setitem__(self, key, value):
         pass
         
+    def get_multi(self, keys):
+        return {}
+        
     def update(self, d):
         pass
+        
+    def delete_many(self, keys):
+        pass
+        
+    def clear(self):
+        pass
 
 class MemcachedDict:
     def __init__(self, memcache_client=None, servers=[]):
@@ -58,6 +96,12 @@ class MemcachedDict:
             raise KeyError, key
         return value
         
+    def get_multi(self, keys):
+        # memcache keys are bytestrings, map them back to the keys that are asked for.
+        d = dict((web.safestr(k), k) for k in keys)
+        result = self.memcache_client.get_multi(d.keys())
+        return dict((d[k], v) for k, v in result.items())
+        
     def __setitem__(self, key, value):
         key = web.safestr(key)
         logger.debug("MemcachedDict.set: %s", key)
@@ -68,27 +112,428 @@ class MemcachedDict:
         logger.debug("MemcachedDict.update: %s", d.keys())
         self.memcache_client.set_multi(d)
         
+    def delete_many(self, keys):
+        self.memcache_client.delete_multi([web.safestr(k) for k in keys])
+        
     def clear(self):
         self.memcache_client.flush_all()
 
+class NearMemcachedDict(MemcachedDict):
+    """MemcachedDict with a small in-process LRU, the near cache, in front of it.
+    
+    Reads are served from the near cache when possible and writes go to both.
+    Entries of the near cache expire after near_ttl seconds, which bounds how 
+    long a document modified by another process can be served from it. Keys 
+    invalidated through cache.invalidate are removed from both caches.
+    """
+    def __init__(self, memcache_client=None, servers=[], near_capacity=1000, near_ttl=10):
+        MemcachedDict.__init__(self, memcache_client, servers)
+        self.near = lru.ShardedLRU(near_capacity)
+        self.near_ttl = near_ttl
+        self.near_hits = 0
+        self.near_misses = 0
+        
+    def _get_near(self, key, now):
+        entry = self.near.get(key)
+        if entry is not None and entry[1] > now:
+            self.near_hits += 1
+            return entry[0]
+        self.near_misses += 1
+        return None
+        
+    def _set_near(self, d):
+        expires = time.time() + self.near_ttl
+        for k, v in d.items():
+            self.near[k] = (v, expires)
+        
+    def __getitem__(self, key):
+        value = self._get_near(key, time.time())
+        if value is None:
+            value = MemcachedDict.__getitem__(self, key)
+            self._set_near({key: value})
+        return value
+        
+    def get_multi(self, keys):
+        now = time.time()
+        result = {}
+        missing = []
+        for k in keys:
+            value = self._get_near(k, now)
+            if value is None:
+                missing.append(k)
+            else:
+                result[k] = value
+                
+        if missing:
+            d = MemcachedDict.get_multi(self, missing)
+            self._set_near(d)
+            result.update(d)
+        return result
+        
+    def __setitem__(self, key, value):
+        MemcachedDict.__setitem__(self, key, value)
+        self._set_near({key: value})
+        
+    def update(self, d):
+        MemcachedDict.update(self, d)
+        self._set_near(d)
+        
+    def delete_many(self, keys):
+        self.near.delete_many(keys)
+        MemcachedDict.delete_many(self, keys)
+        
+    def clear(self):
+        self.near.clear()
+        MemcachedDict.clear(self)
+        
+    def recent_keys(self, n):
+        return self.near.recent_keys(n)
+        
+    def stats(self):
+        d = self.near.stats()
+        d.update(near_hits=self.near_hits, near_misses=self.near_misses, near_ttl=self.near_ttl)
+        return d
+
+COMPRESSED = "\x01"
+
+class CompressedDict:
+    """Wrapper over a cache to store large values compressed with zlib.
+    
+    Values of at least threshold bytes are stored as a one-byte header 
+    followed by the compressed value. The header can't start a JSON 
+    document, so uncompressed values are stored as they are. Compressed 
+    values are returned as unicode, like the JSON read from the database.
+    
+        >>> d = CompressedDict({}, threshold=100)
+        >>> d['/a'] = '{"name": "%s"}' % ('x' * 1000)
+        >>> d.d['/a'][0] == COMPRESSED, len(d.d['/a']) < 100
+        (True, True)
+        >>> len(d['/a'])
+        1012
+        >>> d['/b'] = '{}'
+        >>> d.d['/b'], d['/b']
+        ('{}', '{}')
+    """
+    def __init__(self, d, threshold=4096, level=6):
+        self.d = d
+        self.threshold = threshold
+        self.level = level
+        self.counters = dict(compressed=0, bytes_in=0, bytes_out=0, compress_time=0.0, decompressed=0, decompress_time=0.0)
+        
+    def compress(self, value):
+        if len(value) < self.threshold:
+            return value
+        
+        t_start = time.time()
+        data = web.safestr(value)
+        z = zlib.compress(data, self.level)
+        self.counters['compress_time'] += time.time() - t_start
+        
+        if len(z) + 1 >= len(data):
+            return value
+        self.counters['compressed'] += 1
+        self.counters['bytes_in'] += len(data)
+        self.counters['bytes_out'] += len(z) + 1
+        return COMPRESSED + z
+        
+    def decompress(self, value):
+        if value[:1] != COMPRESSED:
+            return value
+        t_start = time.time()
+        value = zlib.decompress(value[1:]).decode('utf-8')
+        self.counters['decompressed'] += 1
+        self.counters['decompress_time'] += time.time() - t_start
+        return value
+        
+    def __getitem__(self, key):
+        return self.decompress(self.d[key])
+        
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+            
+    def get_multi(self, keys):
+        d = get_multi(self.d, keys)
+        return dict((k, self.decompress(v)) for k, v in d.items())
+        
+    def __setitem__(self, key, value):
+        self.d[key] = self.compress(value)
+        
+    def update(self, d):
+        self.d.update(dict((k, self.compress(v)) for k, v in d.items()))
+        
+    def __contains__(self, key):
+        return key in self.d
+        
+    def __len__(self):
+        return len(self.d)
+        
+    def __getattr__(self, name):
+        # delete_many, clear, keys etc. don't deal with values
+        return getattr(self.d, name)
+        
+    def stats(self):
+        d = hasattr(self.d, 'stats') and self.d.stats() or {}
+        d.update(self.counters)
+        d['compression_ratio'] = self.counters['bytes_out'] and float(self.counters['bytes_in']) / self.counters['bytes_out'] or 1.0
+        return d
+
 _cache_classes = {}
 def register_cache(type, klass):
     _cache_classes[type] = klass
     
 register_cache('lru', lru.LRU)
+register_cache('sharded_lru', lru.ShardedLRU)
+register_cache('sized_lru', lru.SizedLRU)
+register_cache('tinylfu', lru.TinyLFU)
+register_cache('shm', shmcache.SharedMemoryCache)
 register_cache('memcache', MemcachedDict)
+register_cache('near_memcache', NearMemcachedDict)
 
-def create_cache(type, **kw):
+def create_cache(type, compress_threshold=None, compress_level=6, **kw):
+    """Creates a cache of the given type. 
+    Values of at least compress_threshold bytes are compressed, when specified.
+    """
     klass = _cache_classes.get(type) or NoneDict
-    return klass(**kw)
+    d = klass(**kw)
+    if compress_threshold is not None:
+        d = CompressedDict(d, threshold=lru.parse_size(compress_threshold), level=compress_level)
+    return d
+    
+def get_multi(d, keys):
+    """Returns a dict with values of the given keys found in the cache d.
+    
+    Uses d.get_multi when available so that caches like memcached are queried 
+    only once for all the keys.
+    """
+    if hasattr(d, 'get_multi'):
+        return d.get_multi(keys)
+        
+    result = {}
+    for k in keys:
+        try:
+            result[k] = d[k]
+        except KeyError:
+            pass
+    return result
+
+class SpecialCache(dict):
+    """dict that counts the lookups made using get, to report the hit rate.
+    
+        >>> d = SpecialCache()
+        >>> d['/type/type'] = '{}'
+        >>> d.get('/type/type'), d.get('/type/foo')
+        ('{}', None)
+        >>> sorted(d.stats().items())
+        [('hit_rate', 0.5), ('hits', 1), ('misses', 1), ('size', 1)]
+        
+    When ttl is set, the functions registered with add_reload_listener are 
+    called to load the cache again on the first lookup after ttl seconds. They 
+    are called in a background thread, as the thread making the lookup could 
+    be in the middle of a transaction.
+    """
+    def __init__(self, *a, **kw):
+        dict.__init__(self, *a, **kw)
+        self.hits = 0
+        self.misses = 0
+        self.ttl = None
+        self.loaded_at = time.time()
+        self._reload_listeners = []
+        self._reload_lock = threading.Lock()
+        self._reload_thread = None
+        
+    def add_reload_listener(self, f):
+        self._reload_listeners.append(f)
+        
+    def remove_reload_listener(self, f):
+        try:
+            self._reload_listeners.remove(f)
+        except ValueError:
+            pass
+        
+    def reload(self):
+        """Calls the reload listeners, unless another thread is already doing it."""
+        # the lookups made while another thread is reloading use the current entries
+        if self._reload_lock.acquire(False):
+            self._reload()
+            
+    def _reload(self):
+        # called with _reload_lock acquired
+        try:
+            self.loaded_at = time.time()
+            for f in self._reload_listeners:
+                try:
+                    f()
+                except Exception:
+                    logger.error("failed to reload special cache using %s", f, exc_info=True)
+        finally:
+            self._reload_lock.release()
+            
+    def _check_reload(self):
+        if self.ttl is None or time.time() - self.loaded_at <= self.ttl:
+            return
+        if not self._reload_lock.acquire(False):
+            return
+        try:
+            t = threading.Thread(target=self._reload)
+            t.setDaemon(True)
+            t.start()
+        except:
+            self._reload_lock.release()
+            raise
+        self._reload_thread = t
+        
+    def get(self, key, default=None):
+        self._check_reload()
+        try:
+            value = self[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        else:
+            self.hits += 1
+            return value
+            
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = lookups and float(self.hits) / lookups or 0.0
+        return dict(hits=self.hits, misses=self.misses, hit_rate=hit_rate, size=len(self))
+
+LAYERS = ["new_objects", "special_cache", "local_cache", "global_cache", "revision_cache", "parsed_cache"]
+
+class CacheStats:
+    """Counters of each layer of the cache.
+    
+    A lookup counts as a miss in every layer it passes through and as a hit 
+    in the layer that has the key. bytes is the total size of the values 
+    served from a layer and evictions is the number of keys removed from it.
+    
+        >>> s = CacheStats()
+        >>> s.miss("local_cache")
+        >>> s.hit("global_cache", "{}")
+        >>> s.format()
+        'local_cache=0/1 global_cache=1/0'
+        >>> s.layers['global_cache']['bytes']
+        2
+        >>> s.hit("global_cache", u'"\\u20ac"')
+        >>> s.layers['global_cache']['bytes']
+        7
+    """
+    fields = ["hits", "misses", "sets", "evictions", "bytes"]
+    
+    def __init__(self):
+        self.layers = dict((layer, dict.fromkeys(self.fields, 0)) for layer in LAYERS)
+        
+    def hit(self, layer, value):
+        d = self.layers[layer]
+        d['hits'] += 1
+        d['bytes'] += lru.json_size(value)
+        
+    def miss(self, layer, count=1):
+        self.layers[layer]['misses'] += count
+        
+    def set(self, layer, count=1):
+        self.layers[layer]['sets'] += count
+        
+    def evict(self, layer, count=1):
+        self.layers[layer]['evictions'] += count
+        
+    def add(self, other):
+        """Adds the counters of other to this."""
+        for layer, d in other.layers.items():
+            mine = self.layers[layer]
+            for k, v in d.items():
+                mine[k] += v
+                
+    def as_dict(self):
+        return dict((layer, dict(d)) for layer, d in self.layers.items())
+        
+    def format(self):
+        """Returns hits/misses of the layers that were looked up, for the X-STATS header."""
+        layers = [(layer, self.layers[layer]) for layer in LAYERS]
+        return " ".join("%s=%d/%d" % (layer, d['hits'], d['misses']) for layer, d in layers if d['hits'] or d['misses'])
+
+# totals of all the requests served by this process
+process_stats = CacheStats()
+_process_stats_lock = threading.Lock()
 
-special_cache = {}
+def get_stats():
+    """Returns the cache counters of this process along with the stats of the cache implementations."""
+    with _process_stats_lock:
+        layers = process_stats.as_dict()
+        
+    d = dict(layers=layers, special_cache=special_cache.stats())
+    for name, c in [("global_cache", global_cache), ("revision_cache", revision_cache), ("parsed_cache", parsed_cache)]:
+        if hasattr(c, 'stats'):
+            d[name] = c.stats()
+            # evictions due to capacity are known only to the cache implementation.
+            layers[name]['evictions'] += d[name].get('evictions', 0)
+    return d
+
+special_cache = SpecialCache()
 global_cache = lru.LRU(200)
+revision_cache = lru.LRU(1000)
+parsed_cache = NoneDict()
+
+_invalidation_listeners = []
+def add_invalidation_listener(f):
+    """Registers a function to be called with the list of keys modified by other processes.
+    Used by other caches of documents to stay in sync with the global cache.
+    """
+    _invalidation_listeners.append(f)
+    
+def remove_invalidation_listener(f):
+    try:
+        _invalidation_listeners.remove(f)
+    except ValueError:
+        pass
+        
+def invalidate(keys):
+    """Removes the given keys from the global cache. 
+    Called when the documents are modified by other processes.
+    """
+    global_cache.delete_many(keys)
+    with _process_stats_lock:
+        process_stats.evict("global_cache", len(keys))
+    for f in _invalidation_listeners:
+        try:
+            f(keys)
+        except Exception:
+            logger.error("invalidation listener %s failed", f, exc_info=True)
+
+_flush_listeners = []
+def add_flush_listener(f):
+    """Registers a function to be called, without arguments, when the caches are flushed.
+    Used by other caches that hold data which can be modified by other processes.
+    """
+    _flush_listeners.append(f)
+    
+def remove_flush_listener(f):
+    try:
+        _flush_listeners.remove(f)
+    except ValueError:
+        pass
+    
+def flush():
+    """Clears the special cache, the global cache and the caches registered with add_flush_listener.
+    Called when some of the modifications made by other processes are not known, 
+    like when invalidation messages are lost.
+    """
+    special_cache.clear()
+    global_cache.clear()
+    for f in _flush_listeners:
+        try:
+            f()
+        except Exception:
+            logger.error("flush listener %s failed", f, exc_info=True)
 
 def loadhook():
     web.ctx.new_objects = {}
     web.ctx.local_cache = {}
     web.ctx.locally_added = {}
+    web.ctx.cache_stats = CacheStats()
     
 def unloadhook():
     """Called at the end of every request."""
@@ -96,20 +541,33 @@ def unloadhook():
     d.update(web.ctx.locally_added)
     d.update(web.ctx.new_objects)
 
+    stats = web.ctx.cache_stats
     if d:
         global_cache.update(d)
+        stats.set("global_cache", len(d))
+        
+    with _process_stats_lock:
+        process_stats.add(stats)
+    web.ctx.cache_stats = CacheStats()
     
 class Cache:
     def __getitem__(self, key):
         ctx = web.ctx
-        obj = ctx.new_objects.get(key) \
-            or special_cache.get(key)  \
-            or ctx.local_cache.get(key) \
+        stats = ctx.cache_stats
+        for layer, d in (("new_objects", ctx.new_objects), ("special_cache", special_cache), ("local_cache", ctx.local_cache)):
+            obj = d.get(key)
+            if obj:
+                stats.hit(layer, obj)
+                return obj
+            stats.miss(layer)
         
-        if not obj:    
+        try:
             obj = global_cache[key]
-            ctx.local_cache[key] = obj
-            
+        except KeyError:
+            stats.miss("global_cache")
+            raise
+        stats.hit("global_cache", obj)
+        ctx.local_cache[key] = obj
         return obj
         
     def get(self, key, default=None):
@@ -117,6 +575,37 @@ class Cache:
             return self[key]
         except:
             return default
+            
+    def get_multi(self, keys):
+        """Returns a dict with the cached values of the given keys. 
+        Keys not found in the cache are not included in the result.
+        
+        All the keys not found in the thread-local layers are looked up in 
+        the global cache with a single get_multi call.
+        """
+        ctx = web.ctx
+        stats = ctx.cache_stats
+        result = {}
+        missing = []
+        for key in keys:
+            for layer, d in (("new_objects", ctx.new_objects), ("special_cache", special_cache), ("local_cache", ctx.local_cache)):
+                obj = d.get(key)
+                if obj:
+                    stats.hit(layer, obj)
+                    result[key] = obj
+                    break
+                stats.miss(layer)
+            else:
+                missing.append(key)
+                
+        if missing:
+            d = get_multi(global_cache, missing)
+            for obj in d.itervalues():
+                stats.hit("global_cache", obj)
+            stats.miss("global_cache", len(missing) - len(d))
+            ctx.local_cache.update(d)
+            result.update(d)
+        return result
     
     def __contains__(self, key):
         """Tests whether an element is present in the cache.
@@ -142,6 +631,45 @@ class Cache:
     def __setitem__(self, key, value):
         web.ctx.local_cache[key] = value
         web.ctx.locally_added[key] = value
+        web.ctx.cache_stats.set("local_cache")
+        
+    def get_revision(self, key, revision):
+        """Returns the cached json of the given revision of a document or None if it is not cached."""
+        stats = web.ctx.cache_stats
+        try:
+            json = revision_cache[key, revision]
+        except KeyError:
+            stats.miss("revision_cache")
+            return None
+        stats.hit("revision_cache", json)
+        return json
+            
+    def set_revision(self, key, revision, json):
+        revision_cache[key, revision] = json
+        web.ctx.cache_stats.set("revision_cache")
+
+    def get_parsed(self, key, revision, json):
+        """Returns the parsed data of a document, if it was parsed from the given json, or None.
+        
+        Revision is None for the latest revision. Comparing the json detects 
+        the entries of the latest revision that are out of date.
+        """
+        stats = web.ctx.cache_stats
+        try:
+            cached_json, data = parsed_cache[key, revision]
+        except KeyError:
+            stats.miss("parsed_cache")
+            return None
+        if cached_json is not json and cached_json != json:
+            stats.miss("parsed_cache")
+            return None
+        stats.hit("parsed_cache", json)
+        return data
+        
+    def set_parsed(self, key, revision, json, data):
+        """Adds the parsed data of a document to the cache. The data must not be modified after this."""
+        parsed_cache[key, revision] = (json, data)
+        web.ctx.cache_stats.set("parsed_cache")
 
     def clear(self, local=False):
         """Clears the cache. 
@@ -152,3 +680,5 @@ class Cache:
         web.ctx.new_objects.clear()
         if not local:
             global_cache.clear()
+            revision_cache.clear()
+            parsed_cache.clear()
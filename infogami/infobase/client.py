@@ -272,7 +272,7 @@ class Site:
             }
             if p.expected_type:
                 q['type'] = p.expected_type.key
-            backreferences[p.name] = LazyObject(lambda q=q: self.get_many(self.things(q)))
+            backreferences[p.name] = LazyObject(lambda q=q: self.things_with_docs(q))
         return backreferences
 
     def exists(self):
@@ -337,6 +337,36 @@ class Site:
     def things(self, query, details=False):
         query = simplejson.dumps(query)
         return self._request('/things', 'GET', {'query': query, "details": str(details)})
+        
+    def things_with_docs(self, query):
+        """Returns the things matching the query, loaded along with the query in one request.
+        
+        When the query has a cursor, a storage object with the things as result 
+        and the cursor of the next page as cursor is returned.
+        """
+        query = simplejson.dumps(query)
+        result = self._request('/things', 'GET', {'query': query, 'include_docs': 'true'})
+        
+        if isinstance(result, dict):
+            return web.storage(result=self._make_things(result['result']), cursor=result['cursor'])
+        else:
+            return self._make_things(result)
+            
+    def _make_things(self, docs):
+        things = []
+        for data in docs:
+            data = web.storage(common.parse_query(data))
+            self._cache[data.key, None] = data
+            things.append(create_thing(self, data.key, self._process_dict(data)))
+        return things
+        
+    def things_count(self, query, estimate=False):
+        """Returns the number of things matching the query. 
+        When estimate is True, a fast estimate of the number is returned.
+        """
+        query = simplejson.dumps(query)
+        count = estimate and "estimate" or "true"
+        return self._request('/things', 'GET', {'query': query, "count": count})['count']
                 
     def versions(self, query):
         def process(v):
@@ -135,6 +135,9 @@ def create_test_store():
         def get(self, key, revision=None):
             return simplejson.dumps(self[key].format_data())
             
+        def get_thing(self, key, revision=None):
+            return Thing.from_json(self, key, self.get(key, revision))
+            
     store = Store()
     
     def add_primitive_type(key):
@@ -34,6 +34,41 @@ use_bot_column = True
 
 verify_user_email = False
 
+# keep a copy of the latest revision of every document in the latest_data table and read the
+# latest revisions from it, without joining thing and data. See migration/latest_data.sql for
+# populating the table in existing installations.
+use_latest_data = False
+
+# max time in seconds a request waits for another request loading the same document from the db.
+# Concurrent loads of the same document are not coalesced when this is set to 0.
+singleflight_timeout = 5.0
+
+# cache of the rows of the thing table, by key and by id. Disabled when None.
+# When the invalidation bus and pg_notify are not configured, the rows expire after ttl seconds, 60 by default.
+# example: {"capacity": 10000, "ttl": 60}
+metadata_cache = None
+
+# prepare the queries run for almost every request once per database connection, 
+# instead of having them parsed and planned on every run.
+prepared_statements = False
+
+# number of compiled things queries to keep, by the shape of the query. 
+# The SQL of every things query is built from scratch when this is 0.
+things_query_cache_size = 1000
+
+# plan the things queries with conditions on several properties using the estimated number of rows 
+# of each property. Disabled when None. 
+# example: {"in_threshold": 1000, "refresh_interval": 3600}
+query_planner = None
+
+# documents of these types are loaded into cache.special_cache when a site is initialized.
+# example: ["/type/type", "/type/permission", "/type/usergroup"]
+special_cache_types = None
+
+# seconds after which the documents of special_cache_types are loaded again, 
+# when the invalidation bus and pg_notify are not configured to announce the modifications of other processes.
+special_cache_ttl = 60
+
 def get(key, default=None):
     return globals().get(key, default)
 
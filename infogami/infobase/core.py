@@ -61,10 +61,16 @@ class Reference(unicode):
         return "<ref: %s>" % unicode.__repr__(self)
 
 class Thing:
-    def __init__(self, store, key, data):
+    """Document of infobase.
+    
+    When shared is True, data is also used by other Things, like the data from 
+    the parsed cache, and it is copied before the first modification.
+    """
+    def __init__(self, store, key, data, shared=False):
         self._store = store
         self.key = key
         self._data = data
+        self._shared = shared
 
     def _process(self, value):
         if isinstance(value, list):
@@ -72,8 +78,7 @@ class Thing:
         elif isinstance(value, dict):
             return web.storage((k, self._process(v)) for k, v in value.iteritems())
         elif isinstance(value, Reference):
-            json = self._store.get(value)
-            return Thing.from_json(self._store, unicode(value), json)
+            return self._store.get_thing(unicode(value))
         else:
             return value
 
@@ -84,6 +89,9 @@ class Thing:
         return self._process(self._data[key])
         
     def __setitem__(self, key, value):
+        if self._shared:
+            self._data = self._data.copy()
+            self._shared = False
         self._data[key] = value
 
     def __getattr__(self, key):
@@ -105,6 +113,9 @@ class Thing:
         return "<thing: %s>" % repr(self.key)
         
     def copy(self):
+        if self._shared:
+            # the nested values are shared too
+            return Thing(self._store, self.key, copy.deepcopy(self._data))
         return Thing(self._store, self.key, self._data.copy())
         
     def _get_data(self):
@@ -162,6 +173,19 @@ class SiteStore:
         
     def get_many(self, keys):
         return [self.get(key) for key in keys]
+        
+    def get_many_as_list(self, keys):
+        """Returns the json of the latest revision of each of the given keys as a JSON list."""
+        return "[" + ",\n".join(json for json in self.get_many(keys) if json) + "]"
+        
+    def get_thing(self, key, revision=None):
+        """Returns the document as Thing or None if it doesn't exist."""
+        json = self.get(key, revision)
+        return json and Thing.from_json(self, key, json)
+        
+    def get_many_by_type(self, types):
+        """Returns a dict with json of the latest revision of all the documents of the given types."""
+        return {}
     
     def write(self, query, timestamp=None, comment=None, machine_comment=None, ip=None, author=None):
         raise NotImplementedError
@@ -169,6 +193,16 @@ class SiteStore:
     def things(self, query):
         raise NotImplementedError
         
+    def things_count(self, query, estimate=False):
+        """Returns the number of things matching the query. 
+        The number is only estimated when estimate is True.
+        """
+        raise NotImplementedError
+        
+    def explain_things(self, query):
+        """Returns a dict describing how the things query would be run."""
+        raise NotImplementedError
+        
     def versions(self, query):
         raise NotImplementedError
         
@@ -202,6 +236,12 @@ class SiteStore:
         
     def set_cache(self, cache):
         pass
+        
+    def close(self):
+        """Releases the resources held by the store, like the listeners registered with the cache.
+        Called when the site is deleted.
+        """
+        pass
 
 class Event:
     """Infobase Event.
@@ -2,13 +2,22 @@
 """
 import common
 import config
+import cache
+import invalidation
+import lru
+import readquery
 import web
 import _json as simplejson
 import datetime, time
+import re
 from collections import defaultdict
 import logging
 
-from _dbstore import store, sequence
+from _dbstore import store, sequence, pool, prepared
+from _dbstore.querycache import QueryCache
+from _dbstore.planner import Planner, PropertyStats
+from _dbstore.notfound import NotFoundCache
+from _dbstore.singleflight import SingleFlight
 from _dbstore.schema import Schema, INDEXED_DATATYPES
 from _dbstore.indexer import Indexer
 from _dbstore.save import SaveImpl, PropertyManager
@@ -23,12 +32,58 @@ def process_json(key, json):
     """
     return json
 
+def after_commit(db, f):
+    """Calls f after the outermost transaction of db is committed.
+    
+    f is called immediately when there is no transaction and not at all when the transaction is rolled back.
+    """
+    transactions = db._ctx.get('transactions')
+    if not transactions:
+        return f()
+    
+    tx = transactions[0]
+    if 'after_commit' not in tx.__dict__:
+        tx.after_commit = []
+        commit = tx.commit
+        def commit_and_call():
+            committed = len(tx.ctx.transactions) > tx.transaction_count
+            commit()
+            if committed:
+                for g in tx.after_commit:
+                    g()
+        tx.commit = commit_and_call
+    tx.after_commit.append(f)
+
 class DBSiteStore(common.SiteStore):
     """
     """
+    # statements run for almost every request, prepared when config.prepared_statements is set.
+    statements = {
+        "thing_by_key": ("SELECT * FROM thing WHERE key=$1", ["text"]),
+        "data_by_revision": ("SELECT data.data FROM thing, data" + 
+            " WHERE thing.key=$1 AND data.thing_id=thing.id AND data.revision=$2", ["text", "int"]),
+        "latest_data": ("SELECT data.revision, data.data FROM thing, data" + 
+            " WHERE thing.key=$1 AND data.thing_id=thing.id AND data.revision=thing.latest_revision", ["text"]),
+        "latest_data_table": ("SELECT revision, data FROM latest_data WHERE key=$1", ["text"]),
+        "many_latest_data": ("SELECT thing.key, data.data from thing, data" + 
+            " WHERE data.revision = thing.latest_revision and data.thing_id=thing.id" + 
+            " AND thing.key = ANY($1)", ["text[]"]),
+        "many_latest_data_table": ("SELECT key, data FROM latest_data WHERE key = ANY($1)", ["text[]"]),
+    }
+    
     def __init__(self, db, schema):
         self.db = db
+        self.prepared = prepared.get_registry(db)
+        self.prepared.register_all(self.statements)
         self.schema = schema
+        self.query_cache = QueryCache(schema, config.get('things_query_cache_size', 1000))
+        
+        planner_params = config.get('query_planner')
+        if planner_params is not None:
+            self.property_stats = PropertyStats(db, planner_params.get('refresh_interval', 3600))
+            self.planner = Planner(schema, self.property_stats, planner_params.get('in_threshold', 1000))
+        else:
+            self.property_stats = self.planner = None
         self.sitename = None
         self.indexer = Indexer()
         self.store = store.Store(self.db)
@@ -36,6 +91,39 @@ class DBSiteStore(common.SiteStore):
         
         self.cache = None
         self.property_manager = PropertyManager(self.db)
+        
+        notfound_params = config.get('notfound_cache')
+        if notfound_params is not None:
+            # keys created by other processes are known only when they are announced
+            self.notfound_cache = NotFoundCache(self.db, shared=invalidation.is_enabled(), **notfound_params)
+            # keys modified by other processes could be newly created ones
+            cache.add_invalidation_listener(self.notfound_cache.add)
+            cache.add_flush_listener(self.notfound_cache.clear)
+        else:
+            self.notfound_cache = None
+            
+        timeout = config.get('singleflight_timeout')
+        self.singleflight = timeout and SingleFlight(timeout) or None
+        
+        metadata_params = config.get('metadata_cache')
+        if metadata_params is not None:
+            metadata_params = dict(metadata_params)
+            # without invalidation, the rows modified by other processes are refreshed only when they expire.
+            if not invalidation.is_enabled():
+                metadata_params.setdefault('ttl', 60)
+            self.metadata_cache = lru.MetadataCache(**metadata_params)
+            cache.add_invalidation_listener(self.metadata_cache.delete_keys)
+            cache.add_flush_listener(self.metadata_cache.clear)
+        else:
+            self.metadata_cache = None
+                
+    def close(self):
+        if self.notfound_cache is not None:
+            cache.remove_invalidation_listener(self.notfound_cache.add)
+            cache.remove_flush_listener(self.notfound_cache.clear)
+        if self.metadata_cache is not None:
+            cache.remove_invalidation_listener(self.metadata_cache.delete_keys)
+            cache.remove_flush_listener(self.metadata_cache.clear)
                 
     def get_store(self):
         return self.store
@@ -50,31 +138,120 @@ class DBSiteStore(common.SiteStore):
 
         if for_update:
             d = self.db.query('SELECT * FROM thing WHERE key=$key FOR UPDATE NOWAIT', vars=locals())
+            return d and d[0] or None
+            
+        notfound = self.notfound_cache
+        if notfound is None:
+            generation = None
+        elif notfound.is_missing(key):
+            return None
         else:
-            d = self.db.query('SELECT * FROM thing WHERE key=$key', vars=locals())
-        return d and d[0] or None
+            generation = notfound.generation
+
+        d = self._get_cached_metadata(key=key)
+        if d is not None:
+            return d
+
+        d = self._load(("metadata", key), self._get_metadata, key)
+        if d is None and notfound is not None:
+            notfound.add_missing(key, generation)
+        # the callers sharing the load get the same row, which they may modify
+        return d and web.storage(d)
+        
+    def _get_metadata(self, key):
+        # cached here and not by the caller, as the callers sharing this load 
+        # may have started after a write that this read doesn't see.
+        generation = self._metadata_generation()
+        d = self.prepared.query("thing_by_key", key)
+        d = d and d[0] or None
+        self._cache_metadata([d], generation)
+        return d
+        
+    def _use_metadata_cache(self):
+        # a transaction may have modified the things, so it must see the rows in the db.
+        return self.metadata_cache is not None and not self._in_transaction()
+        
+    def _get_cached_metadata(self, key=None, id=None):
+        """Returns a copy of the cached metadata of the thing with the given key or id."""
+        if not self._use_metadata_cache():
+            return None
+        elif key is not None:
+            d = self.metadata_cache.get_by_key(key)
+        else:
+            d = self.metadata_cache.get_by_id(id)
+        return d and web.storage(d)
+        
+    def _metadata_generation(self):
+        """Returns the generation of the metadata cache, to be passed to _cache_metadata along with the rows read after this."""
+        if self.metadata_cache is not None:
+            return self.metadata_cache.generation
+        
+    def _cache_metadata(self, rows, generation):
+        if self._use_metadata_cache():
+            for row in rows:
+                if row is not None:
+                    self.metadata_cache.add(web.storage(row), generation)
+        
+    def _load(self, name, f, *args):
+        """Returns f(*args). Concurrent loads with the same name are run only once.
+        
+        Loads made inside a transaction are not shared, as they can see uncommitted writes.
+        """
+        if self.singleflight is None or self._in_transaction():
+            return f(*args)
+        return self.singleflight.do(name, f, *args)
         
     def get_metadata_list(self, keys):
         if not keys:
             return {}
             
-        result = self.db.select('thing', what='*', where="key IN $keys", vars=locals()).list()
-        d = dict((r.key, r) for r in result)
+        d = {}
+        for key in keys:
+            row = self._get_cached_metadata(key=key)
+            if row is not None:
+                d[key] = row
+                
+        missing = [k for k in keys if k not in d]
+        if missing:
+            generation = self._metadata_generation()
+            result = self.db.select('thing', what='*', where="key IN $missing", vars=locals()).list()
+            self._cache_metadata(result, generation)
+            d.update((r.key, r) for r in result)
         return d
         
     def new_thing(self, **kw):
-        return self.db.insert('thing', **kw)
+        id = self.db.insert('thing', **kw)
+        if self.notfound_cache is not None:
+            self._after_commit(lambda: self.notfound_cache.add([kw['key']]))
+        return id
         
     def get_metadata_from_id(self, id):
+        d = self._get_cached_metadata(id=id)
+        if d is not None:
+            return d
+            
+        generation = self._metadata_generation()
         d = self.db.query('SELECT * FROM thing WHERE id=$id', vars=locals())
-        return d and d[0] or None
+        d = d and d[0] or None
+        self._cache_metadata([d], generation)
+        return d
 
     def get_metadata_list_from_ids(self, ids):
         if not ids:
             return {}
             
-        result = self.db.select('thing', what='*', where="id IN $ids", vars=locals()).list()
-        d = dict((r.id, r) for r in result)
+        d = {}
+        for id in ids:
+            row = self._get_cached_metadata(id=id)
+            if row is not None:
+                d[id] = row
+                
+        missing = [id for id in ids if id not in d]
+        if missing:
+            generation = self._metadata_generation()
+            result = self.db.select('thing', what='*', where="id IN $missing", vars=locals()).list()
+            self._cache_metadata(result, generation)
+            d.update((r.id, r) for r in result)
         return d
         
     def new_key(self, type, kw):
@@ -91,67 +268,196 @@ class DBSiteStore(common.SiteStore):
             return common.SiteStore.new_key(self, type, kw)
     
     def get(self, key, revision=None):
-        if self.cache is None or revision is not None:
+        if self.cache is None:
             json = self._get(key, revision)
+        elif revision is not None:
+            json = self._get_revision(key, revision)
         else:
             json = self.cache.get(key)
             if json is None:
-                json = self._get(key, revision)
+                json = self._load(("get", key), self._get, key, None)
                 if json:
                     self.cache[key] = json
         return process_json(key, json)
-    
-    def _get(self, key, revision):    
-        metadata = self.get_metadata(key)
-        if not metadata: 
+        
+    def get_thing(self, key, revision=None):
+        """Returns the document as common.Thing.
+        
+        The parsed data is shared with the other readers of the same revision 
+        through the parsed cache. Thing copies it before modifying.
+        """
+        if isinstance(key, common.Reference):
+            key = unicode(key)
+        json = self.get(key, revision)
+        if not json:
             return None
-        revision = revision or metadata.latest_revision
-        d = self.db.query('SELECT data FROM data WHERE thing_id=$metadata.id AND revision=$revision', vars=locals())
-        json = d and d[0].data or None
+        elif self.cache is None:
+            return common.Thing.from_json(self, key, json)
+            
+        data = self.cache.get_parsed(key, revision, json)
+        if data is None:
+            data = common.parse_query(simplejson.loads(json))
+            self.cache.set_parsed(key, revision, json, data)
+        return common.Thing(self, key, data, shared=True)
+        
+    def _get_revision(self, key, revision):
+        """Returns json of the given revision of a document.
+        
+        Revisions never change once written, so they are cached without any invalidation. 
+        Reads made inside a transaction are not cached as the transaction may be rolled back.
+        """
+        json = self.cache.get_revision(key, revision)
+        if json is None:
+            json = self._get(key, revision)
+            if json and not self._in_transaction():
+                self.cache.set_revision(key, revision, json)
         return json
         
+    def _in_transaction(self):
+        # db.ctx would take a connection from the pool just to look at the transactions.
+        return bool(self.db._ctx.get('transactions'))
+        
+    def _after_commit(self, f):
+        if self._in_transaction():
+            after_commit(self.db, f)
+        else:
+            f()
+    
+    def _get(self, key, revision):
+        if isinstance(key, common.Reference):
+            key = unicode(key)
+            
+        notfound = self.notfound_cache
+        if notfound is None:
+            generation = None
+        elif notfound.is_missing(key):
+            return None
+        else:
+            generation = notfound.generation
+            
+        # the metadata is not required to read the data, get it in one query.
+        if revision is not None:
+            d = self.prepared.query("data_by_revision", key, revision)
+            return d and d[0].data or None
+        elif config.get('use_latest_data'):
+            d = self.prepared.query("latest_data_table", key)
+        else:
+            d = self.prepared.query("latest_data", key)
+            
+        if not d:
+            if notfound is not None:
+                notfound.add_missing(key, generation)
+            return None
+        row = d[0]
+        
+        # the latest revision is also an immutable revision. Remember it for the history views.
+        if row.data and self.cache is not None and not self._in_transaction():
+            self.cache.set_revision(key, row.revision, row.data)
+        return row.data
+        
     def get_many_as_dict(self, keys):
+        """Returns a dict with json of the latest revision of each of the given keys.
+        
+        Keys found in the cache are not queried from the database and the ones 
+        queried from the database are added to the cache.
+        """
         if not keys:
             return {}
             
-        query = 'SELECT thing.key, data.data from thing, data' \
-            + ' WHERE data.revision = thing.latest_revision and data.thing_id=thing.id' \
-            + ' AND thing.key IN $keys'
+        if self.cache is None:
+            return self._get_many_as_dict(keys)
+            
+        keys = web.uniq(keys)
+        result = self.cache.get_multi(keys)
+        missing = [k for k in keys if k not in result]
+        if missing:
+            d = self._get_many_as_dict(missing)
+            for key, json in d.items():
+                self.cache[key] = json
+            result.update(d)
+        return result
+        
+    def _get_many_as_dict(self, keys):
+        name = config.get('use_latest_data') and "many_latest_data_table" or "many_latest_data"
+        rows = self.prepared.query(name, [web.safeunicode(k) for k in keys])
+        return dict((row.key, row.data) for row in rows)
+        
+    def get_many_by_type(self, types):
+        if not types:
+            return {}
             
+        query = 'SELECT thing.key, data.data FROM thing, thing AS type, data' \
+            + ' WHERE type.key IN $types AND thing.type = type.id' \
+            + ' AND data.thing_id = thing.id AND data.revision = thing.latest_revision'
         return dict((row.key, row.data) for row in self.db.query(query, vars=locals()))
         
     def get_many(self, keys):
         if not keys:
             return '{}'
-
-        xkeys = [web.reparam('$k', dict(k=k)) for k in keys]
-        query = 'SELECT thing.key, data.data from thing, data ' \
-            + 'WHERE data.revision = thing.latest_revision and data.thing_id=thing.id ' \
-            + ' AND thing.key IN (' + self.sqljoin(xkeys, ', ') + ')'
             
-        def process(query):
+        d = self.get_many_as_dict(keys)
+        
+        def process():
             yield '{\n'
-            for i, r in enumerate(self.db.query(query)):
+            for i, key in enumerate(k for k in web.uniq(keys) if k in d):
                 if i:
                     yield ',\n'
-                yield simplejson.dumps(r.key)
+                yield simplejson.dumps(key)
                 yield ": "
-                yield process_json(r.key, r.data)
+                yield process_json(key, d[key])
             yield '}'
-        return "".join(process(query))
+        return "".join(process())
+                    
+    def get_many_as_list(self, keys):
+        """Returns the json of the latest revision of each of the given keys as a JSON list,
+        in the order of the keys. The keys which are not found are skipped.
+        """
+        d = self.get_many_as_dict(keys)
+        
+        def process():
+            yield '['
+            for i, key in enumerate(k for k in web.uniq(keys) if k in d):
+                if i:
+                    yield ',\n'
+                yield process_json(key, d[key])
+            yield ']'
+        return "".join(process())
                     
     def save_many(self, docs, timestamp, comment, data, ip, author, action=None):
         docs = list(docs)
         action = action or "bulk_update"
         logger.debug("saving %d docs - %s", len(docs), dict(timestamp=timestamp, comment=comment, data=data, ip=ip, author=author, action=action))
 
-        s = SaveImpl(self.db, self.schema, self.indexer, self.property_manager)
+        s = SaveImpl(self.db, self.schema, self.indexer, self.property_manager, stats=self.property_stats)
         
         # Hack to allow processing of json before using. Required for OL legacy.
         s.process_json = process_json
         
         docs = common.format_data(docs)
-        changeset = s.save(docs, timestamp=timestamp, comment=comment, ip=ip, author=author, action=action, data=data)
+        if config.get('pg_notify') is None:
+            changeset = s.save(docs, timestamp=timestamp, comment=comment, ip=ip, author=author, action=action, data=data)
+        else:
+            # notify inside the same transaction, so that nothing is announced if the write is rolled back.
+            tx = self.db.transaction()
+            try:
+                changeset = s.save(docs, timestamp=timestamp, comment=comment, ip=ip, author=author, action=action, data=data)
+                invalidation.pg_notify(self.db, changeset.get('changes', []))
+            except:
+                tx.rollback()
+                raise
+            else:
+                tx.commit()
+        
+        if self.notfound_cache is not None:
+            created = [doc['key'] for doc in changeset.get('docs', []) if doc['revision'] == 1]
+            self._after_commit(lambda: self.notfound_cache.add(created))
+            
+        # type and latest_revision of the saved things have changed. 
+        # The rows are removed after the write is committed, and the rows read before that are not added back.
+        # When called in a transaction, the write is committed only with the outermost transaction.
+        if self.metadata_cache is not None:
+            keys = [c['key'] for c in changeset.get('changes', [])]
+            self._after_commit(lambda: self.metadata_cache.delete_keys(keys))
         
         # update cache. 
         # Use the docs from result as they contain the updated revision and last_modified fields.
@@ -166,7 +472,7 @@ class DBSiteStore(common.SiteStore):
         return self.save_many([doc], timestamp, comment, data, ip, author, action=action or "update")
         
     def reindex(self, keys):
-        s = SaveImpl(self.db, self.schema, self.indexer, self.property_manager)
+        s = SaveImpl(self.db, self.schema, self.indexer, self.property_manager, stats=self.property_stats)
         # Hack to allow processing of json before using. Required for OL legacy.
         s.process_json = process_json        
         return s.reindex(keys)
@@ -174,208 +480,88 @@ class DBSiteStore(common.SiteStore):
     def get_property_id(self, type, name):
         return self.property_manager.get_property_id(type, name)
 
-    def things(self, query):
+    def _plan_things(self, query, count=None):
+        """Plans and compiles the things query. See querycache.compile_query for count.
+        
+        Returns a storage object with the plan, the compiled query and the sql to run, 
+        or the reason why the query can't match anything as empty.
+        """
+        d = web.storage(plan=None, compiled=None, sql=None, empty=None)
         type = query.get_type()
-        if type:
-            type_metedata = self.get_metadata(type)
-            if type_metedata:
-                type_id = type_metedata.id
-            else:
-                # Return empty result when type not found
-                return []
-        else:
-            type_id = None
-        
-        # type is required if there are conditions/sort on keys other than [key, type, created, last_modified]
-        common_properties = ['key', 'type', 'created', 'last_modified'] 
-        _sort = query.sort and query.sort.key
-        if _sort and _sort.startswith('-'):
-            _sort = _sort[1:]
-        type_required = bool([c for c in query.conditions if c.key not in common_properties]) or (_sort and _sort not in common_properties)
-        
-        if type_required and type is None:
-            raise common.BadData("Type Required")
-        
-        class DBTable:
-            def __init__(self, name, label=None):
-                self.name = name
-                self.label = label or name
-                
-            def sql(self):
-                if self.label != self.name:
-                    return "%s as %s" % (self.name, self.label)
-                else:
-                    return self.name
-                    
-            def __repr__(self):
-                return self.label
-                
-        class Literal:
-            def __init__(self, value):
-                self.value = value
-                
-            def __repr__(self):
-                return self.value
-
-        tables = {}
-        
-        def get_table(datatype, key):
-            if key not in tables:
-                assert type is not None, "Missing type"            
-                table = self.schema.find_table(type, datatype, key)
-                label = 'd%d' % len(tables)
-                tables[key] = DBTable(table, label)
-            return tables[key]
-            
-        wheres = []
-        
-        def process(c, ordering_func=None):
-            # ordering_func is used when the query contains emebbabdle objects
-            #
-            # example: {'links': {'title: 'foo', 'url': 'http://example.com/foo'}}
-            if c.datatype == 'ref':
-                metadata = self.get_metadata(c.value)
-                if metadata is None:
-                    # required object is not found so the query result wil be empty. 
-                    # Raise StopIteration to indicate empty result.
-                    raise StopIteration
-                c.value = metadata.id
-            if c.op == '~':
-                op = Literal('LIKE')
-                c.value = c.value.replace('*', '%')
-            else:
-                op = Literal(c.op)
-                
-            if c.key in ['key', 'type', 'created', 'last_modified']:
-                #@@ special optimization to avoid join with thing.type when there are non-common properties in the query.
-                #@@ Since type information is already present in property table, 
-                #@@ getting property id is equivalent to join with type.
-                if c.key == 'type' and type_required:
-                    return
-                    
-                if isinstance(c.value, list):
-                    q = web.sqlors('thing.%s %s ' % (c.key, op), c.value)
-                else:
-                    q = web.reparam('thing.%s %s $c.value' % (c.key, op), locals())
-                xwheres = [q]
-                
-                # Add thing table explicitly because get_table is not called
-                tables['_thing'] = DBTable("thing")
-            else:
-                table = get_table(c.datatype, c.key)
-                key_id = self.get_property_id(type, c.key)
-                if not key_id:
-                    raise StopIteration
-                    
-                q1 = web.reparam('%(table)s.key_id=$key_id' % {'table': table}, locals())
-                
-                if isinstance(c.value, list):
-                    q2 = web.sqlors('%s.value %s ' % (table, op), c.value)
-                else:
-                    q2 = web.reparam('%s.value %s $c.value' % (table, op), locals())
-                
-                xwheres = [q1, q2]
-                if ordering_func:
-                    xwheres.append(ordering_func(table))
-            wheres.extend(xwheres)
-            
-        def make_ordering_func():
-            d = web.storage(table=None)
-            def f(table):
-                d.table = d.table or table
-                if d.table == table:
-                    # avoid a comparsion when both tables are same. it fails when ordering is None
-                    return "1 = 1"
-                else:
-                    return '%s.ordering = %s.ordering' % (table, d.table)
-            return f
-            
-        import readquery
-        def process_query(q, ordering_func=None):
-            for c in q.conditions:
-                if isinstance(c, readquery.Query):
-                    process_query(c, ordering_func or make_ordering_func())
-                else:
-                    process(c, ordering_func)
-                    
-        def process_sort(query):
-            """Process sort field in the query and returns the db column to order by."""
-            if query.sort:
-                sort_key = query.sort.key
-                if sort_key.startswith('-'):
-                    ascending = " desc"
-                    sort_key = sort_key[1:]
-                else:
-                    ascending = ""
-                    
-                if sort_key in ['key', 'type', 'created', 'last_modified']:
-                    order = 'thing.' + sort_key # make sure c.key is valid
-                    # Add thing table explicitly because get_table is not called
-                    tables['_thing'] = DBTable("thing")                
-                else:   
-                    table = get_table(query.sort.datatype, sort_key)
-                    key_id = self.get_property_id(type, sort_key)
-                    if key_id is None:
-                        raise StopIteration
-                    q = '%(table)s.key_id=$key_id' % {'table': table}
-                    wheres.append(web.reparam(q, locals()))
-                    order = table.label + '.value'
-                return order + ascending
-            else:
-                return None
+        if type and not self.get_metadata(type):
+            d.empty = "type %s not found" % type
+            return d
+        
+        d.plan = self.planner and self.planner.plan(self, query)
+        if d.plan and d.plan.empty:
+            d.empty = d.plan.empty
+            return d
         
+        d.compiled = self.query_cache.get(query, d.plan, count)
         try:
-            process_query(query)
-            # special care for case where query {}.
-            if not tables:
-                tables['_thing'] = DBTable('thing')
-            order = process_sort(query)
+            d.sql = d.compiled.bind(self, query)
         except StopIteration:
-            return []
-            
-        def add_joins():
-            labels = [t.label for t in tables.values()]
-            def get_column(table):
-                if table == 'thing': return 'thing.id'
-                else: return table + '.thing_id'
-                
-            if len(labels) > 1:
-                x = labels[0]
-                xwheres = [get_column(x) + ' = ' + get_column(y) for y in labels[1:]]
-                wheres.extend(xwheres)
-        
-        add_joins()
-        wheres = wheres or ['1 = 1']
-        table_names = [t.sql() for t in tables.values()]
-
+            # StopIteration is raised when a non-existing object or property is referred in the query
+            d.empty = "object or property in the query not found"
+        return d
+        
+    def explain_things(self, query):
+        """Returns the plan and the SQL of the things query, without running it."""
+        d = self._plan_things(query)
+        return {
+            "empty": d.empty,
+            "plan": d.plan and d.plan.dict(),
+            "sql": d.sql and str(d.sql)
+        }
+        
+    def _run_things_query(self, sql):
         t = self.db.transaction()
         if config.query_timeout:
-            self.db.query("SELECT set_config('statement_timeout', $query_timeout, false)", dict(query_timeout=config.query_timeout))
+            self.db.query("SELECT set_config('statement_timeout', $query_timeout, true)", dict(query_timeout=config.query_timeout))
+        result = self.db.query(sql).list()
+        t.commit()
+        return result
+        
+    def things_count(self, query, estimate=False):
+        """Returns the number of things matching the query, ignoring its limit and offset.
+        
+        When estimate is True, the number is estimated by the query planner when the query 
+        has conditions on several properties and by postgres otherwise.
+        """
+        d = self._plan_things(query, count=estimate and "estimate" or "exact")
+        if d.empty:
+            return 0
+        elif estimate and d.plan:
+            return d.plan.estimate()
             
-        if 'thing' in table_names:
-            result = self.db.select(
-                what='thing.key', 
-                tables=table_names, 
-                where=self.sqljoin(wheres, ' AND '), 
-                order=order,
-                limit=query.limit, 
-                offset=query.offset,
-                )
+        result = self._run_things_query(d.sql)
+        if estimate:
+            # the first line of the plan is like "Seq Scan on thing  (cost=0.00..1.10 rows=10 width=4)"
+            m = re.search(r"rows=(\d+)", result[0][d.compiled.column])
+            return m and int(m.group(1)) or 0
+        else:
+            return result[0].count
+        
+    def things(self, query):
+        d = self._plan_things(query)
+        if d.empty:
+            return []
+        
+        result = self._run_things_query(d.sql)
+        if d.compiled.column == 'key':
             keys = [r.key for r in result]
         else:
-            result = self.db.select(
-                what='d0.thing_id', 
-                tables=table_names, 
-                where=self.sqljoin(wheres, ' AND '), 
-                order=order,
-                limit=query.limit, 
-                offset=query.offset,
-            )
             ids = [r.thing_id for r in result]
             rows = ids and self.db.query('SELECT id, key FROM thing where id in $ids', vars={"ids": ids})
-            d = dict((r.id, r.key) for r in rows)
-            keys = [d[id] for id in ids]
-        t.commit()
+            keys = dict((r.id, r.key) for r in rows)
+            keys = [keys[id] for id in ids]
+        
+        if query.use_cursor:
+            if result and len(result) == query.limit:
+                last = result[-1]
+                query.next_cursor = readquery.encode_cursor(query.sort and query.sort.key, last.get('cursor_value'), last.cursor_id)
+            else:
+                query.next_cursor = None
         return keys
         
     def sqljoin(self, queries, delim):
@@ -460,7 +646,7 @@ class DBSiteStore(common.SiteStore):
         
         t = self.db.transaction()
         if config.query_timeout:
-            self.db.query("SELECT set_config('statement_timeout', $query_timeout, false)", dict(query_timeout=config.query_timeout))
+            self.db.query("SELECT set_config('statement_timeout', $query_timeout, true)", dict(query_timeout=config.query_timeout))
                 
         result = self.db.select(['thing','version', 'transaction'], what=what, where=where, offset=query.offset, limit=query.limit, order=sort)
         result = result.list()
@@ -535,6 +721,8 @@ class DBSiteStore(common.SiteStore):
             self.db.update('thing', type=id, where='id=$id', vars=locals())
             self.db.insert('version', False, thing_id=id, revision=1)
             self.db.insert('data', False, thing_id=id, revision=1, data=simplejson.dumps(data))
+            if config.get('use_latest_data'):
+                self.db.insert('latest_data', False, thing_id=id, key='/type/type', revision=1, data=simplejson.dumps(data))
             t.commit()
             
     def initialized(self):
@@ -542,6 +730,8 @@ class DBSiteStore(common.SiteStore):
         
     def delete(self):
         t = self.db.transaction()
+        if config.get('use_latest_data'):
+            self.db.delete('latest_data', where='1=1')
         self.db.delete('data', where='1=1')
         self.db.delete('version', where='1=1')
         self.db.delete('transaction', where='1=1')
@@ -554,6 +744,8 @@ class DBSiteStore(common.SiteStore):
         self.db.delete('thing', where='1=1')
         t.commit()
         self.cache.clear()
+        if self.metadata_cache is not None:
+            self.metadata_cache.clear()
 
 class DBStore(common.Store):
     """StoreFactory that works with single site. 
@@ -584,6 +776,7 @@ class DBStore(common.Store):
         if self.sitestore is None:
             sitestore = DBSiteStore(self.db, self.schema)
             if not self.has_initialized():
+                sitestore.close()
                 return None
             self.sitestore = sitestore
             
@@ -595,7 +788,11 @@ class DBStore(common.Store):
         if not self.has_initialized():
             return
         d = self.get(sitename)
-        d and d.delete()
+        if d:
+            d.delete()
+            # the caches of the deleted site must not be kept in sync anymore
+            d.close()
+            self.sitestore = None
             
 class MultiDBStore(DBStore):
     """DBStore that works with multiple sites.
@@ -670,6 +867,13 @@ class MultiDBSiteStore(DBSiteStore):
 def create_database(**params):
     db = web.database(**params)
     
+    pool_params = config.get('db_pool')
+    if pool_params:
+        pool.attach(db, **pool_params)
+        
+    if config.get('prepared_statements'):
+        prepared.attach(db)
+    
     # monkey-patch query method to collect stats
     _query = db.query
     def query(*a, **kw):
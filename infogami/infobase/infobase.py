@@ -10,6 +10,7 @@ import simplejson
 
 import common
 import config
+import invalidation
 import readquery
 import writequery
 
@@ -49,7 +50,7 @@ class Infobase:
     def delete(self, sitename):
         """Deletes the site with the given name."""
         if sitename in self.sites:
-            del self.sites[sitename]
+            self.sites.pop(sitename).close()
         return self.store.delete(sitename)
         
     def add_event_listener(self, listener):
@@ -84,6 +85,47 @@ class Site:
         store.store.set_listener(self._log_store_action)
         store.seq.set_listener(self._log_store_action)
         
+        self._special_cache_types = config.get('special_cache_types') or []
+        self._special_cache_keys = set()
+        if self._special_cache_types:
+            self._load_special_cache()
+            self.add_trigger(None, self._update_special_cache)
+            cache.add_invalidation_listener(self._refresh_special_cache)
+            cache.add_flush_listener(self._load_special_cache)
+            cache.special_cache.add_reload_listener(self._load_special_cache)
+            if not invalidation.is_enabled():
+                # permissions and usergroups modified by other processes must not be used forever
+                cache.special_cache.ttl = config.get('special_cache_ttl', 60)
+        
+    def close(self):
+        """Removes the listeners registered with the cache."""
+        cache.remove_invalidation_listener(self._refresh_special_cache)
+        cache.remove_flush_listener(self._load_special_cache)
+        cache.special_cache.remove_reload_listener(self._load_special_cache)
+        
+    def _load_special_cache(self):
+        """Pins all the documents of special_cache_types in the special_cache."""
+        d = self.store.get_many_by_type(self._special_cache_types)
+        for key in self._special_cache_keys.difference(d):
+            cache.special_cache.pop(key, None)
+        cache.special_cache.update(d)
+        self._special_cache_keys = set(d)
+        
+    def _update_special_cache(self, site, old, new):
+        key = new['key']
+        if new['type']['key'] in self._special_cache_types:
+            cache.special_cache[key] = simplejson.dumps(new)
+            self._special_cache_keys.add(key)
+        elif key in self._special_cache_keys:
+            # type changed to something that is not pinned
+            cache.special_cache.pop(key, None)
+            self._special_cache_keys.discard(key)
+            
+    def _refresh_special_cache(self, keys):
+        """Reloads the pinned documents when any of them is modified by another process."""
+        if any(k in self._special_cache_keys for k in keys):
+            self._load_special_cache()
+        
     def _log_store_action(self, name, data):
         event = web.storage(name=name, ip=web.ctx.ip, author=None, data=data, sitename=self.sitename, timestamp=None)
         self._infobase.fire_event(event)
@@ -106,8 +148,7 @@ class Site:
     withKey = get
     
     def _get_thing(self, key, revision=None):
-        json = self.get(key, revision)
-        return json and common.Thing.from_json(self.store, key, json)
+        return self.store.get_thing(key, revision)
         
     def _get_many_things(self, keys):
         json = self.get_many(keys)
@@ -196,6 +237,15 @@ class Site:
     def things(self, query):
         return readquery.run_things_query(self.store, query)
         
+    def things_with_docs(self, query):
+        return readquery.run_things_docs_query(self.store, query)
+        
+    def things_count(self, query, estimate=False):
+        return self.store.things_count(readquery.make_query(self.store, query), estimate)
+        
+    def explain_things(self, query):
+        return self.store.explain_things(readquery.make_query(self.store, query))
+        
     def versions(self, query):
         try:
             q = readquery.make_versions_query(self.store, query)
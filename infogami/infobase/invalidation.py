@@ -0,0 +1,421 @@
+"""Cache invalidation across infobase processes.
+
+Each infobase process has its own global_cache. When a document is modified
+in one process, the other processes keep serving the stale copy till it is
+evicted. The invalidation bus broadcasts the keys modified in each write to
+the peer processes, which remove those keys from their caches.
+
+Each message is a JSON object with the following keys.
+
+    sender:    id of the process which sent the message, hostname:pid
+    seq:       sequence number of the message, starting from 1 for each sender
+    timestamp: time of sending the message, in seconds since epoch
+    keys:      list of keys to invalidate
+
+The receivers track the last sequence number seen from each sender. A gap in
+the sequence means that some messages were lost and the receiver flushes all
+the caches as it can't know which keys were modified.
+
+Transports are pluggable and selected using the invalidation section of the
+config. The udp transport uses multicast and is suitable for processes on a
+single host or a LAN. The http transport POSTs the messages to the /_invalidate
+endpoint of each peer.
+
+    invalidation:
+        transport: http
+        peers:
+            - localhost:7001
+            - localhost:7002
+
+Alternatively, the writes can be announced by postgres itself. When the
+pg_notify section of the config is set, DBSiteStore.save_many sends a NOTIFY
+with the modified keys inside the write transaction and every process runs a
+PGNotifyListener, which LISTENs on the channel and evicts the keys. Postgres
+delivers the notifications only on commit, so nothing is announced for the
+writes that are rolled back.
+
+    pg_notify:
+        channel: infobase_invalidate
+"""
+import logging
+import os
+import select
+import socket
+import struct
+import threading
+import time
+import Queue
+import urllib2
+
+import web
+
+import _json as simplejson
+import cache
+import config
+
+logger = logging.getLogger("infobase.invalidation")
+
+def is_enabled():
+    """Returns True if the modifications made by other processes are announced, 
+    by the invalidation bus or by pg_notify.
+    """
+    return bool(config.get('invalidation')) or config.get('pg_notify') is not None
+
+def get_process_id():
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+class InvalidationBus:
+    """Publishes modified keys to the peers and evicts the keys modified by the peers.
+    """
+    # maximum number of keys in a message, to keep udp datagrams small.
+    batch_size = 200
+
+    def __init__(self, transport, sender=None, flush_on_gap=True):
+        self.transport = transport
+        self.sender = sender or get_process_id()
+        self.flush_on_gap = flush_on_gap
+
+        self.seq = 0
+        self.peers = {}
+        self.lock = threading.Lock()
+
+        transport.start(self)
+
+    def on_event(self, event):
+        """Infobase event listener to publish the keys modified in every write."""
+        changeset = event.data.get('changeset') if isinstance(event.data, dict) else None
+        if changeset:
+            self.publish([c['key'] for c in changeset.get('changes', [])])
+
+    def publish(self, keys):
+        keys = list(keys)
+        for i in range(0, len(keys), self.batch_size):
+            with self.lock:
+                self.seq += 1
+                seq = self.seq
+            msg = dict(sender=self.sender, seq=seq, timestamp=time.time(), keys=keys[i:i+self.batch_size])
+            try:
+                self.transport.send(simplejson.dumps(msg))
+            except Exception:
+                logger.error("failed to publish invalidation message", exc_info=True)
+
+    def receive(self, json):
+        """Processes the given message. Returns the number of keys evicted."""
+        msg = simplejson.loads(json)
+        sender, seq = msg['sender'], msg['seq']
+
+        # multicast messages are received by the sender as well
+        if sender == self.sender:
+            return 0
+
+        with self.lock:
+            peer = self.peers.get(sender)
+            if peer is None:
+                peer = self.peers[sender] = dict(last_seq=seq-1, messages=0, keys=0, missed=0, lag=0.0, last_timestamp=None)
+            gap = seq - peer['last_seq'] - 1
+            if gap > 0:
+                peer['missed'] += gap
+            peer['last_seq'] = max(seq, peer['last_seq'])
+            peer['messages'] += 1
+            peer['keys'] += len(msg['keys'])
+            peer['last_timestamp'] = msg['timestamp']
+            peer['lag'] = max(0.0, time.time() - msg['timestamp'])
+
+        if gap > 0 and self.flush_on_gap:
+            logger.warn("missed %d invalidation messages from %s, clearing the caches", gap, sender)
+            cache.flush()
+
+        cache.invalidate(msg['keys'])
+        return len(msg['keys'])
+
+    def stats(self):
+        """Returns the status of this process and how far behind each peer is."""
+        with self.lock:
+            peers = dict((name, dict(p)) for name, p in self.peers.items())
+        return dict(sender=self.sender, seq=self.seq, peers=peers, transport=self.transport.stats())
+
+class Transport:
+    """Base class for the transports."""
+    def start(self, bus):
+        """Starts receiving messages. Each message received must be passed to bus.receive."""
+        pass
+
+    def send(self, message):
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+class UDPTransport(Transport):
+    """Transport using UDP multicast."""
+    def __init__(self, group="239.255.59.64", port=5965, ttl=1, interface="0.0.0.0"):
+        self.group = group
+        self.port = port
+        self.ttl = ttl
+        self.interface = interface
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+
+    def start(self, bus):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(("", self.port))
+        mreq = struct.pack("4s4s", socket.inet_aton(self.group), socket.inet_aton(self.interface))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+
+        def run():
+            while True:
+                data, addr = sock.recvfrom(65536)
+                try:
+                    bus.receive(data)
+                except Exception:
+                    logger.error("failed to process invalidation message from %s", addr, exc_info=True)
+
+        t = threading.Thread(target=run)
+        t.setDaemon(True)
+        t.start()
+
+    def send(self, message):
+        self.sock.sendto(message, (self.group, self.port))
+
+class HTTPTransport(Transport):
+    """Transport that POSTs the messages to /_invalidate endpoint of each peer.
+
+    Messages are sent from a background thread per peer, so that writes are
+    not blocked by slow peers. Messages to a peer which can't be reached are
+    dropped after logging the error and the peer flushes its cache when it
+    notices the gap in sequence numbers.
+    """
+    def __init__(self, peers, timeout=5.0, maxsize=10000):
+        self.peers = [Peer(url, timeout, maxsize) for url in peers]
+
+    def start(self, bus):
+        for p in self.peers:
+            p.start()
+
+    def send(self, message):
+        for p in self.peers:
+            p.put(message)
+
+    def stats(self):
+        return dict((p.url, p.stats()) for p in self.peers)
+
+class Peer:
+    """Peer of the HTTPTransport."""
+    def __init__(self, url, timeout, maxsize):
+        if "://" not in url:
+            url = "http://" + url
+        self.url = url.rstrip("/") + "/_invalidate"
+        self.timeout = timeout
+        self.queue = Queue.Queue(maxsize)
+        self.sent = 0
+        self.errors = 0
+        self.dropped = 0
+
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.setDaemon(True)
+        t.start()
+
+    def put(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except Queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            message = self.queue.get()
+            try:
+                req = urllib2.Request(self.url, message, {"Content-Type": "application/json"})
+                urllib2.urlopen(req, timeout=self.timeout).read()
+                self.sent += 1
+            except Exception:
+                self.errors += 1
+                logger.error("failed to send invalidation message to %s", self.url, exc_info=True)
+
+    def stats(self):
+        return dict(pending=self.queue.qsize(), sent=self.sent, errors=self.errors, dropped=self.dropped)
+
+_transports = {}
+def register_transport(type, klass):
+    _transports[type] = klass
+
+register_transport("udp", UDPTransport)
+register_transport("http", HTTPTransport)
+
+# The bus of this process. None when invalidation is not configured.
+bus = None
+
+def create_bus(transport, flush_on_gap=True, **kw):
+    """Creates invalidation bus from the invalidation config."""
+    klass = _transports[transport]
+    return InvalidationBus(klass(**kw), flush_on_gap=flush_on_gap)
+
+# max size of a NOTIFY payload is 8000 bytes.
+MAX_PAYLOAD_SIZE = 7900
+
+def encode_notifications(sender, changes, max_size=MAX_PAYLOAD_SIZE):
+    """Encodes the changes as a list of NOTIFY payloads, each shorter than max_size.
+
+        >>> encode_notifications("a", [{"key": "/a", "revision": 2}])
+        ['{"sender": "a", "changes": [["/a", 2]]}']
+        >>> len(encode_notifications("a", [{"key": "/" + "x" * 10, "revision": 1}] * 10, max_size=100))
+        4
+    """
+    prefix = '{"sender": %s, "changes": [' % simplejson.dumps(sender)
+    payloads = []
+    chunk = []
+    size = len(prefix) + 2
+    for c in changes:
+        item = simplejson.dumps([c['key'], c['revision']])
+        if chunk and size + len(item) + 2 > max_size:
+            payloads.append(prefix + ", ".join(chunk) + "]}")
+            chunk = []
+            size = len(prefix) + 2
+        chunk.append(item)
+        size += len(item) + 2
+    if chunk:
+        payloads.append(prefix + ", ".join(chunk) + "]}")
+    return payloads
+
+def pg_notify(db, changes):
+    """Sends the changes as notifications on the pg_notify channel.
+    Must be called inside the write transaction.
+    """
+    channel = (config.get('pg_notify') or {}).get('channel') or PGNotifyListener.channel
+    for payload in encode_notifications(get_process_id(), changes):
+        db.query("SELECT pg_notify($channel, $payload)", vars=locals())
+
+class PGNotifyListener:
+    """Evicts the keys announced on a postgres NOTIFY channel from the caches.
+
+    Notifications arriving within batch_interval of each other are evicted
+    together. The notifications sent while the listener is disconnected are
+    lost, so the caches are cleared when it reconnects.
+    """
+    channel = "infobase_invalidate"
+
+    def __init__(self, db_parameters=None, channel=None, batch_interval=0.05, retry_interval=5.0):
+        self.db_parameters = db_parameters
+        self.channel = channel or self.channel
+        self.batch_interval = batch_interval
+        self.retry_interval = retry_interval
+        self.sender = get_process_id()
+
+        self.connected = False
+        self.notifications = 0
+        self.keys = 0
+        self.batches = 0
+        self.reconnects = 0
+        self.flushes = 0
+        self.last_timestamp = None
+
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.setDaemon(True)
+        t.start()
+
+    def connect_args(self):
+        """Returns the arguments to psycopg2.connect for connecting to the database of infobase."""
+        params = self.db_parameters or web.config.db_parameters
+        kw = dict(database=params['db'], user=params.get('user'), password=params.get('pw') or None)
+        for name in ['host', 'port']:
+            if params.get(name):
+                kw[name] = params[name]
+        return kw
+
+    def connect(self):
+        import psycopg2
+        import psycopg2.extensions
+
+        conn = psycopg2.connect(**self.connect_args())
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        conn.cursor().execute('LISTEN "%s"' % self.channel.replace('"', '""'))
+        return conn
+
+    def run(self):
+        first = True
+        while True:
+            try:
+                conn = self.connect()
+            except Exception:
+                logger.error("failed to connect to the database to listen for invalidations", exc_info=True)
+                time.sleep(self.retry_interval)
+                continue
+
+            if not first:
+                self.reconnects += 1
+                self.flush()
+            first = False
+            self.connected = True
+
+            try:
+                self.listen(conn)
+            except Exception:
+                logger.error("lost the connection listening for invalidations", exc_info=True)
+            self.connected = False
+            try:
+                conn.close()
+            except Exception:
+                pass
+            time.sleep(self.retry_interval)
+
+    def listen(self, conn):
+        while True:
+            # wait for the first notification and then give the others in the same burst a chance to arrive.
+            if select.select([conn], [], [], 60) == ([], [], []):
+                continue
+            conn.poll()
+            time.sleep(self.batch_interval)
+            conn.poll()
+
+            payloads = [n.payload for n in conn.notifies]
+            del conn.notifies[:]
+            if payloads:
+                self.process(payloads)
+
+    def process(self, payloads):
+        """Evicts the keys in the given payloads from the caches. Returns the number of keys evicted."""
+        keys = set()
+        for payload in payloads:
+            msg = simplejson.loads(payload)
+            self.notifications += 1
+            # the process making the write has updated its own cache
+            if msg['sender'] != self.sender:
+                keys.update(key for key, revision in msg['changes'])
+
+        self.last_timestamp = time.time()
+        if not keys:
+            return 0
+
+        keys = list(keys)
+        self.batches += 1
+        self.keys += len(keys)
+        for k in keys:
+            cache.special_cache.pop(k, None)
+        cache.invalidate(keys)
+        return len(keys)
+
+    def flush(self):
+        logger.warn("reconnected to listen for invalidations, clearing the caches")
+        self.flushes += 1
+        cache.flush()
+
+    def stats(self):
+        return dict(channel=self.channel, connected=self.connected, notifications=self.notifications,
+            keys=self.keys, batches=self.batches, reconnects=self.reconnects, flushes=self.flushes,
+            last_timestamp=self.last_timestamp)
+
+# The pg_notify listener of this process. None when pg_notify is not configured.
+listener = None
+
+def create_listener(**kw):
+    """Creates and starts the listener from the pg_notify config."""
+    l = PGNotifyListener(**kw)
+    l.start()
+    return l
@@ -1,5 +1,9 @@
 """Infobase cache.
 """
+import itertools
+import threading
+import time
+from collections import OrderedDict
                     
 class Node(object):
     """Queue Node."""
@@ -168,6 +172,11 @@ class LRU:
         except KeyError:
             return default
 
+    @synchronized
+    def get_multi(self, keys):
+        """Returns a dict with values of the given keys that are found in the cache."""
+        return dict((k, self[k]) for k in keys if k in self.d)
+
     @synchronized
     def __setitem__(self, key, value):
         self.getnode(key).value = value
@@ -205,6 +214,16 @@ class LRU:
     @synchronized
     def items(self):
         return [(k, node.value) for k, node in self.d.items()]
+        
+    @synchronized
+    def recent_keys(self, n):
+        """Returns the n most recently used keys, the most recent first."""
+        keys = []
+        node = self.queue.head.prev
+        while node is not self.queue.head and len(keys) < n:
+            keys.append(node.key)
+            node = node.prev
+        return keys
     
     @synchronized    
     def clear(self):
@@ -222,6 +241,420 @@ class LRU:
         return str(self.queue)
     __repr__ = __str__
     
+_missing = object()
+
+class _Shard:
+    """One partition of a ShardedLRU.
+    
+    Keys are kept in an OrderedDict in the order of their last access, 
+    so the least recently used key is always the first one. Each entry is 
+    stored as a (value, size) pair and the shard evicts entries till the 
+    total size fits in the capacity. The size of every entry is 1 when 
+    sizeof is not specified.
+    """
+    def __init__(self, capacity, sizeof=None):
+        self.capacity = capacity
+        self.sizeof = sizeof
+        self.d = OrderedDict()
+        self.lock = threading.Lock()
+        self.size = 0
+        self.evictions = 0
+        
+    def get(self, key, default=None):
+        d = self.d
+        with self.lock:
+            try:
+                entry = d.pop(key)
+            except KeyError:
+                return default
+            d[key] = entry
+            return entry[0]
+            
+    def set(self, key, value):
+        size = self.sizeof and self.sizeof(value) or 1
+        d = self.d
+        with self.lock:
+            self._remove(key)
+            # an entry larger than the whole shard would evict everything and still not fit.
+            if size > self.capacity:
+                return
+            d[key] = (value, size)
+            self.size += size
+            while self.size > self.capacity:
+                k, (v, vsize) = d.popitem(last=False)
+                self.size -= vsize
+                self.evictions += 1
+                
+    def _remove(self, key):
+        entry = self.d.pop(key, None)
+        if entry is None:
+            return False
+        self.size -= entry[1]
+        return True
+                
+    def delete(self, key):
+        with self.lock:
+            return self._remove(key)
+            
+    def clear(self):
+        with self.lock:
+            self.d.clear()
+            self.size = 0
+            
+    def items(self):
+        with self.lock:
+            return [(k, entry[0]) for k, entry in self.d.iteritems()]
+            
+    def recent_keys(self, n):
+        with self.lock:
+            return list(itertools.islice(reversed(self.d), n))
+
+class ShardedLRU:
+    """LRU cache that partitions keys across independently locked shards.
+    
+    LRU serializes every access, including plain lookups, on a single lock. 
+    ShardedLRU gives each shard its own lock and recency order, so threads 
+    working on different keys rarely wait for each other. The capacity is 
+    split evenly among the shards and eviction happens per shard.
+    
+        >>> d = ShardedLRU(3, shards=1)
+        >>> d[1], d[2], d[3] = 1, 2, 3
+        >>> d[1], d[2], d[3]
+        (1, 2, 3)
+        >>> d[2] and d
+        [1, 3, 2]
+        >>> d[4] = 4
+        >>> d
+        [3, 2, 4]
+        >>> del d[2]
+        >>> d, len(d), 2 in d
+        ([3, 4], 2, False)
+    """
+    shard_class = _Shard
+    
+    def __init__(self, capacity, shards=16, sizeof=None):
+        shards = max(1, min(shards, capacity))
+        self.capacity = capacity
+        
+        # distribute the remainder among the first few shards
+        size, extra = divmod(capacity, shards)
+        self.shards = [self.shard_class(size + (i < extra), sizeof) for i in range(shards)]
+        
+    def _shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+        
+    def __contains__(self, key):
+        return key in self._shard(key).d
+        
+    def __getitem__(self, key):
+        value = self._shard(key).get(key, _missing)
+        if value is _missing:
+            raise KeyError, key
+        return value
+        
+    def get(self, key, default=None):
+        return self._shard(key).get(key, default)
+        
+    def get_multi(self, keys):
+        """Returns a dict with values of the given keys that are found in the cache."""
+        result = {}
+        for k in keys:
+            value = self._shard(k).get(k, _missing)
+            if value is not _missing:
+                result[k] = value
+        return result
+        
+    def __setitem__(self, key, value):
+        self._shard(key).set(key, value)
+        
+    def __delitem__(self, key):
+        if not self._shard(key).delete(key):
+            raise KeyError, key
+            
+    def delete(self, key):
+        self._shard(key).delete(key)
+        
+    def delete_many(self, keys):
+        for k in keys:
+            self._shard(k).delete(k)
+            
+    def update(self, d):
+        for k, v in d.items():
+            self._shard(k).set(k, v)
+            
+    def __len__(self):
+        return sum(len(s.d) for s in self.shards)
+        
+    def keys(self):
+        return [k for k, v in self.items()]
+        
+    def items(self):
+        return [item for s in self.shards for item in s.items()]
+        
+    def clear(self):
+        for s in self.shards:
+            s.clear()
+            
+    def recent_keys(self, n):
+        """Returns about n most recently used keys, taking the same number of keys from each shard."""
+        per_shard = -(-n // len(self.shards))
+        keys = [s.recent_keys(per_shard) for s in self.shards]
+        # interleave, so that the most recent keys of every shard come first
+        return [k for ks in itertools.izip_longest(*keys) for k in ks if k is not None][:n]
+            
+    def stats(self):
+        return dict(
+            count=len(self), 
+            capacity=self.capacity, 
+            shards=len(self.shards), 
+            evictions=sum(s.evictions for s in self.shards))
+        
+    def __str__(self):
+        return str(self.keys())
+    __repr__ = __str__
+    
+def json_size(value):
+    """Returns the size of the given JSON string in bytes.
+    
+        >>> json_size('{"key": "/a"}')
+        13
+        >>> json_size(u'"\\u20ac"')
+        5
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return len(value)
+    
+def parse_size(size):
+    """Parses size specified as number of bytes or with K, M or G suffix.
+    
+        >>> parse_size(1024), parse_size("64K"), parse_size("1.5M"), parse_size("2G")
+        (1024, 65536, 1572864, 2147483648)
+    """
+    if isinstance(size, basestring):
+        units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+        size = size.strip().upper().rstrip("B")
+        if size and size[-1] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+    
+class SizedLRU(ShardedLRU):
+    """ShardedLRU with capacity specified in bytes instead of number of entries.
+    
+    The size of each entry is the length of the stored JSON string in bytes. 
+    Least recently used entries are evicted till the total size fits in the 
+    capacity and entries larger than the capacity of a shard are not cached.
+    
+        >>> d = SizedLRU("100", shards=1)
+        >>> d['a'], d['b'] = 'x' * 40, 'y' * 40
+        >>> d['c'] = 'z' * 30
+        >>> d
+        ['b', 'c']
+        >>> d['big'] = 'x' * 200
+        >>> d
+        ['b', 'c']
+        >>> sorted(d.stats().items())
+        [('bytes', 70), ('capacity', 100), ('count', 2), ('evictions', 1), ('shards', 1)]
+    """
+    def __init__(self, capacity, shards=16):
+        ShardedLRU.__init__(self, parse_size(capacity), shards, sizeof=json_size)
+        
+    def stats(self):
+        d = ShardedLRU.stats(self)
+        d['bytes'] = sum(s.size for s in self.shards)
+        return d
+    
+class FrequencySketch:
+    """Count-min sketch estimating how often each key was accessed recently.
+    
+    Counters saturate at 15 and all the counters are halved after every 
+    10 * width increments, so that the keys which were popular long ago 
+    are forgotten.
+    
+        >>> f = FrequencySketch(16)
+        >>> for i in range(3): f.increment("/a")
+        >>> f.frequency("/a"), f.frequency("/b")
+        (3, 0)
+    """
+    def __init__(self, capacity):
+        # more counters than the entries in the cache, to keep the collisions low.
+        width = 16
+        while width < 4 * capacity:
+            width *= 2
+        self.mask = width - 1
+        self.table = [bytearray(width) for seed in self.seeds]
+        self.sample_size = 10 * width
+        self.additions = 0
+        
+    # odd multipliers, one for each row
+    seeds = [0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93]
+    
+    def _indexes(self, key):
+        # the high bits of the product depend on all the bits of the hash. 
+        # The low bits can't be used as the keys of a shard share the low bits used to pick the shard.
+        h = hash(key)
+        return [((h * seed) & 0xFFFFFFFFFFFFFFFF) >> 32 & self.mask for seed in self.seeds]
+        
+    def frequency(self, key):
+        return min(row[i] for row, i in zip(self.table, self._indexes(key)))
+        
+    def increment(self, key):
+        for row, i in zip(self.table, self._indexes(key)):
+            if row[i] < 15:
+                row[i] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.reset()
+            
+    def reset(self):
+        self.table = [bytearray(c >> 1 for c in row) for row in self.table]
+        self.additions /= 2
+        
+    def clear(self):
+        self.table = [bytearray(len(row)) for row in self.table]
+        self.additions = 0
+
+class _TinyLFUShard:
+    """One partition of TinyLFU.
+    
+    New entries go to a small LRU window. An entry pushed out of the window 
+    is admitted to the main cache only if it was accessed more often than 
+    the entry the main cache would evict for it. The main cache is a 
+    segmented LRU: entries hit in the probation segment move to the 
+    protected segment, and the least recently used entries of the protected 
+    segment move back to probation when it is full.
+    """
+    def __init__(self, capacity, sizeof=None):
+        self.capacity = capacity
+        self.window_capacity = max(1, capacity // 100)
+        self.protected_capacity = (capacity - self.window_capacity) * 4 // 5
+        
+        # values of all the entries. The segments only keep the order of keys.
+        self.d = {}
+        self.window = OrderedDict()
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        self.sketch = FrequencySketch(capacity)
+        
+        self.lock = threading.Lock()
+        self.size = 0
+        self.evictions = 0
+        self.rejections = 0
+        
+    def get(self, key, default=None):
+        with self.lock:
+            self.sketch.increment(key)
+            if key not in self.d:
+                return default
+                
+            if key in self.window:
+                del self.window[key]
+                self.window[key] = None
+            elif key in self.probation:
+                del self.probation[key]
+                self.protected[key] = None
+                if len(self.protected) > self.protected_capacity:
+                    k, _ = self.protected.popitem(last=False)
+                    self.probation[k] = None
+            else:
+                del self.protected[key]
+                self.protected[key] = None
+            return self.d[key]
+            
+    def set(self, key, value):
+        with self.lock:
+            if key in self.d:
+                self.d[key] = value
+                return
+                
+            self.d[key] = value
+            self.window[key] = None
+            if len(self.window) > self.window_capacity:
+                candidate, _ = self.window.popitem(last=False)
+                self._admit(candidate)
+            self.size = len(self.d)
+            
+    def _admit(self, candidate):
+        """Moves the candidate from the window to the main cache, or drops it."""
+        if len(self.probation) + len(self.protected) < self.capacity - self.window_capacity:
+            self.probation[candidate] = None
+            return
+            
+        victims = self.probation or self.protected
+        # shards of capacity 1 have only the window and no main cache to evict from
+        victim = next(iter(victims), _missing)
+        if victim is _missing:
+            del self.d[candidate]
+        elif self.sketch.frequency(candidate) > self.sketch.frequency(victim):
+            del victims[victim]
+            del self.d[victim]
+            self.probation[candidate] = None
+        else:
+            del self.d[candidate]
+            self.rejections += 1
+        self.evictions += 1
+        
+    def _remove(self, key):
+        if self.d.pop(key, _missing) is _missing:
+            return False
+        for segment in (self.window, self.probation, self.protected):
+            if segment.pop(key, _missing) is not _missing:
+                break
+        self.size = len(self.d)
+        return True
+                
+    def delete(self, key):
+        with self.lock:
+            return self._remove(key)
+            
+    def clear(self):
+        with self.lock:
+            self.d.clear()
+            self.window.clear()
+            self.probation.clear()
+            self.protected.clear()
+            self.sketch.clear()
+            self.size = 0
+            
+    def items(self):
+        with self.lock:
+            keys = list(self.window) + list(self.probation) + list(self.protected)
+            return [(k, self.d[k]) for k in keys]
+            
+    def recent_keys(self, n):
+        # the protected segment has the entries accessed more than once
+        with self.lock:
+            keys = itertools.chain(reversed(self.protected), reversed(self.probation), reversed(self.window))
+            return list(itertools.islice(keys, n))
+    
+class TinyLFU(ShardedLRU):
+    """ShardedLRU with an admission policy that keeps the cache from being flushed by scans.
+    
+    A plain LRU admits every new entry, so a bulk read of many documents that 
+    are never read again evicts the frequently accessed ones. TinyLFU keeps an 
+    approximate access count of each key, including the keys that are not in 
+    the cache, and a new entry replaces an old one only if it is accessed 
+    more often.
+    
+        >>> d = TinyLFU(10, shards=1)
+        >>> def read(k):
+        ...     if d.get(k) is None: d[k] = k
+        >>> for i in range(5):
+        ...     for k in range(8): read(k)
+        >>> for k in range(100, 200): read(k)
+        >>> sorted(k for k in d.keys() if k < 100)
+        [0, 1, 2, 3, 4, 5, 6, 7]
+    """
+    shard_class = _TinyLFUShard
+    
+    def __init__(self, capacity, shards=16):
+        ShardedLRU.__init__(self, capacity, shards)
+        
+    def stats(self):
+        d = ShardedLRU.stats(self)
+        d['rejections'] = sum(s.rejections for s in self.shards)
+        return d
+    
 def lrumemoize(n):
     def decorator(f):
         cache = LRU(n)
@@ -279,6 +712,105 @@ class ThingCache(LRU):
         LRU.clear(self)
         self.key2id.clear()
 
+class MetadataCache(LRU):
+    """LRU cache of the rows of the thing table, which can be looked up by id or by key.
+    
+        >>> from web import storage
+        >>> d = MetadataCache(2)
+        >>> d.add(storage(id=1, key="/a", latest_revision=1))
+        >>> d.add(storage(id=2, key="/b", latest_revision=3))
+        >>> d.get_by_key("/b").id, d.get_by_id(1).key
+        (2, '/a')
+        >>> d.add(storage(id=3, key="/c", latest_revision=1))
+        >>> d.get_by_key("/b") is None, sorted(d.key2id)
+        (True, ['/a', '/c'])
+        >>> d.delete_keys(["/a"])
+        >>> d.get_by_id(1) is None
+        True
+        
+    A row read from the db before a write to it is committed must not be added 
+    after the write has removed it from the cache. So the rows are added along 
+    with the generation taken before reading them, and are ignored if any rows 
+    were removed since then.
+    
+        >>> generation = d.generation
+        >>> d.delete_keys(["/c"])
+        >>> d.add(storage(id=3, key="/c", latest_revision=1), generation)
+        >>> d.get_by_key("/c") is None
+        True
+        
+    When ttl is given, the rows expire after ttl seconds.
+    """
+    def __init__(self, capacity, ttl=None):
+        LRU.__init__(self, capacity)
+        self.ttl = ttl
+        self.key2id = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # incremented whenever rows are removed.
+        self.generation = 0
+        
+    @synchronized
+    def get_by_id(self, id):
+        entry = LRU.get(self, id)
+        if entry is not None and entry[1] is not None and time.time() > entry[1]:
+            self.delete(id)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+        
+    @synchronized
+    def get_by_key(self, key):
+        id = self.key2id.get(key)
+        if id is None:
+            self.misses += 1
+            return None
+        return self.get_by_id(id)
+        
+    @synchronized
+    def add(self, row, generation=None):
+        """Adds the row. generation must be the value of self.generation taken before reading the row from the db."""
+        if generation is not None and generation != self.generation:
+            return
+        # key2id must be updated before adding, as adding may evict the row which has the same key.
+        self.key2id[row.key] = row.id
+        self[row.id] = (row, self.ttl and time.time() + self.ttl)
+        
+    @synchronized
+    def delete_keys(self, keys):
+        # the rows being read now may be older than the ones being removed
+        self.generation += 1
+        for key in keys:
+            id = self.key2id.get(key)
+            if id is not None:
+                self.delete(id)
+    
+    @synchronized
+    def remove_node(self, node=None):
+        evicted = node is None
+        node = LRU.remove_node(self, node)
+        if evicted:
+            self.evictions += 1
+        # the key may have been taken by another id
+        row = node.value and node.value[0]
+        if row is not None and self.key2id.get(row.key) == row.id:
+            del self.key2id[row.key]
+        return node
+        
+    @synchronized
+    def clear(self):
+        self.generation += 1
+        LRU.clear(self)
+        self.key2id.clear()
+        
+    @synchronized
+    def stats(self):
+        return dict(count=len(self.d), capacity=self.capacity, hits=self.hits, misses=self.misses, evictions=self.evictions)
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
@@ -2,15 +2,45 @@ import common
 from common import all, any
 import web
 import re
+import base64
 import _json as simplejson
 
 def get_thing(store, key, revision=None):
-    json = key and store.get(key, revision)
-    return json and common.Thing.from_json(store, key, json)
+    return key and store.get_thing(key, revision)
 
 def run_things_query(store, query):
+    """Runs the things query and returns the matching documents.
+
+    When the query has a cursor, a dict with the documents as result and the
+    cursor of the next page as cursor is returned. The cursor is None on the
+    last page.
+    """
     query = make_query(store, query)
     keys = store.things(query)
+    
+    if query.use_cursor:
+        return {"result": _run_things_query(store, query, keys), "cursor": query.next_cursor}
+    else:
+        return _run_things_query(store, query, keys)
+
+def run_things_docs_query(store, query):
+    """Runs the things query and returns the latest revisions of the matching 
+    documents as a JSON list. 
+    
+    The documents are taken from the cache when possible and the rest are
+    loaded together in one query. When the query has a cursor, a JSON object with 
+    the documents as result and the cursor of the next page as cursor is returned.
+    """
+    query = make_query(store, query)
+    keys = store.things(query)
+    docs = store.get_many_as_list(keys)
+    
+    if query.use_cursor:
+        return '{"result": %s, "cursor": %s}' % (docs, simplejson.dumps(query.next_cursor))
+    else:
+        return docs
+
+def _run_things_query(store, query, keys):
         
     xthings = {}
     def load_things(keys, query):
@@ -84,6 +114,9 @@ class Query:
         self.sort = None
         self.limit = None
         self.offset = None
+        self.use_cursor = False
+        self.cursor = None
+        self.next_cursor = None
         self.prefix = None
         self.requested = {"key": None}
         
@@ -121,10 +154,21 @@ def make_query(store, query, prefix=""):
         <query: ['life = int:42', 'type = ref:/type/page', 'title ~ str:foo']>
         >>> make_query(store, {'type': '/type/page', 'title~': 'foo', 'a:life<': 42, "b:life>": 420})        
         <query: ['life < int:42', 'type = ref:/type/page', 'title ~ str:foo', 'life > int:420']>
+
+    Pages can be fetched either with offset or with the cursor returned
+    with the previous page. An empty cursor asks for the first page.
+
+        >>> q = make_query(store, {'type': '/type/page', 'cursor': ''})
+        >>> q.use_cursor, q.cursor
+        (True, None)
+        >>> q = make_query(store, {'type': '/type/page', 'cursor': encode_cursor(None, None, 42)})
+        >>> q.cursor
+        <Storage {'sort': None, 'id': 42, 'value': None}>
     """
     query = common.parse_query(query)
     q = Query()
     q.prefix = prefix
+    cursor = query.pop('cursor', False)
     q.offset = common.safeint(query.pop('offset', None), 0)
     q.limit = common.safeint(query.pop('limit', 20), 20)
     if q.limit > 1000:
@@ -167,8 +211,54 @@ def make_query(store, query, prefix=""):
         q.sort = web.storage(key=sort, datatype=find_datatype(type, sort, None))
     else:
         q.sort = None
+
+    if cursor is not False and not nested:
+        if q.offset:
+            raise common.BadData(message="offset can't be used with cursor")
+        q.use_cursor = True
+        if cursor:
+            q.cursor = decode_cursor(cursor)
+            if q.cursor.sort != (q.sort and q.sort.key):
+                raise common.BadData(message="cursor doesn't match the sort order of the query")
             
     return q
+
+def encode_cursor(sort, value, id):
+    """Returns an opaque token for the position after the thing with the given id 
+    and value of the sort key.
+    
+        >>> c = decode_cursor(encode_cursor("title", u"foo", 42))
+        >>> c.sort == u"title", c.value == u"foo", c.id
+        (True, True, 42)
+        >>> type(c.sort), type(c.value)
+        (<type 'unicode'>, <type 'unicode'>)
+        >>> import datetime
+        >>> decode_cursor(encode_cursor("-created", datetime.datetime(2009, 1, 2, 3, 4, 5), 42)).value
+        datetime.datetime(2009, 1, 2, 3, 4, 5)
+    """
+    return base64.urlsafe_b64encode(simplejson.dumps([sort, common.format_data(value), id]))
+
+def decode_cursor(token):
+    """Decodes the token returned by encode_cursor. Raises BadData if the token is not valid.
+
+        >>> try:
+        ...     decode_cursor("foo")
+        ... except common.BadData, e:
+        ...     print e.dict()['message']
+        invalid cursor
+    """
+    try:
+        sort, value, id = simplejson.loads(base64.urlsafe_b64decode(str(token)))
+        id = int(id)
+    except Exception:
+        raise common.BadData(message="invalid cursor")
+    
+    # simplejson returns str for ascii strings when using the C speedups
+    def to_unicode(s):
+        if isinstance(s, str):
+            return s.decode('utf-8')
+        return s
+    return web.storage(sort=to_unicode(sort), value=to_unicode(common.parse_data(value, level=None)), id=id)
     
 def find_datatype(type, key, value):
     """
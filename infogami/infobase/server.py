@@ -14,7 +14,9 @@ import logging
 from infobase import config
 import common
 import cache
+import invalidation
 import logreader
+import warmup
 
 from account import get_user_root
 
@@ -44,7 +46,9 @@ urls = (
     "/([^/]*)/_seq/(.*)", "seq",
     "/([^/]*)/_recentchanges", "recentchanges",
     "/([^/]*)/_recentchanges/(\d+)", "change",
-    "/_invalidate", "invalidate"
+    "/_invalidate", "invalidate",
+    "/_stats/cache", "cache_stats",
+    "/_stats/db", "db_stats",
 )
 
 app = web.application(urls, globals(), autoreload=False)
@@ -105,9 +109,15 @@ def jsonify(f):
         totaltime = t_end - t_start
         querytime = web.ctx.pop('querytime', 0.0)
         queries = web.ctx.pop('queries', 0)
+        poolwait = web.ctx.pop('poolwait', None)
         
         if config.get("enabled_stats"):
-            web.header("X-STATS", "tt: %0.3f, tq: %0.3f, nq: %d" % (totaltime, querytime, queries))
+            stats = "tt: %0.3f, tq: %0.3f, nq: %d" % (totaltime, querytime, queries)
+            if poolwait is not None:
+                stats += ", pw: %0.3f" % poolwait
+            if 'cache_stats' in web.ctx:
+                stats += ", cache: " + web.ctx.cache_stats.format()
+            web.header("X-STATS", stats)
 
         if web.ctx.get('infobase_localmode'):
             return result
@@ -160,6 +170,8 @@ def get_site(sitename):
         schema = dbstore.default_schema or dbstore.Schema()
         store = dbstore.DBStore(schema)
         _infobase = infobase.Infobase(store, config.secret_key)
+        if invalidation.bus:
+            _infobase.add_event_listener(invalidation.bus.on_event)
     return _infobase.get(sitename)
     
 class server:
@@ -271,11 +283,24 @@ class things:
     @jsonify
     def GET(self, sitename):
         site = get_site(sitename)
-        i = input('query', details="false")
+        i = input('query', details="false", explain="false", count="false", include_docs="false")
         q = from_json(i.query)
+        if i.explain.lower() == "true":
+            return site.explain_things(q)
+        elif i.include_docs.lower() == "true":
+            return JSON(site.things_with_docs(q))
+        elif i.count.lower() in ["true", "estimate"]:
+            estimate = i.count.lower() == "estimate"
+            return {"count": site.things_count(q, estimate), "estimated": estimate}
+        
         result = site.things(q)
         
-        if i.details.lower() == "false":
+        if isinstance(result, dict):
+            # paginated with a cursor
+            if i.details.lower() == "false":
+                result['result'] = [r['key'] for r in result['result']]
+            return result
+        elif i.details.lower() == "false":
             return [r['key'] for r in result]
         else:
             return result
@@ -513,6 +538,65 @@ class account:
         a = site.get_account_manager()
         return a.update(username, **i)
 
+class invalidate:
+    """Endpoint to receive cache invalidation messages from the peers.
+    GET returns the status of the invalidation bus.
+    """
+    def check_permission(self):
+        if web.ctx.ip not in config.trusted_machines:
+            raise common.PermissionDenied(message="Permission denied to invalidate cache from " + web.ctx.ip)
+
+    def get_bus(self):
+        self.check_permission()
+        if invalidation.bus is None:
+            raise common.NotFound(error="notfound", message="Cache invalidation is not enabled")
+        return invalidation.bus
+        
+    @jsonify
+    def GET(self):
+        self.check_permission()
+        if invalidation.bus is None and invalidation.listener is None:
+            raise common.NotFound(error="notfound", message="Cache invalidation is not enabled")
+            
+        d = invalidation.bus and invalidation.bus.stats() or {}
+        if invalidation.listener:
+            d['pg_notify'] = invalidation.listener.stats()
+        return d
+        
+    @jsonify
+    def POST(self):
+        count = self.get_bus().receive(get_data())
+        return {"ok": True, "count": count}
+
+class cache_stats:
+    """Hits, misses, sets, evictions and bytes of each cache layer, for all the requests served by this process."""
+    @jsonify
+    def GET(self):
+        d = cache.get_stats()
+        sitestore = _infobase and getattr(_infobase.store, 'sitestore', None)
+        if getattr(sitestore, 'metadata_cache', None) is not None:
+            d['metadata_cache'] = sitestore.metadata_cache.stats()
+        if warmup.snapshotter:
+            d['snapshot'] = warmup.snapshotter.stats()
+        return d
+
+class db_stats:
+    """Stats of the database connection pool, the prepared statements and the things queries of this process."""
+    @jsonify
+    def GET(self):
+        db = _infobase and getattr(_infobase.store, 'db', None)
+        pool = db and getattr(db, 'pool', None)
+        statements = db and getattr(db, 'statements', None)
+        sitestore = _infobase and getattr(_infobase.store, 'sitestore', None)
+        query_cache = getattr(sitestore, 'query_cache', None)
+        property_stats = getattr(sitestore, 'property_stats', None)
+        return {
+            "pool": pool and pool.stats(),
+            "statements": statements and statements.stats(),
+            "things_queries": query_cache and query_cache.stats(),
+            "planner": property_stats and property_stats.stats()
+        }
+
 class readlog:
     def get_log(self, offset, i):
         log = logreader.LogFile(config.writelog)
@@ -628,8 +712,9 @@ def parse_db_parameters(d):
         user = os.getenv("USER")
      
     result = dict(dbn=dbn, db=db, user=user, pw=pw)
-    if 'host' in d:
-        result['host'] = d['host']
+    for name in ['host', 'port']:
+        if name in d:
+            result[name] = d[name]
     return result
     
 def start(config_file, *args):
@@ -659,7 +744,30 @@ def load_config(config_file):
     cache_params = config.get('cache', {'type': 'none'})
     cache.global_cache = cache.create_cache(**cache_params)
     
+    invalidation_params = config.get('invalidation')
+    if invalidation_params:
+        invalidation.bus = invalidation.create_bus(**invalidation_params)
+        
+    pg_notify_params = config.get('pg_notify')
+    if pg_notify_params is not None:
+        invalidation.listener = invalidation.create_listener(**pg_notify_params)
+    
+    revision_cache_params = config.get('revision_cache')
+    if revision_cache_params:
+        cache.revision_cache = cache.create_cache(**revision_cache_params)
+        
+    parsed_cache_params = config.get('parsed_cache')
+    if parsed_cache_params:
+        cache.parsed_cache = cache.create_cache(**parsed_cache_params)
+    
     # init plugins
     for p in plugins:
         m = getattr(p, 'init_plugin', None)
-        m and m()
\ No newline at end of file
+        m and m()
+        
+    # preload the cache from the snapshot of the previous run
+    snapshot_params = config.get('cache_snapshot')
+    if snapshot_params:
+        snapshot_params = dict(snapshot_params)
+        site = get_site(snapshot_params.pop('sitename'))
+        warmup.start(site, **snapshot_params)
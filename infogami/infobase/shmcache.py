@@ -0,0 +1,361 @@
+"""Cache of JSON documents shared by all the infobase processes on a host.
+
+Each infobase process has its own global_cache, so every worker keeps a copy
+of the hot documents and warms up separately. SharedMemoryCache keeps the
+documents in a file mapped into the memory of all the processes using it.
+Putting the file on tmpfs, like /dev/shm, keeps it off the disk.
+
+The file has a header, a hash index and an arena of fixed size slots.
+
+    header:  geometry of the file, clock hand and counters
+    index:   open addressing hash table of slot numbers. -1 marks an empty
+             bucket and -2 a bucket whose slot was removed.
+    slots:   each slot holds the hash, key and value of one entry and a
+             referenced bit, which is set on every read.
+
+Keys and values are stored UTF-8 encoded. Values stored as unicode, like the
+JSON read from the database, are marked with the text flag and decoded when
+read, so that they can be joined with the other documents. Values stored as
+byte strings, like the ones compressed by CompressedDict, are returned as
+they are.
+
+When there are no free slots, a slot is evicted using the clock algorithm.
+The hand sweeps over the slots, clearing the referenced bits, and evicts
+the first slot that was not read since the previous sweep. Values that
+don't fit in a slot are not cached.
+
+Access is serialized by an flock on the file, shared for reads and
+exclusive for writes, and by a thread lock within the process. As flock
+locks are shared by the processes that inherit the file descriptor, the file
+is opened again after fork.
+
+    >>> import tempfile
+    >>> d = SharedMemoryCache(tempfile.mktemp(), capacity="64K", slot_size="1K")
+    >>> d["/type/type"] = '{"key": "/type/type"}'
+    >>> d["/type/type"]
+    '{"key": "/type/type"}'
+    >>> d["/type/page"] = u'{"key": "/type/page"}'
+    >>> d["/type/page"]
+    u'{"key": "/type/page"}'
+    >>> d.get("/type/foo") is None, len(d)
+    (True, 2)
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+import web
+from lru import parse_size
+
+MAGIC = "IBSHM002"
+
+# magic, nslots, slot_size, nbuckets, hand, used, tombstones, next_free, evictions
+HEADER = struct.Struct("<8sIIIIIIIQ")
+HEADER_SIZE = 64
+
+# hash, key length, value length, flags
+SLOT_HEADER = struct.Struct("<QHIB")
+SLOT_HEADER_SIZE = 16
+
+BUCKET = struct.Struct("<i")
+EMPTY, REMOVED = -1, -2
+
+IN_USE, REFERENCED, TEXT = 1, 2, 4
+
+def locked(op):
+    """Decorator to run the method holding the thread lock and the flock of the given type."""
+    def decorator(f):
+        def g(self, *a):
+            with self.lock:
+                self._flock(op)
+                try:
+                    return f(self, *a)
+                finally:
+                    self._flock(fcntl.LOCK_UN)
+        return g
+    return decorator
+
+_read = locked(fcntl.LOCK_SH)
+_write = locked(fcntl.LOCK_EX)
+
+class SharedMemoryCache:
+    """Dictionary of JSON strings stored in a memory mapped file."""
+    def __init__(self, path="/dev/shm/infobase_cache", capacity="256M", slot_size="8K"):
+        self.path = path
+        self.slot_size = parse_size(slot_size)
+        self.nslots = max(1, parse_size(capacity) // self.slot_size)
+
+        self.nbuckets = 1
+        while self.nbuckets < 2 * self.nslots:
+            self.nbuckets *= 2
+
+        self.index_offset = HEADER_SIZE
+        self.slots_offset = self.index_offset + self.nbuckets * BUCKET.size
+        self.size = self.slots_offset + self.nslots * self.slot_size
+
+        self.lock = threading.Lock()
+        self.pid = None
+        self.fd = None
+        self._open()
+
+        self._flock(fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.fd).st_size != self.size or self._header()[:4] != (MAGIC, self.nslots, self.slot_size, self.nbuckets):
+                self._initialize()
+        finally:
+            self._flock(fcntl.LOCK_UN)
+
+    def _open(self):
+        if self.fd is not None:
+            self.mm.close()
+            os.close(self.fd)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+        self.pid = os.getpid()
+        if os.fstat(self.fd).st_size < self.size:
+            os.ftruncate(self.fd, self.size)
+        self.mm = mmap.mmap(self.fd, self.size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+
+    def _flock(self, op):
+        # locks of the parent are shared by the child till the file is opened again.
+        if self.pid != os.getpid():
+            self._open()
+        fcntl.flock(self.fd, op)
+
+    def _initialize(self):
+        os.ftruncate(self.fd, self.size)
+        self._write_header(self.nslots, self.slot_size, self.nbuckets, 0, 0, 0, 0, 0)
+        self._clear_index()
+
+    def _clear_index(self):
+        chunk = "\xff" * 65536
+        offset, end = self.index_offset, self.slots_offset
+        while offset < end:
+            n = min(len(chunk), end - offset)
+            self.mm[offset:offset+n] = chunk[:n]
+            offset += n
+
+    def _header(self):
+        return HEADER.unpack_from(self.mm, 0)
+
+    def _write_header(self, *values):
+        HEADER.pack_into(self.mm, 0, MAGIC, *values)
+
+    def _hash(self, key):
+        return struct.unpack("<Q", hashlib.md5(key).digest()[:8])[0]
+
+    def _bucket(self, i):
+        return BUCKET.unpack_from(self.mm, self.index_offset + i * BUCKET.size)[0]
+
+    def _set_bucket(self, i, slot):
+        BUCKET.pack_into(self.mm, self.index_offset + i * BUCKET.size, slot)
+
+    def _slot_offset(self, slot):
+        return self.slots_offset + slot * self.slot_size
+
+    def _slot_header(self, slot):
+        return SLOT_HEADER.unpack_from(self.mm, self._slot_offset(slot))
+
+    def _find(self, key, h):
+        """Returns (bucket, slot) of the key, or (None, None) if it is not present."""
+        mask = self.nbuckets - 1
+        i = h & mask
+        for n in xrange(self.nbuckets):
+            slot = self._bucket(i)
+            if slot == EMPTY:
+                break
+            elif slot != REMOVED:
+                shash, keylen, vallen, flags = self._slot_header(slot)
+                if shash == h and flags & IN_USE:
+                    offset = self._slot_offset(slot) + SLOT_HEADER_SIZE
+                    if self.mm[offset:offset+keylen] == key:
+                        return i, slot
+            i = (i + 1) & mask
+        return None, None
+
+    def _get(self, key):
+        key = web.safestr(key)
+        i, slot = self._find(key, self._hash(key))
+        if slot is None:
+            return None
+        offset = self._slot_offset(slot)
+        shash, keylen, vallen, flags = SLOT_HEADER.unpack_from(self.mm, offset)
+        if not flags & REFERENCED:
+            SLOT_HEADER.pack_into(self.mm, offset, shash, keylen, vallen, flags | REFERENCED)
+        start = offset + SLOT_HEADER_SIZE + keylen
+        return self._value(self.mm[start:start+vallen], flags)
+
+    def _value(self, value, flags):
+        if flags & TEXT:
+            return value.decode("utf-8")
+        return value
+
+    @_read
+    def __getitem__(self, key):
+        value = self._get(key)
+        if value is None:
+            raise KeyError, key
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    @_read
+    def get_multi(self, keys):
+        """Returns a dict with values of the given keys that are found in the cache."""
+        result = {}
+        for k in keys:
+            value = self._get(k)
+            if value is not None:
+                result[k] = value
+        return result
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def _remove(self, bucket, slot):
+        self._set_bucket(bucket, REMOVED)
+        offset = self._slot_offset(slot)
+        shash, keylen, vallen, flags = SLOT_HEADER.unpack_from(self.mm, offset)
+        SLOT_HEADER.pack_into(self.mm, offset, shash, keylen, vallen, 0)
+
+        magic, nslots, slot_size, nbuckets, hand, used, tombstones, next_free, evictions = self._header()
+        self._write_header(nslots, slot_size, nbuckets, hand, used - 1, tombstones + 1, next_free, evictions)
+
+    def _allocate(self):
+        """Returns a free slot, evicting one if required."""
+        magic, nslots, slot_size, nbuckets, hand, used, tombstones, next_free, evictions = self._header()
+        if next_free < nslots:
+            self._write_header(nslots, slot_size, nbuckets, hand, used, tombstones, next_free + 1, evictions)
+            return next_free
+
+        # two rounds are enough as the first one clears all the referenced bits.
+        for n in xrange(2 * nslots + 1):
+            slot = hand
+            hand = (hand + 1) % nslots
+            offset = self._slot_offset(slot)
+            shash, keylen, vallen, flags = SLOT_HEADER.unpack_from(self.mm, offset)
+            if not flags & IN_USE:
+                break
+            elif flags & REFERENCED:
+                SLOT_HEADER.pack_into(self.mm, offset, shash, keylen, vallen, flags & ~REFERENCED)
+            else:
+                key = self.mm[offset+SLOT_HEADER_SIZE:offset+SLOT_HEADER_SIZE+keylen]
+                bucket, _ = self._find(key, shash)
+                self._remove(bucket, slot)
+                evictions += 1
+                break
+
+        magic, nslots, slot_size, nbuckets, _, used, tombstones, next_free, _ = self._header()
+        self._write_header(nslots, slot_size, nbuckets, hand, used, tombstones, next_free, evictions)
+        return slot
+
+    def _set(self, key, value):
+        key = web.safestr(key)
+        flags = IN_USE
+        if isinstance(value, unicode):
+            flags |= TEXT
+        value = web.safestr(value)
+        if SLOT_HEADER_SIZE + len(key) + len(value) > self.slot_size:
+            self._delete(key)
+            return
+
+        h = self._hash(key)
+        bucket, slot = self._find(key, h)
+        if slot is None:
+            slot = self._allocate()
+            # the slot may have been taken from a key on the probe sequence, so look up the bucket after allocating.
+            bucket = self._free_bucket(h)
+            self._set_bucket(bucket, slot)
+            magic, nslots, slot_size, nbuckets, hand, used, tombstones, next_free, evictions = self._header()
+            self._write_header(nslots, slot_size, nbuckets, hand, used + 1, tombstones, next_free, evictions)
+
+        offset = self._slot_offset(slot)
+        SLOT_HEADER.pack_into(self.mm, offset, h, len(key), len(value), flags)
+        start = offset + SLOT_HEADER_SIZE
+        self.mm[start:start+len(key)+len(value)] = key + value
+
+        if self._header()[6] > self.nbuckets // 4:
+            self._rebuild_index()
+
+    def _free_bucket(self, h):
+        mask = self.nbuckets - 1
+        i = h & mask
+        while self._bucket(i) not in (EMPTY, REMOVED):
+            i = (i + 1) & mask
+        return i
+
+    def _rebuild_index(self):
+        """Rebuilds the index to get rid of the buckets marked as removed."""
+        self._clear_index()
+        magic, nslots, slot_size, nbuckets, hand, used, tombstones, next_free, evictions = self._header()
+        for slot in xrange(next_free):
+            shash, keylen, vallen, flags = self._slot_header(slot)
+            if flags & IN_USE:
+                self._set_bucket(self._free_bucket(shash), slot)
+        self._write_header(nslots, slot_size, nbuckets, hand, used, 0, next_free, evictions)
+
+    def _delete(self, key):
+        key = web.safestr(key)
+        bucket, slot = self._find(key, self._hash(key))
+        if slot is not None:
+            self._remove(bucket, slot)
+            return True
+        return False
+
+    @_write
+    def __setitem__(self, key, value):
+        self._set(key, value)
+
+    @_write
+    def update(self, d):
+        for k, v in d.items():
+            self._set(k, v)
+
+    @_write
+    def __delitem__(self, key):
+        if not self._delete(key):
+            raise KeyError, key
+
+    @_write
+    def delete(self, key):
+        self._delete(key)
+
+    @_write
+    def delete_many(self, keys):
+        for k in keys:
+            self._delete(k)
+
+    @_write
+    def clear(self):
+        self._clear_index()
+        self._write_header(self.nslots, self.slot_size, self.nbuckets, 0, 0, 0, 0, self._header()[8])
+
+    @_read
+    def items(self):
+        result = []
+        for slot in xrange(self._header()[7]):
+            offset = self._slot_offset(slot)
+            shash, keylen, vallen, flags = SLOT_HEADER.unpack_from(self.mm, offset)
+            if flags & IN_USE:
+                start = offset + SLOT_HEADER_SIZE
+                key = self.mm[start:start+keylen].decode("utf-8")
+                result.append((key, self._value(self.mm[start+keylen:start+keylen+vallen], flags)))
+        return result
+
+    def keys(self):
+        return [k for k, v in self.items()]
+
+    @_read
+    def __len__(self):
+        return self._header()[5]
+
+    @_read
+    def stats(self):
+        magic, nslots, slot_size, nbuckets, hand, used, tombstones, next_free, evictions = self._header()
+        return dict(count=used, capacity=nslots, slot_size=slot_size, evictions=evictions, tombstones=tombstones)
@@ -0,0 +1,521 @@
+from infogami.infobase import cache, common, lru
+
+import os
+import threading
+import time
+import web
+
+class TestShardedLRU:
+    def test_capacity(self):
+        d = lru.ShardedLRU(100, shards=4)
+        assert [s.capacity for s in d.shards] == [25, 25, 25, 25]
+
+        d = lru.ShardedLRU(10, shards=4)
+        assert [s.capacity for s in d.shards] == [3, 3, 2, 2]
+
+        # never more shards than the capacity
+        d = lru.ShardedLRU(2, shards=4)
+        assert len(d.shards) == 2
+
+    def test_get_set(self):
+        d = lru.ShardedLRU(100, shards=4)
+        for i in range(10):
+            d["/a/%d" % i] = i
+
+        assert len(d) == 10
+        assert d["/a/1"] == 1
+        assert d.get("/a/1") == 1
+        assert d.get("/x") is None
+        assert "/a/1" in d
+        assert sorted(d.keys()) == sorted("/a/%d" % i for i in range(10))
+
+        d.delete_many(["/a/1", "/a/2", "/x"])
+        assert len(d) == 8
+        assert "/a/1" not in d
+
+        d.clear()
+        assert len(d) == 0
+
+    def test_eviction(self):
+        d = lru.ShardedLRU(20, shards=4)
+        for i in range(1000):
+            d[i] = i
+        assert len(d) == 20
+
+        for s in d.shards:
+            assert len(s.d) <= s.capacity
+
+    def test_threads(self):
+        d = lru.ShardedLRU(50, shards=4)
+        errors = []
+
+        def f(n):
+            try:
+                for i in range(2000):
+                    k = (n * i) % 200
+                    d[k] = k
+                    assert d.get(k) in [k, None]
+                    d.delete(k + 1)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=f, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert errors == []
+        assert len(d) <= 50
+
+    def test_recent_keys(self):
+        d = lru.ShardedLRU(100, shards=4)
+        for i in range(20):
+            d[i] = i
+        d.get(0)
+
+        keys = d.recent_keys(8)
+        assert len(keys) == 8
+        assert 0 in keys
+        assert len(d.recent_keys(100)) == 20
+
+        d = lru.LRU(10)
+        d["/a"], d["/b"], d["/c"] = 1, 2, 3
+        d.get("/a")
+        assert d.recent_keys(2) == ["/a", "/c"]
+
+    def test_create_cache(self):
+        d = cache.create_cache("sharded_lru", capacity=10, shards=2)
+        assert isinstance(d, lru.ShardedLRU)
+        assert d.stats() == dict(count=0, capacity=10, shards=2, evictions=0)
+
+class TestMetadataCache:
+    def test_eviction(self):
+        d = lru.MetadataCache(2)
+        for i in range(5):
+            d.add(web.storage(id=i, key="/a/%d" % i))
+        assert sorted(d.key2id) == ["/a/3", "/a/4"]
+        assert d.get_by_key("/a/0") is None
+        assert d.stats()['evictions'] == 3
+        
+    def test_delete_keys(self):
+        d = lru.MetadataCache(10)
+        d.add(web.storage(id=1, key="/a"))
+        d.add(web.storage(id=2, key="/b"))
+        d.delete_keys(["/a", "/x"])
+        assert d.get_by_key("/a") is None
+        assert d.get_by_id(1) is None
+        assert d.get_by_key("/b").id == 2
+        assert d.stats()['evictions'] == 0
+        
+    def test_stats(self):
+        d = lru.MetadataCache(10)
+        d.add(web.storage(id=1, key="/a"))
+        d.get_by_key("/a")
+        d.get_by_id(1)
+        d.get_by_key("/b")
+        assert d.stats() == dict(count=1, capacity=10, hits=2, misses=1, evictions=0)
+        
+    def test_generation(self):
+        d = lru.MetadataCache(10)
+        generation = d.generation
+        # a row read before a concurrent write is committed and the write removes the key from the cache
+        d.delete_keys(["/a"])
+        d.add(web.storage(id=1, key="/a", latest_revision=1), generation)
+        assert d.get_by_key("/a") is None
+        
+        generation = d.generation
+        d.add(web.storage(id=1, key="/a", latest_revision=2), generation)
+        assert d.get_by_key("/a").latest_revision == 2
+        
+        d.clear()
+        d.add(web.storage(id=1, key="/a", latest_revision=1), generation)
+        assert d.get_by_key("/a") is None
+        
+    def test_ttl(self):
+        d = lru.MetadataCache(10, ttl=60)
+        d.add(web.storage(id=1, key="/a"))
+        assert d.get_by_key("/a").id == 1
+        
+        d.d[1].value = (web.storage(id=1, key="/a"), time.time() - 1)
+        assert d.get_by_key("/a") is None
+        assert d.get_by_id(1) is None
+        assert d.key2id == {}
+
+class TestSizedLRU:
+    def test_size_accounting(self):
+        d = lru.SizedLRU(1000, shards=2)
+        d["/a"] = "a" * 100
+        d["/b"] = "b" * 200
+        assert d.stats()['bytes'] == 300
+
+        # overwriting must replace the old size
+        d["/a"] = "a" * 10
+        assert d.stats()['bytes'] == 210
+
+        del d["/b"]
+        assert d.stats()['bytes'] == 10
+        assert d.stats()['count'] == 1
+
+        d.clear()
+        assert d.stats()['bytes'] == 0
+
+    def test_eviction(self):
+        d = lru.SizedLRU("1K", shards=1)
+        for i in range(100):
+            d[i] = "x" * 100
+
+        stats = d.stats()
+        assert stats['count'] == 10
+        assert stats['bytes'] == 1000
+        assert stats['evictions'] == 90
+        assert d.keys() == range(90, 100)
+
+    def test_unicode(self):
+        d = lru.SizedLRU(1000, shards=1)
+        d["/a"] = u"\u20ac" * 10
+        assert d.stats()['bytes'] == 30
+
+    def test_create_cache(self):
+        d = cache.create_cache("sized_lru", capacity="2M")
+        assert isinstance(d, lru.SizedLRU)
+        assert d.capacity == 2 * 1024 * 1024
+
+class MockMemcache:
+    """Mock memcache client for testing."""
+    def __init__(self):
+        self.d = {}
+        self.calls = []
+
+    def get(self, key):
+        self.calls.append(("get", key))
+        return self.d.get(key)
+
+    def get_multi(self, keys):
+        self.calls.append(("get_multi", keys))
+        return dict((k, self.d[k]) for k in keys if k in self.d)
+
+    def set(self, key, value):
+        self.d[key] = value
+
+    def set_multi(self, d):
+        self.calls.append(("set_multi", sorted(d)))
+        self.d.update(d)
+
+    def delete_multi(self, keys):
+        for k in keys:
+            self.d.pop(k, None)
+
+    def flush_all(self):
+        self.d.clear()
+
+class TestCacheGetMulti:
+    def setup_method(self, method):
+        self._global_cache = cache.global_cache
+        cache.loadhook()
+
+    def teardown_method(self, method):
+        cache.global_cache = self._global_cache
+
+    def test_layers(self):
+        cache.global_cache = lru.LRU(10)
+        cache.global_cache["/c"] = "c"
+        web.ctx.new_objects["/a"] = "a"
+        web.ctx.local_cache["/b"] = "b"
+
+        c = cache.Cache()
+        assert c.get_multi(["/a", "/b", "/c", "/d"]) == {"/a": "a", "/b": "b", "/c": "c"}
+
+        # values from global cache must be remembered in the local cache
+        assert web.ctx.local_cache["/c"] == "c"
+
+    def test_memcache(self):
+        mc = MockMemcache()
+        mc.set("/a", "a")
+        mc.set("/b", "b")
+        cache.global_cache = cache.MemcachedDict(memcache_client=mc)
+
+        c = cache.Cache()
+        assert c.get_multi([u"/a", u"/b", u"/c"]) == {"/a": "a", "/b": "b"}
+        # all the keys must be fetched in one call
+        assert len(mc.calls) == 1
+        assert mc.calls[0][0] == "get_multi"
+        assert sorted(mc.calls[0][1]) == ["/a", "/b", "/c"]
+
+    def test_get_multi_fallback(self):
+        d = {"/a": 1}
+        assert cache.get_multi(d, ["/a", "/b"]) == {"/a": 1}
+        assert cache.get_multi(cache.NoneDict(), ["/a"]) == {}
+
+class TestRevisionCache:
+    def setup_method(self, method):
+        self._revision_cache = cache.revision_cache
+        cache.revision_cache = lru.LRU(10)
+        cache.loadhook()
+
+    def teardown_method(self, method):
+        cache.revision_cache = self._revision_cache
+
+    def test_get_set(self):
+        c = cache.Cache()
+        assert c.get_revision("/a", 1) is None
+
+        c.set_revision("/a", 1, '{"revision": 1}')
+        assert c.get_revision("/a", 1) == '{"revision": 1}'
+        assert c.get_revision("/a", 2) is None
+
+        # revisions are not visible as latest docs
+        assert c.get("/a") is None
+
+        c.clear()
+        assert c.get_revision("/a", 1) is None
+
+class TestSpecialCache:
+    def test_ttl(self):
+        d = cache.SpecialCache()
+        d.ttl = 60
+        threads = []
+        d.add_reload_listener(lambda: threads.append(threading.current_thread()))
+
+        d.get("/a")
+        assert threads == []
+
+        # reloaded in the background, as the lookup could be made in a transaction
+        d.loaded_at -= 61
+        d.get("/a")
+        d._reload_thread.join()
+        assert len(threads) == 1
+        assert threads[0] is not threading.current_thread()
+
+        d.get("/a")
+        assert len(threads) == 1
+
+class TestCacheStats:
+    def setup_method(self, method):
+        self._global_cache = cache.global_cache
+        cache.global_cache = lru.LRU(10)
+        cache.loadhook()
+
+    def teardown_method(self, method):
+        cache.global_cache = self._global_cache
+
+    def test_layers(self):
+        cache.global_cache["/b"] = "bb"
+        web.ctx.new_objects["/a"] = "a"
+
+        c = cache.Cache()
+        c.get("/a")
+        c.get("/b")
+        c.get("/b")
+        c.get("/x")
+        c["/y"] = "y"
+
+        layers = web.ctx.cache_stats.layers
+        assert layers['new_objects']['hits'] == 1
+        assert layers['new_objects']['misses'] == 3
+        assert layers['global_cache']['hits'] == 1
+        assert layers['global_cache']['misses'] == 1
+        assert layers['global_cache']['bytes'] == 2
+        # the second lookup of /b is served from the local cache
+        assert layers['local_cache']['hits'] == 1
+        assert layers['local_cache']['sets'] == 1
+
+        assert web.ctx.cache_stats.format() == "new_objects=1/3 special_cache=0/3 local_cache=1/2 global_cache=1/1"
+
+    def test_process_stats(self):
+        before = cache.get_stats()['layers']['global_cache']
+
+        c = cache.Cache()
+        c.get("/x")
+        c.get_multi(["/y", "/z"])
+        c["/y"] = "y"
+        cache.unloadhook()
+
+        after = cache.get_stats()['layers']['global_cache']
+        assert after['misses'] - before['misses'] == 3
+        assert after['sets'] - before['sets'] == 1
+        # counters of the request are reset after adding them to the process totals
+        assert web.ctx.cache_stats.layers['global_cache']['misses'] == 0
+
+class TestTinyLFU:
+    def read(self, d, key):
+        if d.get(key) is None:
+            d[key] = key
+
+    def test_scan_resistance(self):
+        d = cache.create_cache("tinylfu", capacity=400)
+        hot = ["/books/OL%dM" % i for i in range(200)]
+        for i in range(5):
+            for k in hot:
+                self.read(d, k)
+
+        # a bulk read of one-off documents must not evict the hot documents
+        for i in range(5000):
+            self.read(d, "/authors/OL%dA" % i)
+
+        assert len(d) <= 400
+        assert sum(1 for k in hot if k in d) > 190
+        assert d.stats()['rejections'] > 0
+
+    def test_get_set_delete(self):
+        d = lru.TinyLFU(100, shards=4)
+        for i in range(10):
+            d["/a/%d" % i] = i
+
+        assert len(d) == 10
+        assert d["/a/1"] == 1
+        assert d.get("/x") is None
+        assert sorted(d.get_multi(["/a/1", "/a/2", "/x"])) == ["/a/1", "/a/2"]
+
+        d["/a/1"] = "one"
+        assert d["/a/1"] == "one"
+
+        d.delete_many(["/a/1", "/a/2", "/x"])
+        assert len(d) == 8
+        assert "/a/1" not in d
+
+        d.clear()
+        assert len(d) == 0
+
+    def test_capacity(self):
+        d = lru.TinyLFU(50, shards=2)
+        for i in range(1000):
+            self.read(d, i)
+        assert len(d) <= 50
+
+    def test_small_capacity(self):
+        # shards with capacity 1 have only the window and no main cache
+        for capacity, shards in [(1, 1), (2, 1), (20, 16), (5, 16)]:
+            d = lru.TinyLFU(capacity, shards=shards)
+            for i in range(100):
+                self.read(d, i)
+            assert 0 < len(d) <= capacity
+            assert d[99] == 99
+
+class TestNearMemcachedDict:
+    def test_near_hits(self):
+        mc = MockMemcache()
+        d = cache.create_cache("near_memcache", memcache_client=mc, near_capacity=10)
+        d["/a"] = "a"
+        assert mc.d["/a"] == "a"
+
+        # reads of the written keys must not go to memcached
+        assert d["/a"] == "a"
+        assert mc.calls == []
+
+        mc.set("/b", "b")
+        assert d["/b"] == "b"
+        assert d["/b"] == "b"
+        assert mc.calls == [("get", "/b")]
+        assert d.stats()['near_hits'] == 2
+
+    def test_get_multi(self):
+        mc = MockMemcache()
+        d = cache.NearMemcachedDict(memcache_client=mc)
+        d.update({"/a": "a", "/b": "b"})
+        mc.set("/c", "c")
+        mc.calls = []
+
+        assert d.get_multi(["/a", "/c", "/d"]) == {"/a": "a", "/c": "c"}
+        # only the keys not in the near cache are fetched, in one call
+        assert [(name, sorted(keys)) for name, keys in mc.calls] == [("get_multi", ["/c", "/d"])]
+
+        mc.calls = []
+        assert d.get_multi(["/a", "/c"]) == {"/a": "a", "/c": "c"}
+        assert mc.calls == []
+
+    def test_ttl(self):
+        mc = MockMemcache()
+        d = cache.NearMemcachedDict(memcache_client=mc, near_ttl=0)
+        d["/a"] = "a"
+        # modified by another process
+        mc.set("/a", "a2")
+        assert d["/a"] == "a2"
+
+    def test_invalidate(self):
+        mc = MockMemcache()
+        d = cache.NearMemcachedDict(memcache_client=mc)
+        d.update({"/a": "a", "/b": "b"})
+        d.delete_many(["/a"])
+        assert d.get_multi(["/a", "/b"]) == {"/b": "b"}
+        assert "/a" not in mc.d
+
+        d.clear()
+        assert d.get_multi(["/b"]) == {}
+
+class TestCompressedDict:
+    def test_compress(self):
+        d = cache.create_cache("lru", capacity=10, compress_threshold="1K")
+        assert isinstance(d, cache.CompressedDict)
+
+        big = '{"key": "/books/OL1M", "title": "%s"}' % ("x" * 5000)
+        d["/a"] = big
+        d["/b"] = '{"key": "/b"}'
+
+        assert d.d["/a"][0] == cache.COMPRESSED
+        assert d.d["/b"] == '{"key": "/b"}'
+        assert d["/a"] == big
+        assert d.get_multi(["/a", "/b", "/c"]) == {"/a": big, "/b": '{"key": "/b"}'}
+
+        stats = d.stats()
+        assert stats['compressed'] == 1
+        assert stats['decompressed'] == 2
+        assert stats['compression_ratio'] > 10
+
+        d.delete_many(["/a"])
+        assert d.get("/a") is None
+
+    def test_unicode(self):
+        d = cache.CompressedDict(lru.SizedLRU("1M"), threshold=100)
+        value = u'{"title": "%s"}' % (u"\u20ac" * 1000)
+        d["/a"] = value
+        assert d["/a"] == value
+        assert d.stats()['bytes'] < 100
+
+    def test_incompressible(self):
+        d = cache.CompressedDict({}, threshold=10)
+        value = '"' + os.urandom(100).encode("hex") + '"'
+        d.update({"/a": value})
+        assert d.d["/a"] == value or len(d.d["/a"]) < len(value)
+        assert d["/a"] == value
+
+class TestParsedCache:
+    def setup_method(self, method):
+        self._parsed_cache = cache.parsed_cache
+        cache.parsed_cache = lru.LRU(10)
+        cache.loadhook()
+
+    def teardown_method(self, method):
+        cache.parsed_cache = self._parsed_cache
+
+    def test_get_set(self):
+        c = cache.Cache()
+        json = '{"key": "/a", "revision": 1}'
+        assert c.get_parsed("/a", None, json) is None
+
+        data = {"key": "/a", "revision": 1}
+        c.set_parsed("/a", None, json, data)
+        assert c.get_parsed("/a", None, json) is data
+        # equal json from a different source
+        assert c.get_parsed("/a", None, '{"key": "/a", "revision": %d}' % 1) is data
+
+        # the latest revision has changed
+        assert c.get_parsed("/a", None, '{"key": "/a", "revision": 2}') is None
+        assert c.get_parsed("/a", 1, json) is None
+
+        layers = web.ctx.cache_stats.layers
+        assert layers['parsed_cache']['hits'] == 2
+        assert layers['parsed_cache']['misses'] == 3
+
+        c.clear()
+        assert c.get_parsed("/a", None, json) is None
+
+    def test_thing_copy(self):
+        data = {"key": "/a", "authors": [{"name": "a"}]}
+        thing = common.Thing(None, "/a", data, shared=True)
+
+        t = thing.copy()
+        t["title"] = "foo"
+        t._data["authors"][0]["name"] = "b"
+        t._data["authors"].append({"name": "c"})
+        assert data == {"key": "/a", "authors": [{"name": "a"}]}
@@ -67,6 +67,21 @@ class TestRecentChanges:
         changes = self.recentchanges(data={"x": "two"})
         assert [c['data'] for c in changes] == [{"x": "two"}]
     
+class TestThings:
+    def test_things_with_docs(self):
+        site.save({"key": "/things/a", "type": {"key": "/type/object"}, "title": "a"})
+        site.save({"key": "/things/b", "type": {"key": "/type/object"}, "title": "b"})
+
+        things = site.things_with_docs({"key~": "/things/*", "sort": "key"})
+        assert [t.key for t in things] == ["/things/a", "/things/b"]
+        assert things[0].title == "a"
+        # the documents are cached
+        assert ("/things/a", None) in site._cache
+
+        result = site.things_with_docs({"key~": "/things/*", "sort": "key", "limit": 1, "cursor": ""})
+        assert [t.key for t in result.result] == ["/things/a"]
+        assert result.cursor is not None
+
 class TestStore:
     def setup_method(self, method):
         s.clear()
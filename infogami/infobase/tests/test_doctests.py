@@ -11,12 +11,20 @@ def test_doctest():
         "infogami.infobase.core",
         "infogami.infobase.dbstore",
         "infogami.infobase.infobase",
+        "infogami.infobase.invalidation",
         "infogami.infobase.logger",
         "infogami.infobase.logreader",
         "infogami.infobase.lru",
         "infogami.infobase.readquery",
+        "infogami.infobase.shmcache",
         "infogami.infobase.utils",
         "infogami.infobase.writequery",
+        "infogami.infobase._dbstore.notfound",
+        "infogami.infobase._dbstore.planner",
+        "infogami.infobase._dbstore.pool",
+        "infogami.infobase._dbstore.prepared",
+        "infogami.infobase._dbstore.querycache",
+        "infogami.infobase._dbstore.singleflight",
     ]
     for test in find_doctests(modules):
         yield run_doctest, test
@@ -5,7 +5,7 @@ import urllib
 import py.test
 
 import web
-from infogami.infobase import config, dbstore, infobase, server
+from infogami.infobase import cache, common, config, dbstore, infobase, server
 
 import utils
 
@@ -157,7 +157,71 @@ class TestInfobase(DBTest):
         # should return empty result when queried for non-existing objects
         assert site.things({'type': '/type/object', 'foo': {'key': '/foo'}}) == []
         assert site.things({'type': '/type/bad'}) == []
-        
+
+    def test_things_cursor(self):
+        for k in ['/a', '/b', '/c']:
+            site.save(k, {'key': k, 'type': '/type/object', 'name': k[1:]})
+
+        def pages(q):
+            keys = []
+            q = dict(q, cursor="", limit=2)
+            while True:
+                result = site.things(q)
+                keys.append([d['key'] for d in result['result']])
+                if result['cursor'] is None:
+                    return keys
+                q['cursor'] = result['cursor']
+
+        assert pages({'type': '/type/object'}) == [['/a', '/b'], ['/c']]
+        assert pages({'type': '/type/object', 'sort': '-name'}) == [['/c', '/b'], ['/a']]
+        assert pages({'type': '/type/object', 'sort': 'key'}) == [['/a', '/b'], ['/c']]
+        assert pages({'type': '/type/object', 'sort': '-created'}) == [['/c', '/b'], ['/a']]
+
+        # a cursor can't be used with a different sort order or with offset
+        cursor = site.things({'type': '/type/object', 'cursor': '', 'limit': 1})['cursor']
+        py.test.raises(common.BadData, site.things, {'type': '/type/object', 'sort': 'name', 'cursor': cursor})
+        py.test.raises(common.BadData, site.things, {'type': '/type/object', 'cursor': cursor, 'offset': 1})
+        py.test.raises(common.BadData, site.things, {'type': '/type/object', 'cursor': 'bad'})
+
+    def test_things_count(self):
+        for k in ['/a', '/b', '/c']:
+            site.save(k, {'key': k, 'type': '/type/object', 'name': k[1:], 'tags': ['x', 'y']})
+
+        assert site.things_count({'type': '/type/object'}) == 3
+        assert site.things_count({'type': '/type/object', 'limit': 1, 'offset': 1}) == 3
+        assert site.things_count({'type': '/type/object', 'name': 'a'}) == 1
+        # things matching more than one value are counted once
+        assert site.things_count({'type': '/type/object', 'tags': ['x', 'y']}) == 3
+        assert site.things_count({'type': '/type/object', 'foo': 'bar'}) == 0
+        assert site.things_count({'type': '/type/bad'}) == 0
+
+        assert site.things_count({'type': '/type/object'}, estimate=True) >= 0
+
+    def test_things_with_docs(self):
+        site.save('/a', {'key': '/a', 'type': '/type/object', 'name': 'a'})
+        site.save('/b', {'key': '/b', 'type': '/type/object', 'name': 'b'})
+
+        docs = simplejson.loads(site.things_with_docs({'type': '/type/object', 'sort': 'key'}))
+        assert [d['key'] for d in docs] == ['/a', '/b']
+        assert docs[0]['name'] == 'a'
+        assert docs[0]['revision'] == 1
+
+        d = simplejson.loads(site.things_with_docs({'type': '/type/object', 'sort': 'key', 'limit': 1, 'cursor': ''}))
+        assert [doc['key'] for doc in d['result']] == ['/a']
+        assert d['cursor'] is not None
+
+        assert simplejson.loads(site.things_with_docs({'type': '/type/bad'})) == []
+
+    def test_explain_things(self):
+        site.save('/a', {'key': '/a', 'type': '/type/object', 'name': 'a'})
+
+        d = site.explain_things({'type': '/type/object', 'name': 'a'})
+        assert d['empty'] is None
+        assert d['sql'].startswith('SELECT')
+
+        assert site.explain_things({'type': '/type/object', 'foo': 'bar'})['empty']
+        assert site.explain_things({'type': '/type/bad'})['empty']
+
     def test_nested_things(self):
         site.save('/a', {
             'key': '/a', 
@@ -194,3 +258,138 @@ class TestInfobase(DBTest):
         site.things({'type': '/type/object', 'links': {'name': 'x'}}) == [{'key': '/a'}]
         site.things({'type': '/type/object', 'links': {'name': 'y'}}) == [{'key': '/a'}, {'key': '/b'}]
         site.things({'type': '/type/object', 'links': {'name': 'z'}}) == [{'key': '/b'}]
+
+class TestGetMany(DBTest):
+    def test_get_many(self):
+        site.save_many([
+            {'key': '/a', 'type': '/type/object', 'name': 'a'},
+            {'key': '/b', 'type': '/type/object', 'name': 'b'}
+        ])
+        reset()
+
+        d = simplejson.loads(site.get_many(['/a', '/b', '/c']))
+        assert sorted(d.keys()) == ['/a', '/b']
+        assert d['/a']['name'] == 'a'
+
+        # docs read by get_many must be added to the cache
+        assert sorted(site.store.cache.get_multi(['/a', '/b'])) == ['/a', '/b']
+
+    def test_get_many_uses_cache(self):
+        site.save('/a', {'key': '/a', 'type': '/type/object', 'name': 'a'})
+        reset()
+        site.get_many(['/a'])
+
+        # change the data behind the back of the cache.
+        db.query("UPDATE data SET data=replace(data, '\"a\"', '\"x\"') WHERE thing_id=(SELECT id FROM thing WHERE key='/a')")
+
+        d = site.store.get_many_as_dict(['/a'])
+        assert simplejson.loads(d['/a'])['name'] == 'a'
+
+class TestGetRevision(DBTest):
+    def test_get_revision(self):
+        site.save('/a', {'key': '/a', 'type': '/type/object', 'name': 'a1'})
+        site.save('/a', {'key': '/a', 'type': '/type/object', 'name': 'a2'})
+        reset()
+
+        assert simplejson.loads(site.get('/a', revision=1))['name'] == 'a1'
+        assert simplejson.loads(site.get('/a', revision=2))['name'] == 'a2'
+        assert simplejson.loads(site.get('/a'))['name'] == 'a2'
+        assert site.get('/a', revision=3) is None
+        assert site.get('/b', revision=1) is None
+
+        # reads inside a transaction must not be cached as it can be rolled back.
+        assert site.store.cache.get_revision('/a', 1) is None
+
+    def test_revision_cache(self):
+        site.save('/a', {'key': '/a', 'type': '/type/object', 'name': 'a1'})
+        site.save('/a', {'key': '/a', 'type': '/type/object', 'name': 'a2'})
+        reset()
+
+        # the tests run in a transaction, which bypasses the cache
+        store = site.store
+        revision_cache = cache.revision_cache
+        cache.revision_cache = cache.create_cache("lru", capacity=10)
+        store._in_transaction = lambda: False
+        reads = []
+        store._get = lambda key, revision: reads.append((key, revision)) or store.__class__._get(store, key, revision)
+        try:
+            assert simplejson.loads(site.get('/a', revision=1))['name'] == 'a1'
+            assert ('/a', 1) in cache.revision_cache
+
+            # the second read is served from the revision cache
+            assert simplejson.loads(site.get('/a', revision=1))['name'] == 'a1'
+            assert reads == [('/a', 1)]
+        finally:
+            del store._in_transaction
+            del store._get
+            cache.revision_cache = revision_cache
+
+class TestParsedCache(DBTest):
+    def setUp(self):
+        DBTest.setUp(self)
+        self._parsed_cache = cache.parsed_cache
+        cache.parsed_cache = cache.create_cache("sharded_lru", capacity=100)
+        
+    def tearDown(self):
+        cache.parsed_cache = self._parsed_cache
+        DBTest.tearDown(self)
+        
+    def test_get_thing(self):
+        site.save('/a', {'key': '/a', 'type': '/type/object', 'name': 'a'})
+        
+        t1 = site._get_thing('/a')
+        t2 = site._get_thing('/a')
+        assert t1.name == 'a'
+        assert t1._data is t2._data
+        
+        # modifying a thing must not modify the shared data
+        t1['name'] = 'x'
+        assert t1.name == 'x'
+        assert t2.name == 'a'
+        assert site._get_thing('/a').name == 'a'
+        
+        # a new revision must not be served from the entry of the old one
+        site.save('/a', {'key': '/a', 'type': '/type/object', 'name': 'a2'})
+        assert site._get_thing('/a').name == 'a2'
+        assert site._get_thing('/a', revision=1).name == 'a'
+        
+class TestSpecialCache(DBTest):
+    def setUp(self):
+        DBTest.setUp(self)
+        config.special_cache_types = ['/type/type']
+        self.site = infobase.Site(site._infobase, site.sitename, site.store, config.secret_key)
+        
+    def tearDown(self):
+        config.special_cache_types = None
+        cache.special_cache.clear()
+        self.site.close()
+        cache.special_cache.ttl = None
+        DBTest.tearDown(self)
+        
+    def test_load(self):
+        assert '/type/object' in cache.special_cache
+        assert '/type/object' in self.site._special_cache_keys
+        
+        hits = cache.special_cache.hits
+        self.site.get('/type/object')
+        assert cache.special_cache.hits == hits + 1
+        
+    def test_trigger(self):
+        self.site.save('/type/foo', {'key': '/type/foo', 'type': '/type/type', 'name': 'foo'})
+        assert simplejson.loads(cache.special_cache['/type/foo'])['name'] == 'foo'
+        
+        # no longer a type
+        self.site.save('/type/foo', {'key': '/type/foo', 'type': '/type/object'})
+        assert '/type/foo' not in cache.special_cache
+        
+    def test_ttl(self):
+        # without invalidation, the changes made by other processes are picked up after ttl seconds
+        assert cache.special_cache.ttl == 60
+        
+        # site doesn't pin the special cache documents, like another process
+        site.save('/type/bar', {'key': '/type/bar', 'type': '/type/type', 'name': 'bar'})
+        assert '/type/bar' not in cache.special_cache
+        
+        # reloaded in this thread, a background thread wouldn't see the transaction of the test
+        cache.special_cache.reload()
+        assert simplejson.loads(cache.special_cache['/type/bar'])['name'] == 'bar'
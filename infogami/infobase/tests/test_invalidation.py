@@ -0,0 +1,194 @@
+from infogami.infobase import cache, invalidation, lru
+
+import web
+import simplejson
+
+class MockTransport(invalidation.Transport):
+    """Transport that stores the messages sent instead of sending them."""
+    def __init__(self):
+        self.messages = []
+
+    def send(self, message):
+        self.messages.append(message)
+
+class TestInvalidationBus:
+    def setup_method(self, method):
+        self._global_cache = cache.global_cache
+        cache.global_cache = lru.LRU(100)
+
+    def teardown_method(self, method):
+        cache.global_cache = self._global_cache
+        cache.special_cache.clear()
+
+    def test_publish(self):
+        bus = invalidation.InvalidationBus(MockTransport(), sender="a")
+        bus.batch_size = 2
+        bus.publish(["/a", "/b", "/c"])
+
+        messages = [simplejson.loads(m) for m in bus.transport.messages]
+        assert [m['seq'] for m in messages] == [1, 2]
+        assert [m['keys'] for m in messages] == [["/a", "/b"], ["/c"]]
+        assert messages[0]['sender'] == "a"
+
+    def test_receive(self):
+        a = invalidation.InvalidationBus(MockTransport(), sender="a")
+        b = invalidation.InvalidationBus(MockTransport(), sender="b")
+
+        cache.global_cache.update({"/a": "a", "/b": "b", "/c": "c"})
+        a.publish(["/a", "/b"])
+
+        # own messages must be ignored
+        assert a.receive(a.transport.messages[0]) == 0
+        assert "/a" in cache.global_cache
+
+        assert b.receive(a.transport.messages[0]) == 2
+        assert cache.global_cache.keys() == ["/c"]
+
+        stats = b.stats()
+        assert stats['peers']['a']['last_seq'] == 1
+        assert stats['peers']['a']['missed'] == 0
+        assert stats['peers']['a']['keys'] == 2
+
+    def test_gap(self):
+        a = invalidation.InvalidationBus(MockTransport(), sender="a")
+        b = invalidation.InvalidationBus(MockTransport(), sender="b")
+        a.publish(["/a"])
+        a.publish(["/b"])
+        a.publish(["/c"])
+
+        b.receive(a.transport.messages[0])
+        cache.global_cache.update({"/x": "x"})
+        cache.special_cache["/y"] = "y"
+        flushes = []
+        flush = lambda: flushes.append(True)
+        cache.add_flush_listener(flush)
+
+        # the second message is lost, the caches must be flushed
+        try:
+            b.receive(a.transport.messages[2])
+        finally:
+            cache.remove_flush_listener(flush)
+        assert "/x" not in cache.global_cache
+        assert "/y" not in cache.special_cache
+        assert len(flushes) == 1
+        assert b.stats()['peers']['a']['missed'] == 1
+
+    def test_on_event(self):
+        bus = invalidation.InvalidationBus(MockTransport(), sender="a")
+        changeset = {"changes": [{"key": "/a", "revision": 2}]}
+        bus.on_event(web.storage(name="save", data={"changeset": changeset}))
+        bus.on_event(web.storage(name="store.put", data={"key": "foo"}))
+
+        messages = [simplejson.loads(m) for m in bus.transport.messages]
+        assert [m['keys'] for m in messages] == [["/a"]]
+
+    def test_invalidation_listener(self):
+        invalidated = []
+        cache.add_invalidation_listener(invalidated.extend)
+        try:
+            cache.invalidate(["/a"])
+        finally:
+            cache.remove_invalidation_listener(invalidated.extend)
+        assert invalidated == ["/a"]
+
+    def test_remove_listener(self):
+        invalidated = []
+        cache.add_invalidation_listener(invalidated.extend)
+        cache.remove_invalidation_listener(invalidated.extend)
+        cache.invalidate(["/a"])
+        assert invalidated == []
+
+        # removing a listener that is not registered is not an error
+        cache.remove_invalidation_listener(invalidated.extend)
+
+    def test_flush_listener(self):
+        def fail():
+            raise Exception("flush failed")
+        flushed = []
+        flush = lambda: flushed.append(True)
+        cache.add_flush_listener(fail)
+        cache.add_flush_listener(flush)
+        try:
+            # a failing listener must not keep the others from being called
+            cache.flush()
+        finally:
+            cache.remove_flush_listener(fail)
+            cache.remove_flush_listener(flush)
+        assert flushed == [True]
+
+class MockDB:
+    def __init__(self):
+        self.queries = []
+
+    def query(self, query, vars):
+        self.queries.append((query, vars['channel'], vars['payload']))
+
+class TestPGNotify:
+    def setup_method(self, method):
+        self._global_cache = cache.global_cache
+        cache.global_cache = lru.LRU(100)
+
+    def teardown_method(self, method):
+        cache.global_cache = self._global_cache
+        cache.special_cache.clear()
+
+    def test_pg_notify(self):
+        db = MockDB()
+        changes = [{"key": "/a", "revision": 1}, {"key": "/b", "revision": 3}]
+        invalidation.pg_notify(db, changes)
+
+        assert len(db.queries) == 1
+        query, channel, payload = db.queries[0]
+        assert channel == "infobase_invalidate"
+        msg = simplejson.loads(payload)
+        assert msg['sender'] == invalidation.get_process_id()
+        assert msg['changes'] == [["/a", 1], ["/b", 3]]
+
+    def test_encode_notifications(self):
+        changes = [{"key": "/books/OL%dM" % i, "revision": i} for i in range(1000)]
+        payloads = invalidation.encode_notifications("a", changes)
+        assert len(payloads) > 1
+        assert max(len(p) for p in payloads) <= invalidation.MAX_PAYLOAD_SIZE
+
+        keys = [key for p in payloads for key, revision in simplejson.loads(p)['changes']]
+        assert keys == [c['key'] for c in changes]
+
+    def test_process(self):
+        listener = invalidation.PGNotifyListener()
+        cache.global_cache.update({"/a": "a", "/b": "b", "/c": "c"})
+        cache.special_cache["/b"] = "b"
+
+        payloads = invalidation.encode_notifications("other:1", [{"key": "/a", "revision": 2}])
+        payloads += invalidation.encode_notifications("other:2", [{"key": "/a", "revision": 3}, {"key": "/b", "revision": 2}])
+        assert listener.process(payloads) == 2
+        assert cache.global_cache.keys() == ["/c"]
+        assert "/b" not in cache.special_cache
+        assert listener.stats()['batches'] == 1
+
+        # notifications of the writes made by this process must be ignored
+        payloads = invalidation.encode_notifications(listener.sender, [{"key": "/c", "revision": 2}])
+        assert listener.process(payloads) == 0
+        assert "/c" in cache.global_cache
+
+    def test_flush(self):
+        listener = invalidation.PGNotifyListener()
+        cache.global_cache.update({"/a": "a"})
+        cache.special_cache["/b"] = "b"
+        flushes = []
+        flush = lambda: flushes.append(True)
+        cache.add_flush_listener(flush)
+        try:
+            listener.flush()
+        finally:
+            cache.remove_flush_listener(flush)
+        assert "/a" not in cache.global_cache
+        assert cache.special_cache == {}
+        # the other caches, like the not-found and metadata caches, are flushed too
+        assert flushes == [True]
+
+    def test_connect_args(self):
+        listener = invalidation.PGNotifyListener(db_parameters=dict(db="infobase", user="joe", pw="", host="db1", port=5433))
+        assert listener.connect_args() == dict(database="infobase", user="joe", password=None, host="db1", port=5433)
+
+        listener = invalidation.PGNotifyListener(db_parameters=dict(db="infobase", user="joe", pw="secret"))
+        assert listener.connect_args() == dict(database="infobase", user="joe", password="secret")
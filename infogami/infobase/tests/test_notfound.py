@@ -0,0 +1,130 @@
+from infogami.infobase._dbstore.notfound import BloomFilter, NotFoundCache
+
+import time
+import web
+
+class TestBloomFilter:
+    def test_no_false_negatives(self):
+        b = BloomFilter(1000)
+        keys = ["/books/OL%dM" % i for i in range(1000)]
+        for k in keys:
+            b.add(k)
+
+        assert len(b) == 1000
+        assert all(k in b for k in keys)
+
+    def test_error_rate(self):
+        b = BloomFilter(1000, error_rate=0.01)
+        for i in range(1000):
+            b.add("/books/OL%dM" % i)
+
+        false_positives = sum(1 for i in range(10000) if "/authors/OL%dA" % i in b)
+        assert false_positives < 300
+
+    def test_unicode(self):
+        b = BloomFilter(10)
+        b.add(u"/books/\u20ac")
+        assert u"/books/\u20ac" in b
+
+class MockDB:
+    """db with the given keys in the thing table. on_query is called on every query."""
+    def __init__(self, keys, on_query=None):
+        self.keys = keys
+        self.on_query = on_query
+
+    def query(self, query, vars=None):
+        if self.on_query:
+            self.on_query()
+        if query.startswith("SELECT max(id)"):
+            return [web.storage(max_id=len(self.keys))]
+        rows = [web.storage(id=i+1, key=k) for i, k in enumerate(self.keys) if i+1 > vars['last_id']]
+        return Result(rows[:vars['self'].batch_size])
+
+class Result(list):
+    def list(self):
+        return self
+
+class TestNotFoundCache:
+    def setup_method(self, method):
+        self.cache = NotFoundCache(db=None, capacity=10, shared=True)
+        # pretend that the bloom filter was built, to avoid querying the db.
+        self.cache.last_rebuild = 0
+        self.cache.rebuild_interval = 1e12
+
+    def test_misses(self):
+        c = self.cache
+        assert c.is_missing("/a") == False
+
+        c.add_missing("/a", c.generation)
+        assert c.is_missing("/a") == True
+
+        c.add(["/a"])
+        assert c.is_missing("/a") == False
+
+        stats = c.stats()
+        assert stats['miss_hits'] == 1
+        assert stats['queries_saved'] == 1
+        assert stats['lookups'] == 3
+
+    def test_concurrent_create(self):
+        c = self.cache
+        generation = c.generation
+        # key created while the db query for it was running
+        c.add(["/a"])
+        c.add_missing("/a", generation)
+        assert c.is_missing("/a") == False
+
+    def test_bloom(self):
+        c = self.cache
+        c.bloom = BloomFilter(100)
+        c.add(["/a"])
+        assert c.is_missing("/a") == False
+        assert c.is_missing("/b") == True
+        assert c.stats()['bloom_rejects'] == 1
+        assert c.stats()['bloom_keys'] == 1
+
+    def test_clear(self):
+        c = self.cache
+        c.bloom = BloomFilter(100)
+        c.add_missing("/a", c.generation)
+        c.clear()
+
+        # keys created by other processes while their announcements were lost must not be reported missing
+        assert c.bloom is None
+        assert c.is_missing("/b") == False
+        assert c.is_missing("/a") == False
+
+    def test_rebuild(self):
+        c = self.cache
+        c.db = MockDB(["/a", "/b"])
+        c.rebuild()
+        assert c.is_missing("/a") == False
+        assert c.is_missing("/c") == True
+
+    def test_clear_during_rebuild(self):
+        c = self.cache
+        c.db = MockDB(["/a", "/b"], on_query=c.clear)
+        # the bloom filter built from the keys read before the clear is discarded
+        c.rebuild()
+        assert c.bloom is None
+        assert c.last_rebuild is None
+
+class TestNotFoundCacheNotShared:
+    def setup_method(self, method):
+        self.cache = NotFoundCache(db=None, capacity=10, miss_ttl=60)
+
+    def test_no_bloom(self):
+        c = self.cache
+        assert c.is_missing("/a") == False
+        # the bloom filter is never built, keys created by other processes wouldn't be known
+        assert c.last_rebuild is None and not c._rebuilding
+
+        c.add_missing("/a", c.generation)
+        assert c.is_missing("/a") == True
+
+    def test_miss_ttl(self):
+        c = self.cache
+        c.add_missing("/a", c.generation)
+        c.misses["/a"] = time.time() - 61
+        assert c.is_missing("/a") == False
+        assert "/a" not in c.misses
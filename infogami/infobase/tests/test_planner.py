@@ -0,0 +1,116 @@
+from infogami.infobase import readquery
+from infogami.infobase._dbstore.planner import Planner, PropertyStats, TableStats
+from infogami.infobase._dbstore.querycache import compile_query
+from infogami.infobase._dbstore.save import IndexUtil
+from infogami.infobase._dbstore.schema import Schema
+
+import web
+
+class MockStore:
+    properties = {"title": 1, "subject": 2, "publisher": 3, "isbn": 4}
+
+    def get_property_id(self, type, name):
+        return self.properties.get(name)
+
+class MockDB:
+    def __init__(self):
+        self.queries = []
+
+    def multiple_insert(self, table, values, seqname=None):
+        self.queries.append(("insert", table, len(values)))
+
+    def delete(self, table, where, vars):
+        self.queries.append(("delete", table))
+
+def make_query(conditions, sort=None):
+    q = readquery.Query()
+    q.add_condition("type", "=", "ref", "/type/edition")
+    for key, op, value in conditions:
+        q.add_condition(key, op, "str", value)
+    q.sort = sort and web.storage(key=sort, datatype="str")
+    q.limit, q.offset = 20, 0
+    return q
+
+class TestPlanner:
+    def setup_method(self, method):
+        self.stats = PropertyStats(None)
+        # title: 1M rows, subject: 5M rows, publisher: 2M rows, isbn: 1M rows
+        self.stats.tables["datum_str"] = TableStats(
+            rows=9000000,
+            key_rows={1: 1000000, 2: 5000000, 3: 2000000, 4: 1000000},
+            rows_per_value=10)
+        self.planner = Planner(Schema(), self.stats, in_threshold=1000)
+        self.store = MockStore()
+
+    def plan(self, q):
+        return self.planner.plan(self.store, q)
+
+    def test_single_property(self):
+        assert self.plan(make_query([("title", "=", "foo")])) is None
+
+    def test_order(self):
+        q = make_query([("subject", "~", "a*"), ("publisher", "!=", "x"), ("isbn", "=", "123")])
+        plan = self.plan(q)
+        assert [(g.key, g.estimate, g.strategy) for g in plan.groups] == [
+            ("isbn", 10, "join"),
+            ("subject", 25000, "exists"),
+            ("publisher", 2000000, "exists"),
+        ]
+        assert plan.empty is None
+        assert plan.estimate() == 10
+        assert plan.dict()["estimate"] == 10
+
+        # whatever the order of the groups
+        plan.groups.reverse()
+        assert plan.estimate() == 10
+
+    def test_in(self):
+        q = make_query([("subject", "=", "fiction"), ("isbn", "=", "123")])
+        plan = self.plan(q)
+        assert [(g.key, g.strategy) for g in plan.groups] == [("subject", "join"), ("isbn", "in")]
+
+    def test_stats_change_plan(self):
+        q = make_query([("subject", "=", "fiction"), ("publisher", "~", "x*")])
+        plan = self.plan(q)
+        assert [(g.key, g.strategy) for g in plan.groups] == [("subject", "join"), ("publisher", "exists")]
+
+        self.stats.tables["datum_str"].rows_per_value = 100000
+        plan = self.plan(q)
+        assert [(g.key, g.strategy) for g in plan.groups] == [("publisher", "join"), ("subject", "exists")]
+
+    def test_sort_is_joined(self):
+        q = make_query([("isbn", "=", "123"), ("publisher", "~", "x*")], sort="-publisher")
+        plan = self.plan(q)
+        assert [(g.key, g.strategy) for g in plan.groups] == [("isbn", "join"), ("publisher", "join")]
+
+    def test_empty(self):
+        # values of different labels, like {"a:isbn": "1", "b:isbn": "2"}, must match the same row
+        assert self.plan(make_query([("isbn", "=", "1"), ("isbn", "=", "2"), ("title", "=", "foo")])).empty
+
+        assert self.plan(make_query([("isbn", "=", []), ("title", "=", "foo")])).empty
+        assert self.plan(make_query([("isbn", "=", "1"), ("foo", "=", "bar")])).empty
+
+    def test_compile(self):
+        q = make_query([("subject", "=", "fiction"), ("publisher", "~", "x*"), ("isbn", "=", "123")])
+        plan = self.plan(q)
+        sql = compile_query(Schema(), q, plan).sql()
+        assert sql.startswith("SELECT d0.thing_id FROM datum_str as d0 WHERE d0.key_id=")
+        assert "d0.thing_id IN (SELECT s0.thing_id FROM datum_str as s0 WHERE s0.key_id=" in sql
+        assert "EXISTS (SELECT 1 FROM datum_str as s1 WHERE s1.thing_id = d0.thing_id AND s1.key_id=" in sql
+
+    def test_join_order(self):
+        q = make_query([("isbn", "=", "123"), ("publisher", "~", "x*")], sort="-publisher")
+        q.add_condition("key", "~", "str", "/books/*")
+        sql = compile_query(Schema(), q, self.plan(q)).sql()
+        # the tables are joined in the order of the plan, with the first one
+        assert sql.startswith("SELECT thing.key FROM datum_str as d0, datum_str as d1, thing WHERE ")
+        assert "d0.thing_id = d1.thing_id AND d0.thing_id = thing.id" in sql
+
+    def test_index_stats(self):
+        db = MockDB()
+        index = IndexUtil(db, property_manager=object(), stats=self.stats)
+        index.insert_index({("datum_str", 100, 1): ["a", "b"], ("datum_str", 101, 1): ["c"]})
+        assert self.stats.rows("datum_str", 1) == 1000003
+
+        index.delete_index({("datum_str", 100, 1): ["a"], ("datum_str", 102, None): []})
+        assert self.stats.rows("datum_str", 1) == 1000002
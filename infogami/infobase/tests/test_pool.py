@@ -0,0 +1,270 @@
+from infogami.infobase._dbstore import pool
+from infogami.infobase._dbstore.pool import ConnectionPool, PoolTimeout
+
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import web
+
+class MockConnection:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.closed = False
+        self.queries = []
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, values=None):
+        if self.fail:
+            raise Exception("server closed the connection unexpectedly")
+        self.queries.append((query, values))
+
+    def fetchall(self):
+        return [(1,)]
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+class TestConnectionPool:
+    def setup_method(self, method):
+        self.connections = []
+
+    def connect(self):
+        conn = MockConnection()
+        self.connections.append(conn)
+        return conn
+
+    def test_reuse(self):
+        p = ConnectionPool(self.connect, max_size=2)
+        conn = p.get()
+        p.put(conn)
+        assert p.get() is conn
+        assert len(self.connections) == 1
+
+    def test_fill(self):
+        p = ConnectionPool(self.connect, min_size=3, max_size=5)
+        p.fill()
+        assert len(self.connections) == 3
+        assert p.stats()['connections'] == dict(size=3, idle=3, in_use=0)
+
+    def test_session_settings(self):
+        p = ConnectionPool(self.connect, session={"statement_timeout": 60000})
+        conn = p.get()
+        assert conn.queries == [("SELECT set_config(%s, %s, false)", ("statement_timeout", "60000"))]
+
+    def test_timeout(self):
+        p = ConnectionPool(self.connect, max_size=1, timeout=0.05)
+        p.get()
+        try:
+            p.get()
+            assert False, "PoolTimeout must be raised"
+        except PoolTimeout:
+            pass
+
+        stats = p.stats()
+        assert stats['timeouts'] == 1
+        assert stats['max_wait_time'] >= 0.05
+
+    def test_wait(self):
+        p = ConnectionPool(self.connect, max_size=1, timeout=5)
+        conn = p.get()
+
+        def release():
+            time.sleep(0.05)
+            p.put(conn)
+        threading.Thread(target=release).start()
+
+        assert p.get() is conn
+        stats = p.stats()
+        assert stats['waits'] == 1
+        assert stats['wait_time'] > 0
+
+    def test_broken(self):
+        p = ConnectionPool(self.connect, max_size=1)
+        conn = p.get()
+        p.put(conn, broken=True)
+        assert conn.closed
+
+        # the slot of the broken connection must be available again
+        assert p.get() is not conn
+        assert p.stats()['broken'] == 1
+
+    def test_health_check(self):
+        p = ConnectionPool(self.connect, check_interval=0)
+        conn = p.get()
+        p.put(conn)
+        conn.fail = True
+
+        new_conn = p.get()
+        assert new_conn is not conn
+        assert conn.closed
+        assert p.stats()['health_check_failures'] == 1
+        assert p.stats()['connections']['size'] == 1
+
+    def test_closed_connection(self):
+        p = ConnectionPool(self.connect, check_interval=None)
+        conn = p.get()
+        p.put(conn)
+        conn.closed = True
+        assert p.get() is not conn
+
+    def test_reap(self):
+        p = ConnectionPool(self.connect, min_size=1, max_size=3, max_idle=0)
+        c1, c2, c3 = p.get(), p.get(), p.get()
+        for c in [c1, c2, c3]:
+            p.put(c)
+        # idle connections are closed, leaving min_size of them
+        assert p.stats()['connections'] == dict(size=1, idle=1, in_use=0)
+        assert [c.closed for c in [c1, c2, c3]] == [True, True, False]
+
+    def test_threads(self):
+        p = ConnectionPool(self.connect, max_size=3, timeout=5)
+        errors = []
+
+        def f():
+            try:
+                for i in range(100):
+                    conn = p.get()
+                    p.put(conn)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=f) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert errors == []
+        assert len(self.connections) <= 3
+
+class SQLiteConnection:
+    """sqlite3 connection which starts a transaction before the first statement, like psycopg2.
+
+    The sqlite3 module of python 2 commits the transaction before SAVEPOINT,
+    so nested transactions don't work with its own transaction handling.
+    """
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.in_transaction = False
+
+    def cursor(self):
+        return SQLiteCursor(self)
+
+    def commit(self):
+        self._end("COMMIT")
+
+    def rollback(self):
+        self._end("ROLLBACK")
+
+    def _end(self, statement):
+        if self.in_transaction:
+            self.in_transaction = False
+            self.conn.execute(statement)
+
+    def close(self):
+        self.conn.close()
+
+class SQLiteCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = conn.conn.cursor()
+
+    def execute(self, query, values=()):
+        if not self.conn.in_transaction:
+            self.cursor.execute("BEGIN")
+            self.conn.in_transaction = True
+        return self.cursor.execute(query, values)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+class TestAttach:
+    """Runs queries and transactions through a web.database using the pool."""
+    def setup_method(self, method):
+        self.path = tempfile.mktemp()
+        self.db = web.database(dbn="sqlite", db=self.path)
+        self.db.printing = False
+        self.pool = pool.attach(self.db, min_size=1, max_size=2)
+        # replace the connections opened by the pool
+        self.pool.close()
+        self.pool._connect = lambda: SQLiteConnection(self.path)
+        self.db.query("CREATE TABLE t (x int)")
+
+    def teardown_method(self, method):
+        self.pool.close()
+        os.remove(self.path)
+
+    def values(self):
+        return [row.x for row in self.db.query("SELECT x FROM t ORDER BY x")]
+
+    def in_use(self):
+        return self.pool.stats()['connections']['in_use']
+
+    def test_query(self):
+        self.db.insert("t", x=1)
+        assert self.values() == [1]
+        # the connection is returned after every query outside of a transaction
+        assert self.in_use() == 0
+        assert self.pool.stats()['connections']['size'] == 1
+
+    def test_transaction(self):
+        t = self.db.transaction()
+        self.db.insert("t", x=1)
+        # the connection is held for the whole of the transaction
+        assert self.in_use() == 1
+
+        nested = self.db.transaction()
+        self.db.insert("t", x=2)
+        nested.rollback()
+        assert self.in_use() == 1
+
+        nested = self.db.transaction()
+        self.db.insert("t", x=3)
+        nested.commit()
+        t.commit()
+
+        assert self.in_use() == 0
+        assert self.values() == [1, 3]
+
+    def test_rollback(self):
+        t = self.db.transaction()
+        self.db.insert("t", x=1)
+        nested = self.db.transaction()
+        self.db.insert("t", x=2)
+        nested.commit()
+        t.rollback()
+
+        assert self.in_use() == 0
+        assert self.values() == []
+
+    def test_error(self):
+        try:
+            self.db.query("SELECT * FROM no_such_table")
+            assert False, "the error must be raised"
+        except Exception:
+            pass
+        # the connection is returned to the pool after the error
+        assert self.in_use() == 0
+        assert self.values() == []
+
+        # an error inside a nested transaction rolls back only the nested transaction
+        t = self.db.transaction()
+        self.db.insert("t", x=1)
+        nested = self.db.transaction()
+        try:
+            self.db.query("SELECT * FROM no_such_table")
+        except Exception:
+            pass
+        t.commit()
+        assert self.values() == [1]
+        assert self.in_use() == 0
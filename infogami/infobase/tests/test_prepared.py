@@ -0,0 +1,143 @@
+from infogami.infobase._dbstore.prepared import StatementRegistry
+
+import web
+
+class DBError(Exception):
+    def __init__(self, pgcode):
+        Exception.__init__(self, pgcode)
+        self.pgcode = pgcode
+
+class MockConnection:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.executed = []
+        self.rollbacks = 0
+
+    def cursor(self):
+        return self
+
+    def execute(self, query):
+        if self.fail and query.startswith("PREPARE"):
+            raise DBError("42601")
+        self.executed.append(query)
+
+    def rollback(self):
+        self.rollbacks += 1
+
+class MockDB:
+    """web.database stand-in recording the queries."""
+    def __init__(self):
+        self.ctx = web.storage(db=MockConnection(), transactions=[])
+        self.queries = []
+        # errors raised by the next queries
+        self.errors = []
+
+    def query(self, q):
+        self.queries.append(str(q))
+        if self.errors:
+            raise self.errors.pop(0)
+        return [web.storage(id=1)]
+
+class TestStatementRegistry:
+    def setup_method(self, method):
+        self.db = MockDB()
+        self.registry = StatementRegistry(self.db, enabled=True)
+        self.registry.register("thing_by_key", "SELECT * FROM thing WHERE key=$1", ["text"])
+
+    def test_disabled(self):
+        registry = StatementRegistry(self.db)
+        registry.register("thing_by_key", "SELECT * FROM thing WHERE key=$1", ["text"])
+        assert registry.query("thing_by_key", "/a") == [web.storage(id=1)]
+        assert self.db.queries == ["SELECT * FROM thing WHERE key='/a'"]
+        assert self.db.ctx.db.executed == []
+        assert registry.stats()['statements']['thing_by_key']['plain'] == 1
+
+    def test_prepare_once(self):
+        self.registry.query("thing_by_key", "/a")
+        self.registry.query("thing_by_key", "/b")
+
+        assert self.db.ctx.db.executed == ["PREPARE ib_thing_by_key (text) AS SELECT * FROM thing WHERE key=$1"]
+        assert self.db.queries == ["EXECUTE ib_thing_by_key ('/a')", "EXECUTE ib_thing_by_key ('/b')"]
+
+        stats = self.registry.stats()['statements']['thing_by_key']
+        assert stats['calls'] == 2
+        assert stats['prepares'] == 1
+
+    def test_prepare_per_connection(self):
+        self.registry.query("thing_by_key", "/a")
+        conn = self.db.ctx.db = MockConnection()
+        self.registry.query("thing_by_key", "/a")
+        assert len(conn.executed) == 1
+
+    def test_prepare_failure(self):
+        conn = self.db.ctx.db = MockConnection(fail=True)
+        self.registry.query("thing_by_key", "/a")
+        self.registry.query("thing_by_key", "/b")
+
+        # the statement is not prepared again on this connection and the queries run as plain queries
+        assert conn.rollbacks == 1
+        assert self.db.queries == ["SELECT * FROM thing WHERE key='/a'", "SELECT * FROM thing WHERE key='/b'"]
+
+    def test_prepare_failure_in_transaction(self):
+        conn = self.db.ctx.db = MockConnection(fail=True)
+        self.db.ctx.transactions = [object()]
+        self.registry.query("thing_by_key", "/a")
+
+        # only the PREPARE is rolled back, not the transaction
+        assert conn.rollbacks == 0
+        assert conn.executed == ["SAVEPOINT ib_prepare", "ROLLBACK TO SAVEPOINT ib_prepare"]
+        assert self.db.queries == ["SELECT * FROM thing WHERE key='/a'"]
+
+    def test_prepare_in_transaction(self):
+        self.db.ctx.transactions = [object()]
+        self.registry.query("thing_by_key", "/a")
+        assert self.db.ctx.db.executed == [
+            "SAVEPOINT ib_prepare",
+            "PREPARE ib_thing_by_key (text) AS SELECT * FROM thing WHERE key=$1",
+            "RELEASE SAVEPOINT ib_prepare"]
+
+    def test_unusable_statement(self):
+        self.registry.query("thing_by_key", "/a")
+
+        # the query is retried as a plain query
+        self.db.errors = [DBError("26000")]
+        assert self.registry.query("thing_by_key", "/b") == [web.storage(id=1)]
+        assert self.db.queries[-2:] == ["EXECUTE ib_thing_by_key ('/b')", "SELECT * FROM thing WHERE key='/b'"]
+
+        self.registry.query("thing_by_key", "/c")
+        assert self.db.queries[-1] == "SELECT * FROM thing WHERE key='/c'"
+
+    def test_unusable_statement_in_transaction(self):
+        self.registry.query("thing_by_key", "/a")
+
+        # the transaction is aborted by the error, so it can't be retried
+        self.db.ctx.transactions = [object()]
+        self.db.errors = [DBError("0A000")]
+        try:
+            self.registry.query("thing_by_key", "/b")
+            assert False, "the error must be raised"
+        except DBError:
+            pass
+        assert self.registry.stats()['statements']['thing_by_key']['errors'] == 1
+
+        self.registry.query("thing_by_key", "/c")
+        assert self.db.queries[-1] == "SELECT * FROM thing WHERE key='/c'"
+
+    def test_other_errors(self):
+        self.registry.query("thing_by_key", "/a")
+
+        # errors like statement timeouts don't affect the prepared statement
+        self.db.errors = [DBError("57014")]
+        try:
+            self.registry.query("thing_by_key", "/b")
+            assert False, "the error must be raised"
+        except DBError:
+            pass
+
+        self.registry.query("thing_by_key", "/c")
+        assert self.db.queries[-1] == "EXECUTE ib_thing_by_key ('/c')"
+
+    def test_array_parameter(self):
+        self.registry.register("many", "SELECT * FROM thing WHERE key = ANY($1)", ["text[]"])
+        q = self.registry.statements["many"].sql_query([["/a", "/b"]])
+        assert q.values() == [["/a", "/b"]]
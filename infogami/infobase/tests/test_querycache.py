@@ -0,0 +1,115 @@
+from infogami.infobase import common, readquery
+from infogami.infobase._dbstore.querycache import QueryCache, compile_query, query_shape
+from infogami.infobase._dbstore.schema import Schema
+
+import py.test
+import web
+
+class MockStore:
+    """Store with the things and properties required for binding the queries."""
+    def __init__(self):
+        self.ids = {"/type/page": 1, "/authors/a": 10, "/authors/b": 11}
+        self.properties = {"title": 100, "author": 101}
+
+    def get_metadata(self, key):
+        if key in self.ids:
+            return web.storage(id=self.ids[key], key=key)
+
+    def get_property_id(self, type, name):
+        return self.properties.get(name)
+
+def make_query(conditions, sort=None, limit=20, offset=0):
+    q = readquery.Query()
+    q.add_condition("type", "=", "ref", "/type/page")
+    for key, op, datatype, value in conditions:
+        q.add_condition(key, op, datatype, value)
+    q.sort = sort and web.storage(key=sort, datatype="str")
+    q.limit, q.offset = limit, offset
+    return q
+
+class TestQueryCache:
+    def setup_method(self, method):
+        self.cache = QueryCache(Schema())
+        self.store = MockStore()
+
+    def test_shape(self):
+        q1 = make_query([("title", "=", "str", "foo")])
+        q2 = make_query([("title", "=", "str", "bar")], offset=20)
+        q3 = make_query([("title", "~", "str", "bar*")])
+        q4 = make_query([("title", "=", "str", "foo")], sort="-title")
+        assert query_shape(q1) == query_shape(q2)
+        assert query_shape(q1) != query_shape(q3)
+        assert query_shape(q1) != query_shape(q4)
+
+        q5 = make_query([("title", "=", "str", ["a", "b"])])
+        q6 = make_query([("title", "=", "str", ["a", "b", "c"])])
+        assert query_shape(q5) != query_shape(q6)
+
+    def test_hits(self):
+        c1 = self.cache.get(make_query([("title", "=", "str", "foo")]))
+        c2 = self.cache.get(make_query([("title", "=", "str", "bar")]))
+        assert c1 is c2
+
+        stats = self.cache.stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert stats['size'] == 1
+
+    def test_disabled(self):
+        cache = QueryCache(Schema(), capacity=0)
+        q = make_query([("title", "=", "str", "foo")])
+        assert cache.get(q) is not cache.get(q)
+        assert cache.stats()['misses'] == 2
+
+    def test_bind(self):
+        q = make_query([("title", "~", "str", "foo*"), ("author", "=", "ref", ["/authors/a", "/authors/b"])], sort="title")
+        sql = self.cache.get(q).bind(self.store, q)
+        assert sql.values() == [100, "foo%", 101, 10, 11, 100, 20, 0]
+        assert "d0.value LIKE" in str(sql)
+        assert "(d1.value = 10 OR d1.value = 11)" in str(sql)
+        assert "ORDER BY d0.value" in str(sql)
+
+    def test_bind_missing(self):
+        q = make_query([("author", "=", "ref", "/authors/x")])
+        py.test.raises(StopIteration, self.cache.get(q).bind, self.store, q)
+
+        q = make_query([("publisher", "=", "str", "foo")])
+        py.test.raises(StopIteration, self.cache.get(q).bind, self.store, q)
+
+    def test_common_properties(self):
+        q = readquery.Query()
+        q.add_condition("key", "~", "key", "/authors/*")
+        q.sort = web.storage(key="-created", datatype="datetime")
+        q.limit, q.offset = 10, 0
+        compiled = compile_query(Schema(), q)
+        assert compiled.column == 'key'
+        assert compiled.sql() == "SELECT thing.key FROM thing WHERE thing.key LIKE $1 ORDER BY thing.created desc LIMIT $2 OFFSET $3"
+
+        # type is required for querying by other properties
+        q = readquery.Query()
+        q.add_condition("title", "=", "str", "foo")
+        py.test.raises(common.BadData, compile_query, Schema(), q)
+
+    def test_cursor(self):
+        q = make_query([("title", "=", "str", "foo")], sort="-title")
+        q.use_cursor = True
+        q.cursor = web.storage(sort="-title", value="foo", id=42)
+        compiled = self.cache.get(q)
+        assert "(d0.value, d0.thing_id) < ($4, $5)" in compiled.sql()
+        assert "ORDER BY d0.value desc, d0.thing_id desc" in compiled.sql()
+        assert "OFFSET" not in compiled.sql()
+        assert compiled.bind(self.store, q).values() == [100, "foo", 100, "foo", 42, 20]
+
+    def test_count(self):
+        q = make_query([("title", "=", "str", "foo")], sort="-title")
+        q.use_cursor = True
+        q.cursor = web.storage(sort="-title", value="foo", id=42)
+        compiled = self.cache.get(q, count="exact")
+        assert compiled.column == "count"
+        assert compiled.sql().startswith("SELECT count(DISTINCT d0.thing_id) AS count FROM datum_str as d0 WHERE ")
+        for s in ["ORDER BY", "LIMIT", "OFFSET", "42"]:
+            assert s not in str(compiled.bind(self.store, q))
+
+        compiled = self.cache.get(q, count="estimate")
+        assert compiled.sql().startswith("EXPLAIN SELECT d0.thing_id FROM")
+        assert self.cache.stats()['misses'] == 2
@@ -1,5 +1,6 @@
-from infogami.infobase import dbstore
+from infogami.infobase import dbstore, config, cache
 from infogami.infobase._dbstore.save import SaveImpl, IndexUtil, PropertyManager
+from infogami.infobase._dbstore.singleflight import SingleFlight
 
 import utils
 
@@ -280,6 +281,211 @@ def pytest_funcarg__testdata(request):
         },
     }
 
+class TestLatestData(DBTest):
+    def setup_method(self, method):
+        DBTest.setup_method(self, method)
+        config.use_latest_data = True
+        
+    def teardown_method(self, method):
+        config.use_latest_data = False
+        DBTest.teardown_method(self, method)
+        
+    def _save(self, docs):
+        s = SaveImpl(db)
+        timestamp = datetime.datetime(2010, 01, 01, 01, 01, 01)
+        return s.save(docs, timestamp=timestamp, comment="foo", ip="1.2.3.4", author=None, action="save")
+        
+    def get_latest_data(self, key):
+        d = db.query("SELECT * FROM latest_data WHERE key=$key", vars=locals())
+        return d and d[0] or None
+        
+    def test_save(self):
+        self._save([{"key": "/a", "type": {"key": "/type/object"}, "title": "a"}])
+        row = self.get_latest_data("/a")
+        assert row.revision == 1
+        assert simplejson.loads(row.data)['title'] == "a"
+        
+        self._save([{"key": "/a", "type": {"key": "/type/object"}, "title": "b"}])
+        row = self.get_latest_data("/a")
+        assert row.revision == 2
+        assert simplejson.loads(row.data)['title'] == "b"
+        
+    def test_missing_row(self):
+        # documents created before the table was populated get a row on the next save
+        self._save([{"key": "/a", "type": {"key": "/type/object"}, "title": "a"}])
+        db.delete("latest_data", where="key='/a'")
+        
+        self._save([{"key": "/a", "type": {"key": "/type/object"}, "title": "b"}])
+        assert self.get_latest_data("/a").revision == 2
+        
+    def test_get(self):
+        store = dbstore.DBSiteStore(db, dbstore.Schema())
+        self._save([{"key": "/a", "type": {"key": "/type/object"}, "title": "a"}])
+        self._save([{"key": "/a", "type": {"key": "/type/object"}, "title": "b"}])
+        
+        assert simplejson.loads(store.get("/a"))['title'] == "b"
+        assert simplejson.loads(store.get("/a", revision=1))['title'] == "a"
+        assert store.get("/b") is None
+        assert store.get_many_as_dict(["/a", "/b"]).keys() == ["/a"]
+        
+        # reads without latest_data must return the same
+        config.use_latest_data = False
+        assert simplejson.loads(store.get("/a"))['title'] == "b"
+        assert store.get("/b") is None
+        
+class TestMetadataCache(DBTest):
+    def setup_method(self, method):
+        DBTest.setup_method(self, method)
+        config.metadata_cache = {"capacity": 10}
+        self.store = dbstore.DBSiteStore(db, dbstore.Schema())
+        # the tests run in a transaction, which bypasses the cache
+        self.store._in_transaction = lambda: False
+        cache.loadhook()
+        
+    def teardown_method(self, method):
+        config.metadata_cache = None
+        self.store.close()
+        DBTest.teardown_method(self, method)
+        
+    def _save(self, doc):
+        timestamp = datetime.datetime(2010, 01, 01, 01, 01, 01)
+        return self.store.save_many([doc], timestamp=timestamp, comment="foo", data={}, ip="1.2.3.4", author=None)
+        
+    def test_get_metadata(self):
+        self._save({"key": "/a", "type": {"key": "/type/object"}, "title": "a"})
+        
+        a = self.store.get_metadata("/a")
+        assert a.latest_revision == 1
+        assert self.store.metadata_cache.get_by_key("/a").id == a.id
+        
+        # the cached row is used by key and by id
+        db.query("UPDATE thing SET last_modified=NULL WHERE key='/a'")
+        assert self.store.get_metadata("/a").last_modified is not None
+        assert self.store.get_metadata_from_id(a.id).last_modified is not None
+        assert self.store.get_metadata_list(["/a"])["/a"].id == a.id
+        assert self.store.get_metadata_list_from_ids([a.id])[a.id].key == "/a"
+        
+    def test_save_invalidates(self):
+        self._save({"key": "/a", "type": {"key": "/type/object"}, "title": "a"})
+        assert self.store.get_metadata("/a").latest_revision == 1
+        
+        self._save({"key": "/a", "type": {"key": "/type/object"}, "title": "b"})
+        assert self.store.get_metadata("/a").latest_revision == 2
+        
+    def test_missing(self):
+        assert self.store.get_metadata("/missing") is None
+        assert self.store.get_metadata_list(["/missing"]) == {}
+        assert len(self.store.metadata_cache.key2id) == 0
+        
+    def test_read_during_save(self):
+        self._save({"key": "/a", "type": {"key": "/type/object"}, "title": "a"})
+        
+        # a read that got the row before the next save was committed adds it after the save
+        generation = self.store._metadata_generation()
+        row = db.query("SELECT * FROM thing WHERE key='/a'")[0]
+        self._save({"key": "/a", "type": {"key": "/type/object"}, "title": "b"})
+        self.store._cache_metadata([row], generation)
+        
+        assert self.store.metadata_cache.get_by_key("/a") is None
+        assert self.store.get_metadata("/a").latest_revision == 2
+        
+    def test_flush(self):
+        self._save({"key": "/a", "type": {"key": "/type/object"}, "title": "a"})
+        self.store.get_metadata("/a")
+        cache.flush()
+        assert self.store.metadata_cache.get_by_key("/a") is None
+        
+    def test_shared_load(self):
+        row = web.storage(id=1, key="/a", latest_revision=1)
+        self.store.singleflight = SingleFlight()
+        self.store._get_metadata = lambda key: row
+        
+        # every caller gets its own copy of the row loaded for all of them
+        a = self.store.get_metadata("/a")
+        a.latest_revision = 2
+        assert self.store.get_metadata("/a").latest_revision == 1
+        assert row.latest_revision == 1
+        
+    def test_close(self):
+        self._save({"key": "/a", "type": {"key": "/type/object"}, "title": "a"})
+        self.store.get_metadata("/a")
+        
+        # a closed store doesn't listen to the invalidations anymore
+        self.store.close()
+        cache.invalidate(["/a"])
+        assert self.store.metadata_cache.get_by_key("/a") is not None
+        
+    def test_save_in_transaction(self):
+        self._save({"key": "/a", "type": {"key": "/type/object"}, "title": "a"})
+        assert self.store.get_metadata("/a").latest_revision == 1
+        
+        # the save is committed only with the outermost transaction, which is the one of the test
+        del self.store._in_transaction
+        try:
+            tx = db.transaction()
+            self._save({"key": "/a", "type": {"key": "/type/object"}, "title": "b"})
+            tx.commit()
+        finally:
+            self.store._in_transaction = lambda: False
+        assert self.store.metadata_cache.get_by_key("/a").latest_revision == 1
+        
+class TestNotFoundCache(DBTest):
+    def setup_method(self, method):
+        DBTest.setup_method(self, method)
+        config.notfound_cache = {"capacity": 10}
+        self.store = dbstore.DBSiteStore(db, dbstore.Schema())
+        
+    def teardown_method(self, method):
+        config.notfound_cache = None
+        self.store.close()
+        DBTest.teardown_method(self, method)
+        
+    def test_create_in_transaction(self):
+        c = self.store.notfound_cache
+        c.add_missing("/a", c.generation)
+        generation = c.generation
+        
+        # the key is created only when the outermost transaction, the one of the test, is committed
+        tx = db.transaction()
+        self.store.new_thing(key="/a")
+        tx.commit()
+        assert c.generation == generation
+        
+class TestAfterCommit:
+    def setup_method(self, method):
+        self.db = web.database(dbn="sqlite", db=":memory:")
+        self.db.printing = False
+        self.db.ctx.ignore_nested_transactions = True
+        self.calls = []
+        
+    def after_commit(self):
+        dbstore.after_commit(self.db, lambda: self.calls.append(1))
+        
+    def test_no_transaction(self):
+        self.after_commit()
+        assert self.calls == [1]
+        
+    def test_nested(self):
+        tx = self.db.transaction()
+        nested = self.db.transaction()
+        self.after_commit()
+        nested.commit()
+        assert self.calls == []
+        self.after_commit()
+        tx.commit()
+        assert self.calls == [1, 1]
+        
+        # the next transaction has its own calls
+        with self.db.transaction():
+            self.after_commit()
+        assert self.calls == [1, 1, 1]
+        
+    def test_rollback(self):
+        tx = self.db.transaction()
+        self.after_commit()
+        tx.rollback()
+        assert self.calls == []
+        
 class TestIndex:
     def setup_method(self, method):
         self.indexer = IndexUtil(MockDB(), MockSchema())
@@ -0,0 +1,92 @@
+from infogami.infobase.shmcache import SharedMemoryCache
+
+import os
+
+class TestSharedMemoryCache:
+    def setup_method(self, method):
+        self.path = "/tmp/infobase_test_shmcache_%d" % os.getpid()
+
+    def teardown_method(self, method):
+        os.remove(self.path)
+
+    def test_get_set(self):
+        d = SharedMemoryCache(self.path, capacity="64K", slot_size="1K")
+        d["/a"] = '{"key": "/a"}'
+        d.update({"/b": "b", u"/\u20ac": u"\u20ac"})
+
+        assert d["/a"] == '{"key": "/a"}'
+        assert d.get(u"/\u20ac") == u"\u20ac"
+        assert isinstance(d.get(u"/\u20ac"), unicode)
+        assert d.get("/x") is None
+        assert "/b" in d
+        assert sorted(d.get_multi(["/a", "/b", "/x"])) == ["/a", "/b"]
+        assert len(d) == 3
+
+        d["/a"] = "a2"
+        assert d["/a"] == "a2"
+        assert len(d) == 3
+
+        d.delete_many(["/a", "/x"])
+        assert "/a" not in d
+        assert sorted(d.keys()) == ["/b", u"/\u20ac"]
+        assert dict(d.items())[u"/\u20ac"] == u"\u20ac"
+
+        d.clear()
+        assert len(d) == 0
+        assert d.get("/b") is None
+
+    def test_unicode(self):
+        d = SharedMemoryCache(self.path, capacity="64K", slot_size="1K")
+        d["/a"] = u'{"name": "\u20ac"}'
+        d["/z"] = "\x01\xff"
+
+        # unicode values can be joined with the JSON read from the database
+        assert u"".join([d["/a"], u'{"name": "\xe9"}']) == u'{"name": "\u20ac"}{"name": "\xe9"}'
+        assert d.get_multi(["/a"]) == {"/a": u'{"name": "\u20ac"}'}
+
+        # byte strings, like the compressed values, are returned as they are
+        assert d["/z"] == "\x01\xff"
+        assert not isinstance(d["/z"], unicode)
+
+    def test_large_values(self):
+        d = SharedMemoryCache(self.path, capacity="64K", slot_size="1K")
+        d["/a"] = "a"
+        # values that don't fit in a slot are not cached and replace the older value.
+        d["/a"] = "x" * 2000
+        assert d.get("/a") is None
+
+    def test_eviction(self):
+        d = SharedMemoryCache(self.path, capacity="16K", slot_size="1K")
+        d["/hot"] = "hot"
+        for i in range(100):
+            d["/a/%d" % i] = "a"
+            d["/hot"]
+
+        assert len(d) == 16
+        assert d.stats()['evictions'] == 85
+        # recently read entries survive the sweep of the clock
+        assert d["/hot"] == "hot"
+
+    def test_shared(self):
+        d = SharedMemoryCache(self.path, capacity="64K", slot_size="1K")
+        pid = os.fork()
+        if pid == 0:
+            d["/child"] = "child"
+            os._exit(0)
+        os.waitpid(pid, 0)
+        assert d["/child"] == "child"
+
+        # another process opening the same file sees the same entries
+        d2 = SharedMemoryCache(self.path, capacity="64K", slot_size="1K")
+        assert d2["/child"] == "child"
+        d2["/a"] = "a"
+        assert d["/a"] == "a"
+
+    def test_geometry_change(self):
+        d = SharedMemoryCache(self.path, capacity="64K", slot_size="1K")
+        d["/a"] = "a"
+
+        # a file created with a different geometry is reinitialized
+        d = SharedMemoryCache(self.path, capacity="32K", slot_size="1K")
+        assert len(d) == 0
+        assert d.get("/a") is None
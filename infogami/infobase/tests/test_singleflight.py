@@ -0,0 +1,66 @@
+from infogami.infobase._dbstore.singleflight import SingleFlight
+
+import threading
+import time
+
+def run_concurrently(n, f):
+    results = []
+    def run():
+        try:
+            results.append(f())
+        except Exception, e:
+            results.append(e)
+    threads = [threading.Thread(target=run) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+class TestSingleFlight:
+    def test_coalesce(self):
+        sf = SingleFlight()
+        calls = []
+        def load():
+            calls.append(1)
+            time.sleep(0.2)
+            return "json"
+
+        results = run_concurrently(10, lambda: sf.do("/a", load))
+        assert results == ["json"] * 10
+        assert len(calls) == 1
+
+        stats = sf.stats()
+        assert stats['loads'] == 1
+        assert stats['coalesced'] == 9
+        assert stats['inflight'] == 0
+
+    def test_different_keys(self):
+        sf = SingleFlight()
+        assert sf.do("/a", lambda: 1) == 1
+        assert sf.do("/b", lambda: 2) == 2
+        assert sf.stats()['loads'] == 2
+
+    def test_error(self):
+        sf = SingleFlight()
+        def load():
+            time.sleep(0.2)
+            raise ValueError("db error")
+
+        results = run_concurrently(5, lambda: sf.do("/a", load))
+        assert len(results) == 5
+        assert all(isinstance(r, ValueError) for r in results)
+        assert sf.stats()['inflight'] == 0
+
+    def test_timeout(self):
+        sf = SingleFlight(timeout=0.05)
+        calls = []
+        def load():
+            calls.append(1)
+            time.sleep(0.3)
+            return "json"
+
+        results = run_concurrently(3, lambda: sf.do("/a", load))
+        assert results == ["json"] * 3
+        assert len(calls) == 3
+        assert sf.stats()['timeouts'] == 2
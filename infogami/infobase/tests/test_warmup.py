@@ -0,0 +1,63 @@
+from infogami.infobase import cache, lru, warmup
+
+import os
+import tempfile
+import time
+
+class MockStore:
+    """Store returning a document for every key starting with /a."""
+    def __init__(self):
+        self.calls = []
+
+    def get_many_as_dict(self, keys):
+        self.calls.append(keys)
+        d = dict((k, '{"key": "%s"}' % k) for k in keys if k.startswith("/a"))
+        c = cache.Cache()
+        for k, v in d.items():
+            c[k] = v
+        return d
+
+class TestWarmup:
+    def setup_method(self, method):
+        self._global_cache = cache.global_cache
+        self.path = tempfile.mktemp()
+
+    def teardown_method(self, method):
+        cache.global_cache = self._global_cache
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_snapshot(self):
+        cache.global_cache = lru.LRU(10)
+        for k in ["/a/1", "/a/2", u"/a/\u20ac"]:
+            cache.global_cache[k] = "{}"
+        cache.global_cache.get("/a/1")
+
+        assert warmup.take_snapshot(self.path, 2) == 2
+        assert warmup.read_snapshot(self.path) == ["/a/1", u"/a/\u20ac"]
+
+    def test_snapshot_not_supported(self):
+        cache.global_cache = cache.NoneDict()
+        assert warmup.take_snapshot(self.path, 10) is None
+        assert not os.path.exists(self.path)
+
+    def test_read_missing_snapshot(self):
+        assert warmup.read_snapshot(self.path) == []
+
+    def test_preload(self):
+        cache.global_cache = lru.LRU(100)
+        store = MockStore()
+        keys = ["/a/%d" % i for i in range(25)] + ["/b/1"]
+
+        assert warmup.preload(store, keys, batch_size=10, rate=None) == 25
+        assert [len(batch) for batch in store.calls] == [10, 10, 6]
+        assert len(cache.global_cache.keys()) == 25
+        assert "/b/1" not in cache.global_cache
+
+    def test_preload_rate(self):
+        cache.global_cache = lru.LRU(100)
+        keys = ["/a/%d" % i for i in range(20)]
+
+        t0 = time.time()
+        warmup.preload(MockStore(), keys, batch_size=5, rate=100)
+        assert time.time() - t0 >= 0.19
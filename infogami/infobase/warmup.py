@@ -0,0 +1,153 @@
+"""Warming up the global cache from snapshots of its hottest keys.
+
+After a restart every infobase process starts with an empty global_cache and
+all the requests go to the database till the cache is filled again. To avoid
+that, each process periodically writes the most recently used keys of its
+global_cache to a snapshot file, one key per line. On start, the keys in the
+snapshot are loaded into the cache in batches using get_many_as_dict. The
+loading is rate limited so that it doesn't overload the database when many
+processes are started together.
+
+This is enabled by the cache_snapshot section of the config.
+
+    cache_snapshot:
+        path: /var/cache/infobase/hot_keys.txt
+        sitename: openlibrary
+        interval: 300
+        size: 10000
+
+Snapshots are taken only for the cache types which keep track of the
+recently used keys, i.e. the ones with a recent_keys method.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+
+import web
+import cache
+
+logger = logging.getLogger("infobase.warmup")
+
+def take_snapshot(path, size):
+    """Writes the size most recently used keys of the global cache to path.
+    Returns the number of keys written or None if the cache doesn't track the recently used keys.
+    """
+    recent_keys = getattr(cache.global_cache, "recent_keys", None)
+    if recent_keys is None:
+        return None
+
+    keys = recent_keys(size)
+
+    # write to a temp file and rename, so that the readers never see a partial snapshot.
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    f = open(tmp, "w")
+    try:
+        for k in keys:
+            f.write(web.safestr(k) + "\n")
+    finally:
+        f.close()
+    os.rename(tmp, path)
+    return len(keys)
+
+def read_snapshot(path):
+    """Returns the keys in the snapshot at path. Returns an empty list if there is no snapshot."""
+    if not os.path.exists(path):
+        return []
+    keys = [web.safeunicode(line.strip()) for line in open(path)]
+    return [k for k in keys if k]
+
+def preload(store, keys, batch_size=100, rate=1000):
+    """Loads the given keys into the global cache, batch_size keys at a time
+    and at most rate keys per second. Returns the number of documents found.
+    """
+    found = 0
+    start = time.time()
+    for i in range(0, len(keys), batch_size):
+        batch = keys[i:i+batch_size]
+        cache.loadhook()
+        try:
+            found += len(store.get_many_as_dict(batch))
+        finally:
+            cache.unloadhook()
+
+        if rate:
+            delay = start + float(i + len(batch)) / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+    return found
+
+class Snapshotter:
+    """Takes a snapshot of the global cache every interval seconds and when the process exits."""
+    def __init__(self, path, interval=300, size=10000):
+        self.path = path
+        self.interval = interval
+        self.size = size
+
+        self.snapshots = 0
+        self.last_snapshot_size = None
+        self.last_snapshot_time = None
+
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.setDaemon(True)
+        t.start()
+        atexit.register(self.snapshot)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.snapshot()
+
+    def snapshot(self):
+        try:
+            n = take_snapshot(self.path, self.size)
+        except Exception:
+            logger.error("failed to write cache snapshot to %s", self.path, exc_info=True)
+            return
+        if n is not None:
+            self.snapshots += 1
+            self.last_snapshot_size = n
+            self.last_snapshot_time = time.time()
+
+    def stats(self):
+        return dict(
+            snapshots=self.snapshots,
+            last_snapshot_size=self.last_snapshot_size,
+            last_snapshot_time=self.last_snapshot_time)
+
+snapshotter = None
+
+def start(site, path, interval=300, size=10000, batch_size=100, rate=1000, block=False):
+    """Preloads the keys of the snapshot at path into the cache using the store of the site
+    and starts taking snapshots. When block is False, the keys are loaded in a background thread.
+    """
+    global snapshotter
+
+    keys = read_snapshot(path)
+    logger.info("preloading %d keys from %s", len(keys), path)
+
+    def load():
+        t0 = time.time()
+        try:
+            found = preload(site.store, keys, batch_size=batch_size, rate=rate)
+        except Exception:
+            logger.error("failed to preload the cache from %s", path, exc_info=True)
+        else:
+            logger.info("preloaded %d of %d keys in %.1f seconds", found, len(keys), time.time() - t0)
+
+    if keys:
+        if block:
+            load()
+        else:
+            t = threading.Thread(target=load)
+            t.setDaemon(True)
+            t.start()
+
+    if not hasattr(cache.global_cache, "recent_keys"):
+        logger.warn("cache snapshots are not supported by %s", cache.global_cache.__class__.__name__)
+        return
+
+    snapshotter = Snapshotter(path, interval=interval, size=size)
+    snapshotter.start()
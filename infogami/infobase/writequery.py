@@ -9,8 +9,7 @@ import account
 def get_thing(store, key, revision=None):
     if isinstance(key, common.Reference):
         key = unicode(key)
-    json = store.get(key, revision)
-    return json and common.Thing.from_json(store, key, json)
+    return store.get_thing(key, revision)
     
 class PermissionEngine:
     """Engine to check if a user has permission to modify a document.
@@ -7,7 +7,7 @@ def get_all_strings(site):
         return []
     else:
         q = {'type': '/type/i18n', 'limit': 1000}
-        return site.get_many(site.things(q))
+        return site.things_with_docs(q)
 
 def get_all_sites():
     if web.ctx.site.exists():
@@ -5,16 +5,14 @@ def get_all_templates(site):
     if t is None:
         return []
     q = {'type': '/type/template', 'limit': 1000}
-    #return [site.get(key) for key in site.things(q)]
-    return site.get_many([key for key in site.things(q)])
+    return site.things_with_docs(q)
 
 def get_all_macros(site):
     t = site.get('/type/macro')
     if t is None:
         return []
     q = {'type': '/type/macro', 'limit': 1000}
-    #return [site.get(key) for key in site.things(q)]
-    return site.get_many([key for key in site.things(q)])
+    return site.things_with_docs(q)
     
 def get_all_sites():
     if web.ctx.site.exists():
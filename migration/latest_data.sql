@@ -0,0 +1,28 @@
+-- Adds the latest_data table to an existing database (schema version 10 to 11).
+-- Run this before setting use_latest_data in the config:
+--
+--     $ psql infobase < migration/latest_data.sql
+--
+-- Documents saved after running this and before use_latest_data is enabled are
+-- stale in latest_data till they are saved again, so run this while the writes
+-- are stopped.
+
+BEGIN;
+
+create table latest_data (
+    thing_id int primary key references thing,
+    key text,
+    revision int,
+    data text
+);
+
+insert into latest_data (thing_id, key, revision, data)
+    select thing.id, thing.key, data.revision, data.data
+    from thing, data
+    where data.thing_id = thing.id and data.revision = thing.latest_revision;
+
+create unique index latest_data_key_idx ON latest_data(key);
+
+update meta set version = 11;
+
+COMMIT;